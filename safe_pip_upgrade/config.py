@@ -1,5 +1,4 @@
 import configparser
-import logging.config
 
 from typing import Callable
 
@@ -10,15 +9,97 @@ class Config:
     WORKING_DIRECTORY = r'./'
     LOCAL_REQUIREMENTS_FILE = r'./requirements.txt'
     IGNORE_LINE_STARTS = '# -r https:// http:// git+'.split()
+    # upgrade the files of the -r includes too and keep the candidates in
+    # the -c constraints
+    FOLLOW_INCLUDES = False
     TEST_START_COMMAND = 'python manage.py test --failfast --keepdb --no-input'
-
-    RUNNER = 'compose'
+    # cheap stages run before the tests, one per line, cheapest first:
+    # "name | timeout | command", e.g. "check | 60 | python manage.py check"
+    TEST_STAGES = ''
+    # regular expressions of the output lines of failed tests, one per line,
+    # the stage is aborted on the first matched line
+    TEST_FAILURE_PATTERNS = ''
+    # deadline of a stage is its previous durations percentile times the
+    # factor, not less than the minimum, 0 factor turns it off
+    TEST_DEADLINE_FACTOR = 3.0
+    TEST_DEADLINE_PERCENTILE = 95
+    TEST_DEADLINE_MIN = 60  # seconds
+    # don't test versions without wheels for the test environment
+    SKIP_SDIST_ONLY = False
+    # install only changed pins if the installed ones are known
+    INCREMENTAL_INSTALL = True
+
+    RUNNER = 'compose'  # "compose" or "venv"
+    # "sequential" tests packages one by one, "group" tests all upgrades
+    # at once and splits them only if the tests fail
+    STRATEGY = 'sequential'
+    WORKERS = 1  # number of runners to test packages in parallel
+    # reject candidates that conflict with the other pins without trials
+    RESOLVE_DEPENDENCIES = False
+    SEARCH_ARITY = 1  # number of versions of a package tested at once
+    # sqlite file of the known trial results, empty value turns it off
+    TRIAL_STORE = ''
+    # every decision is appended to the journal, so an interrupted upgrade
+    # can be resumed, e.g. pip_upgrade.journal, empty value turns it off
+    JOURNAL_FILE = ''
+    RESUME = False  # continue the unfinished session of the journal
+    # test command of the tests impacted by the upgrade with {tests} (dotted
+    # test modules) or {test_files} placeholder, empty value turns it off
+    IMPACT_TEST_COMMAND = ''
+    IMPACT_CACHE = 'pip_upgrade.impact.json'  # cached imports of the project
 
     # COMPOSE PARAMETERS
     COMPOSE_PROJECT_FOLDER = WORKING_DIRECTORY
     COMPOSE_REQUIREMENTS_FILE = LOCAL_REQUIREMENTS_FILE
     COMPOSE_SERVICE_NAME = 'django'
     COMPOSE_WORK_DIR = None  # Working directory inside the container
+    # the wheelhouse is mounted to this directory inside the container
+    COMPOSE_WHEELHOUSE_DIR = '/wheelhouse'
+    # keep the packages installed with the original requirements as the
+    # baseline and install trial pins to a layer dropped after the trial
+    COMPOSE_SNAPSHOT = False
+    COMPOSE_SNAPSHOT_DIR = '/tmp/safe_pip_upgrade_layer'
+    # talk to the docker engine API on this unix socket instead of running
+    # the docker CLI for every step, empty value uses the CLI
+    COMPOSE_DOCKER_SOCKET = ''
+    # follow the container events instead of polling docker before steps
+    COMPOSE_WATCH_EVENTS = True
+    COMPOSE_TIMEOUT = 20  # seconds to start the test container
+
+    # VENV PARAMETERS
+    VENV_PYTHON = 'python3'  # interpreter the environments are created with
+    # directory of the baseline and trial environments relative to the
+    # working directory
+    VENV_DIR = '.safe_pip_upgrade_venv'
+
+    # PYPI PARAMETERS
+    PYPI_INDEX_URL = 'https://pypi.org/simple/'  # PEP 691 json simple API
+    # directory of the release lists cache, e.g. ~/.cache/safe_pip_upgrade,
+    # empty value turns the cache off
+    PYPI_CACHE_DIR = ''
+    PYPI_CACHE_TTL = 60 * 60  # seconds before the cache entry is revalidated
+    PYPI_CACHE_MAX_SIZE = 20 * 1024 * 1024  # bytes
+    PYPI_REFRESH = False  # ignore cached release lists
+    PYPI_OFFLINE = False  # use cached release lists only
+    PYPI_WORKERS = 8  # max concurrent requests to pypi
+
+    # WHEELHOUSE PARAMETERS
+    # directory of the prebuilt candidate versions, empty value turns the
+    # wheelhouse off
+    WHEELHOUSE_DIR = ''
+    WHEELHOUSE_MAX_SIZE = 2 * 1024 * 1024 * 1024  # bytes
+    WHEELHOUSE_MAX_AGE = 30 * 24 * 60 * 60  # seconds a wheel is kept unused
+    WHEELHOUSE_WORKERS = 4  # concurrent downloads to the wheelhouse
+
+    # METRICS PARAMETERS
+    # json report of the run relative to the working directory, e.g.
+    # pip_upgrade.report.json, empty value turns it off
+    METRICS_REPORT = ''
+    # Prometheus textfile for the node exporter, empty value turns it off
+    METRICS_TEXTFILE = ''
+    # Chrome trace-event file of the run spans relative to the working
+    # directory, empty value turns tracing off
+    TRACE_FILE = ''
 
     command_handler: Callable
 
@@ -29,7 +110,9 @@ LOGGING = {
         'file': {
             'class': 'logging.FileHandler',
             'formatter': 'myFormatter',
-            'filename': 'pip_upgrade.log'
+            'filename': 'pip_upgrade.log',
+            # the file is created by the first record only
+            'delay': True,
         },
         'console': {
             'class': 'logging.StreamHandler',
@@ -49,7 +132,31 @@ LOGGING = {
     },
 }
 
-logging.config.dictConfig(LOGGING)
+
+def check_config():
+    """ Check the combination of the settings, raise ValueError if the
+    upgrade can't follow it. """
+    if int(Config.SEARCH_ARITY) > 1 and int(Config.WORKERS) <= 1:
+        # the versions of a package are tested at once on the workers,
+        # one runner bisects them
+        raise ValueError(f'search arity {Config.SEARCH_ARITY} needs '
+                         f'several workers, set --workers N with N > 1')
+    if Config.RESUME and not Config.JOURNAL_FILE:
+        raise ValueError('there is nothing to resume without the journal, '
+                         'set --journal FILE')
+    if Config.PYPI_OFFLINE and not Config.PYPI_CACHE_DIR:
+        raise ValueError('the offline mode uses the cached release lists, '
+                         'set --cache-dir DIR')
+
+
+def setup_logging():
+    """ Log to the console and pip_upgrade.log.
+
+    It is called by the commands, importing the package configures
+    nothing.
+    """
+    import logging.config
+    logging.config.dictConfig(LOGGING)
 
 
 class ConfigFile(configparser.ConfigParser):
@@ -60,19 +167,68 @@ class ConfigFile(configparser.ConfigParser):
             'WORKING_DIRECTORY': str,
             'LOCAL_REQUIREMENTS_FILE': str,
             'IGNORE_LINE_STARTS': str,
+            'FOLLOW_INCLUDES': bool,
             'TEST_START_COMMAND': str,
+            'TEST_STAGES': str,
+            'TEST_FAILURE_PATTERNS': str,
+            'TEST_DEADLINE_FACTOR': float,
+            'TEST_DEADLINE_PERCENTILE': int,
+            'TEST_DEADLINE_MIN': int,
+            'SKIP_SDIST_ONLY': bool,
+            'INCREMENTAL_INSTALL': bool,
+            'RUNNER': str,
+            'WORKERS': int,
+            'RESOLVE_DEPENDENCIES': bool,
+            'SEARCH_ARITY': int,
+            'STRATEGY': str,
+            'TRIAL_STORE': str,
+            'JOURNAL_FILE': str,
+            'IMPACT_TEST_COMMAND': str,
+            'IMPACT_CACHE': str,
         },
         'COMPOSE RUNNER': {
             'COMPOSE_PROJECT_FOLDER': str,
             'COMPOSE_REQUIREMENTS_FILE': str,
             'COMPOSE_SERVICE_NAME': str,
             'COMPOSE_WORK_DIR': str,
-        }
+            'COMPOSE_WHEELHOUSE_DIR': str,
+            'COMPOSE_SNAPSHOT': bool,
+            'COMPOSE_SNAPSHOT_DIR': str,
+            'COMPOSE_DOCKER_SOCKET': str,
+            'COMPOSE_WATCH_EVENTS': bool,
+            'COMPOSE_TIMEOUT': int,
+        },
+        'VENV RUNNER': {
+            'VENV_PYTHON': str,
+            'VENV_DIR': str,
+        },
+        'PYPI': {
+            'PYPI_INDEX_URL': str,
+            'PYPI_CACHE_DIR': str,
+            'PYPI_CACHE_TTL': int,
+            'PYPI_CACHE_MAX_SIZE': int,
+            'PYPI_REFRESH': bool,
+            'PYPI_OFFLINE': bool,
+            'PYPI_WORKERS': int,
+        },
+        'WHEELHOUSE': {
+            'WHEELHOUSE_DIR': str,
+            'WHEELHOUSE_MAX_SIZE': int,
+            'WHEELHOUSE_MAX_AGE': int,
+            'WHEELHOUSE_WORKERS': int,
+        },
+        'METRICS': {
+            'METRICS_REPORT': str,
+            'METRICS_TEXTFILE': str,
+            'TRACE_FILE': str,
+        },
     }
 
     def write_to_file(self):
         for section, keys in self.MAP.items():
-            self[section] = {key: getattr(Config, key) for key in keys}
+            # unset values (None) are left to the defaults
+            self[section] = {key: getattr(Config, key) for key in keys
+                             if getattr(Config, key) is not None}
 
         with open(Config.INI_FILE, 'w') as file:
             self.write(file)
@@ -81,6 +237,7 @@ class ConfigFile(configparser.ConfigParser):
         self.read(Config.INI_FILE)
         GETTERS = {str: self.get,
                    int: self.getint,
+                   float: self.getfloat,
                    bool: self.getboolean}
         for section, keys in self.MAP.items():
             for key, value_type in keys.items():
@@ -91,5 +248,5 @@ class ConfigFile(configparser.ConfigParser):
                     setattr(Config, key, value)
 
 
+# the ini file is read by the commands after the arguments are parsed
 config_file = ConfigFile(inline_comment_prefixes=('#',))
-config_file.read_from_file()
@@ -1,7 +1,11 @@
+import copy
 import re
 from enum import Enum, auto
 
 from safe_pip_upgrade.pypi import pypi_packages
+from safe_pip_upgrade.requirements_parser import (BLANK, COMMENT, REQUIREMENT,
+                                                  URL, parse_line,
+                                                  specifier_set)
 
 
 class RecognizeException(Exception):
@@ -29,29 +33,61 @@ TEMPLATES = {
 
 
 class Requirement:
-    """ Package in requirements. """
+    """ Package in requirements.
+
+    The line is rewritten with the upgraded version and the comment, its
+    extras, markers and other specifiers (e.g. "!=" and the upper bounds)
+    are kept and the candidate versions must satisfy them.
+    """
     type = None
     error_version = None
-    package = None
     version = None
     previous_version = None
+    specifier = None  # SpecifierSet of the kept specifiers
     name: str
 
+    _package = None
+    _line = None
+
     def __init__(self, line):
         self.recognize(line)
 
+    @property
+    def package(self):
+        """ Pypi package, it is requested only when it is needed.
+
+        The pinned release stays a candidate, so the search has a start.
+        """
+        if self._package is None:
+            self._package = pypi_packages.get_package(self.name)
+            if self.version:
+                self._package.keep(self.version)
+        return self._package
+
+    @classmethod
+    def package_to_fetch(cls, line):
+        # type: (str) -> Optional[str]
+        """ Get name of the package the upgrade of line needs.
+
+        Return None if the line is already marked as the latest working
+        version and the pypi metadata is not needed.
+        """
+        parsed = parse_line(line)
+        if parsed.kind != REQUIREMENT:
+            return None
+        final_template = TEMPLATES[RequirementType.FINAL_LATEST_VERSION]
+        if parsed.version and re.search(final_template, parsed.comment):
+            return None
+        return parsed.name
+
     def recognize(self, line):
         # type: (str) -> None
         """ Parse requirement line. """
-        package, comment = self.split_line(line)
-
-        if not package:
-            raise RecognizeException('can\'t find package name')
-
-        self.recognize_package_and_version(package)
+        parsed = parse_line(line)
+        self._recognize_requirement(parsed)
 
         # recognise comment
-        self.recognize_comment(comment)
+        self.recognize_comment(parsed.comment)
 
     def increase_version(self):
         # type: (...) -> bool
@@ -72,24 +108,70 @@ class Requirement:
                 return False
         else:
             version_to_test = self.package.last_version
-            if version_to_test == self.version:
-                # The latest version is already installed
+            if version_to_test in (None, self.version):
+                # The latest version is already installed or no version
+                # can be installed
                 return False
 
         self.previous_version = self.version
         self.version = version_to_test
         return True
 
+    def candidate_versions(self, count):
+        # type: (int) -> list
+        """ Get up to count versions to test at once.
+
+        It is the k-ary version of increase_version, the versions are spread
+        between the current and the error (or the latest) version.
+        """
+        if self.type == RequirementType.FINAL_LATEST_VERSION:
+            return []
+
+        if self.type == RequirementType.NOT_LATEST_VERSION:
+            versions = self.package.get_spread_versions(
+                self.version, self.error_version, count)
+            if not versions:
+                self.type = RequirementType.FINAL_LATEST_VERSION
+            return versions
+
+        return self.package.get_spread_versions(self.version, count=count)
+
+    def apply_results(self, results):
+        # type: (list) -> None
+        """ Narrow the search with [(version, passed), ...] in order.
+
+        The lowest failed version becomes the error version, the highest
+        passed version below it becomes the current version.
+        """
+        for version, passed in results:
+            if not passed:
+                self.type = RequirementType.NOT_LATEST_VERSION
+                self.error_version = version
+                break
+            self.version = version
+
+    def get_line_with_version(self, version):
+        # type: (str) -> str
+        """ get requirements file line with other version. """
+        req = copy.copy(self)
+        req.version = version
+        return req.get_line()
+
     def get_line(self):
         # type: () -> str
         """ get requirements file line."""
-        line = "{}=={}".format(self.name, self.version)
+        comment = ''
         if self.type != RequirementType.LATEST_VERSION:
-            line += ' # ' + TEMPLATES[self.type]
+            comment = TEMPLATES[self.type]
             if self.type == RequirementType.NOT_LATEST_VERSION:
-                line = line.replace(r'(\S*)', self.error_version)
+                comment = comment.replace(r'(\S*)', self.error_version)
 
-        return line + '\n'
+        return self._line.with_version(self.version, comment)
+
+    def allows(self, version):
+        # type: (str) -> bool
+        """ Check the version against the kept specifiers of the line. """
+        return self.specifier.contains(version, prereleases=True)
 
     def fix_error_version(self):
         self.type = RequirementType.NOT_LATEST_VERSION
@@ -113,20 +195,43 @@ class Requirement:
             raise RecognizeException('can\'t recognize comment')
 
     def recognize_package_and_version(self, package):
-        match = re.split(r'[>=<~\s,]+', package)
-        self.name = match[0]
-        self.package = pypi_packages.get_package(self.name)
-        if len(match) > 1:
-            self.version = match[1]
-        else:
-            self.version = self.package.last_version
+        self._recognize_requirement(parse_line(package))
 
-    def split_line(self, line):
+    def _recognize_requirement(self, parsed):
+        if parsed.kind in (BLANK, COMMENT):
+            raise RecognizeException('can\'t find package name')
+        if parsed.kind == URL:
+            raise RecognizeException('can\'t upgrade url requirement')
+        if parsed.kind != REQUIREMENT:
+            raise RecognizeException('can\'t parse requirement')
+        if parsed.continued or parsed.options:
+            # e.g. the hashes of the pinned version
+            raise RecognizeException('can\'t upgrade requirement with '
+                                     'options')
+        if parsed.version and '*' in parsed.version:
+            raise RecognizeException('can\'t upgrade wildcard version')
+        self._line = parsed
+        self.name, self.version = parsed.name, parsed.version
+        self.specifier = specifier_set(parsed.other_specifiers)
+        self._package = None
+        if self.version is None:
+            # the latest version the upper bounds allow
+            versions = self.package.candidates.versions
+            self.version = next((version for version in reversed(versions)
+                                 if self.allows(version)), None)
+            if self.version is None:
+                raise RecognizeException('there is no version to install')
+
+    @staticmethod
+    def split_package(package):
         # type: (str) -> tuple
-        """ Split line on text and comment """
+        """ Split package on name and version (None if not specified). """
+        parsed = parse_line(package)
+        return parsed.name, parsed.version
 
-        parts = [s.strip() for s in line.split('#', 1)]
-        package = parts[0]
-        comment = parts[1] if len(parts) >= 2 else ''
-
-        return package, comment
+    @staticmethod
+    def split_line(line):
+        # type: (str) -> tuple
+        """ Split line on text and comment """
+        parsed = parse_line(line)
+        return parsed.requirement, parsed.comment
@@ -1,8 +1,25 @@
 import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import zip_longest
 from logging import INFO
 
 from safe_pip_upgrade.config import Config
-from safe_pip_upgrade.core.packages import Requirement, RecognizeException
+from safe_pip_upgrade.core.packages import (Requirement, RecognizeException,
+                                            RequirementType)
+from safe_pip_upgrade.impact import ImpactSelector
+from safe_pip_upgrade.journal import Journal
+from safe_pip_upgrade.metrics import metrics
+from safe_pip_upgrade.pypi import pypi_packages
+from safe_pip_upgrade.requirements_parser import RequirementsIncludes
+from safe_pip_upgrade.resolver import DependencyResolver, pinned_versions
+from safe_pip_upgrade.runners.incremental import requirement_pins
+from safe_pip_upgrade.runners.pool import install_and_test
+from safe_pip_upgrade.tracing import tracer
+from safe_pip_upgrade.trial_store import TrialStore
+from safe_pip_upgrade.wheelhouse import WheelPrefetcher, Wheelhouse
 
 logger = logging.getLogger(__name__)
 
@@ -18,33 +35,392 @@ class RunnerException(SafeUpgradeException):
 class Upgrade:
     """ The main class that performs the upgrade. """
 
-    def __init__(self, client, req_file):
+    def __init__(self, client, req_file, pool=None):
         self.client = client
         self.req_file = req_file
+        self.pool = pool
+        self.trial_store = TrialStore.from_config()
+        if pool:
+            pool.trial_store = self.trial_store
+        self.journal = None
+        self.impact = None
+        self.resolver = None
+        self.includes = RequirementsIncludes.from_config()
         self.req_lines = self.req_file.read_lines()
+        if self.includes:
+            self.req_lines = self.includes.expand(self.req_file.full_name,
+                                                  self.req_lines)
+        self.original_pins = self.passed_pins = {}
+        self.skipped_trials = 0
+        self.interrupted = False
+        self._lock = threading.Lock()
 
     def start_upgrade(self):
         """ Upgrade all requirements. """
-        self.req_file.make_backup()
-        for i, r_line in enumerate(self.req_lines):
-            r_line = r_line.strip()
-            if (not r_line or
-                    list(
-                        filter(r_line.startswith, Config.IGNORE_LINE_STARTS))):
-                continue
+        metrics.reset()
+        self.journal = Journal.from_config()
+        if self.journal and Config.RESUME and self.journal.load():
+            # the requirements file has the lines of the interrupted trial
+            self.req_lines = list(self.journal.lines)
+            self.journal.resume()
+        else:
+            self.req_file.make_backup()
+            if self.journal:
+                self.journal.start(self.req_lines)
+        with metrics.phase('environment'):
+            environment = self.client.get_environment()
+        pypi_packages.set_environment(environment)
+        original_lines = list(self.req_lines)
+        self.original_pins = requirement_pins(original_lines)
+        self.passed_pins = self.original_pins
+        self.impact = ImpactSelector.from_config(self.client)
+        if self.trial_store:
+            self.trial_store.invalidate(self.client.image_id())
+        with metrics.phase('prefetch'):
+            self.prefetch_packages()
+        self.resolver = DependencyResolver.from_config(pypi_packages,
+                                                       environment)
+        with metrics.phase('resolve'):
+            self.prefetch_dependencies()
+        prefetcher = self.prefetch_wheels()
+        try:
+            with metrics.phase('baseline'):
+                self.install_baselines(original_lines)
+            if Config.STRATEGY == 'group':
+                self.upgrade_in_groups()
+                self.verify_impacted(original_lines)
+            elif self.pool:
+                self.upgrade_in_parallel(self.requirement_indexes())
+            else:
+                self.upgrade_one_by_one(self.requirement_indexes())
+                self.verify_impacted(original_lines)
+        finally:
+            if prefetcher:
+                prefetcher.stop()
+
+        if self.includes:
+            self.includes.write_back(self.req_file, self.req_lines)
+        else:
+            self.req_file.write_lines(self.req_lines)
+        if self.skipped_trials:
+            logger.info(f'{self.skipped_trials} candidate versions were '
+                        f'skipped without tests')
+        if self.resolver and self.resolver.rejections:
+            reasons = ', '.join(f'{count} {status}' for status, count
+                                in self.resolver.rejections.items())
+            logger.info(f'resolver: candidates rejected without trials: '
+                        f'{reasons}')
+        if self.trial_store and self.trial_store.hits:
+            logger.info(f'{self.trial_store.hits} trial results were '
+                        f'reused from the trial store')
+            metrics.count('trial_store_hits', self.trial_store.hits)
+        self.client.log_stats()
+        if self.journal:
+            self.journal.finish(self.interrupted)
+        self.write_metrics(original_lines)
+        logger.info('All done!')
 
+    def write_metrics(self, original_lines):
+        """ Write the report of the run with the versions of the packages.
+        """
+        original = pinned_versions(original_lines)
+        final = pinned_versions(self.req_lines)
+        for name, version in original.items():
+            metrics.versions(name, version, final.get(name))
+        metrics.count('skipped_trials', self.skipped_trials)
+        metrics.log_summary()
+        try:
+            metrics.write(self.interrupted)
+        except OSError as e:
+            logger.warning(f'metrics: can not write the report: {e}')
+
+    def install_baselines(self, lines):
+        """ Install the original lines on the runners, the trials install
+        their changes over them. """
+        runners = ([(worker.runner, worker.req_file)
+                    for worker in self.pool.workers]
+                   if self.pool else [(self.client, self.req_file)])
+        with ThreadPoolExecutor(len(runners)) as executor:
+            installed = list(executor.map(
+                lambda runner: runner[0].install_baseline(lines, runner[1]),
+                runners))
+        if not all(installed):
+            logger.warning('the original requirements are not installed, '
+                           'the trials install all of them')
+
+    def requirement_indexes(self):
+        """ Get indexes of the lines to upgrade. """
+        return [i for i, r_line in enumerate(self.req_lines)
+                if not self.is_ignored(r_line.strip())]
+
+    def upgrade_one_by_one(self, indexes):
+        """ Upgrade requirements in order with the main runner. """
+        for i in indexes:
+            r_line = self.req_lines[i].strip()
+            if self.journal and i in self.journal.done:
+                self.req_lines[i] = self.journal.done[i]
+                continue
             try:
                 self.try_upgrade_requirement(i)
+                if self.journal:
+                    self.journal.package_done(i, self.req_lines[i])
             except RunnerException:
                 self.req_lines[i] = r_line
+                self.interrupted = True
                 break
 
             except RecognizeException as ex:
                 logger.log(INFO, ex)
                 continue
 
-        self.req_file.write_lines(self.req_lines)
-        logger.info('All done!')
+    def upgrade_in_parallel(self, indexes):
+        """ Upgrade requirements independently on the pool workers.
+
+        Every package is tested with the original versions of the other
+        packages, then the accepted upgrades are verified together.
+        """
+        base_lines = list(self.req_lines)
+        with ThreadPoolExecutor(len(self.pool)) as executor:
+            futures = {executor.submit(self.upgrade_independently, i,
+                                       base_lines): i
+                       for i in indexes}
+            try:
+                for future in as_completed(futures):
+                    try:
+                        self.req_lines[futures[future]] = future.result()
+                    except RecognizeException as ex:
+                        logger.log(INFO, ex)
+            except RunnerException:
+                # the upgrades were not verified together, so keep nothing
+                logger.error('runner failed, requirements are not changed')
+                self.interrupted = True
+                for future in futures:
+                    future.cancel()
+                self.req_lines[:] = base_lines
+                return
+            finally:
+                self.pool.log_utilization()
+                self.pool.close()
+
+        self.verify_together(base_lines)
+
+    def upgrade_in_groups(self):
+        """ Upgrade all requirements at once and test them together.
+
+        If the tests fail, the group is split to find the breaking upgrades
+        (the number of test runs is about k * log(n) for k breaking
+        packages of n), then the versions of the breaking packages and of
+        the packages upgraded to not the latest version are searched one
+        by one.
+        """
+        reqs = {}
+        for i in self.requirement_indexes():
+            try:
+                req = Requirement(self.req_lines[i])
+            except RecognizeException as ex:
+                logger.log(INFO, ex)
+                continue
+            self.log_skipped(req)
+            if req.increase_version():
+                reqs[i] = req
+            else:
+                self.req_lines[i] = req.get_line()
+        if not reqs:
+            return
+
+        try:
+            failed = self.test_group(list(reqs), reqs)
+        except RunnerException:
+            # the upgrades accepted before the failure are kept
+            logger.error('runner failed, the group upgrade is stopped')
+            self.interrupted = True
+            return
+        for i in failed:
+            reqs[i].fix_error_version()
+            self.req_lines[i] = reqs[i].get_line()
+
+        # there may be newer working versions
+        pending = [i for i, req in reqs.items()
+                   if req.type == RequirementType.NOT_LATEST_VERSION]
+        if self.pool:
+            self.upgrade_in_parallel(pending)
+        else:
+            self.upgrade_one_by_one(pending)
+
+    def test_group(self, group, reqs, failed=False):
+        """ Test upgrades of the group on top of the accepted upgrades.
+
+        The passed upgrades are accepted, return indexes of the failed
+        ones. failed means the group is already known to fail.
+        """
+        if not failed:
+            lines = list(self.req_lines)
+            for i in group:
+                lines[i] = reqs[i].get_line()
+            logger.info(f'try upgrade {len(group)} requirements together')
+            if self.run_trial(lines):
+                logger.info(f'{len(group)} requirements were upgraded')
+                self.req_lines[:] = lines
+                return []
+
+        if len(group) == 1:
+            logger.info(f'upgrade failed: {reqs[group[0]].get_line()}')
+            return group
+
+        middle = len(group) // 2
+        first_failed = self.test_group(group[:middle], reqs)
+        # if the first half passed, the rest fails on top of it for sure
+        return first_failed + self.test_group(group[middle:], reqs,
+                                              failed=not first_failed)
+
+    def upgrade_independently(self, i, base_lines):
+        """ Upgrade the requirement with the pool, return its line. """
+        if self.journal and i in self.journal.done:
+            return self.journal.done[i]
+        lines = list(base_lines)
+        req = Requirement(lines[i])
+        self.log_skipped(req)
+        if int(Config.SEARCH_ARITY) > 1:
+            self.search_version_concurrently(req, i, lines)
+        else:
+            self.search_version(req, i, lines, self.run_pool_trial)
+        if self.journal:
+            self.journal.package_done(i, lines[i])
+        return lines[i]
+
+    def verify_impacted(self, base_lines):
+        """ Run the full suite for the upgrades accepted by the impacted
+        tests only. """
+        if self.impact and not self.interrupted:
+            with metrics.phase('verify'):
+                self.verify_together(base_lines)
+
+    def verify_together(self, base_lines):
+        """ Check that independently accepted upgrades pass together.
+
+        If they don't, the upgrades are added one by one and the upgrades
+        that fail are marked as error versions.
+        """
+        upgraded = [i for i, line in enumerate(self.req_lines)
+                    if self._version_changed(base_lines[i], line)]
+        if not upgraded:
+            return
+
+        logger.info(f'verify {len(upgraded)} upgrades together')
+        if self.run_trial(self.req_lines, full=True):
+            return
+
+        logger.info('upgrades fail together, add them one by one')
+        lines = list(self.req_lines)
+        for i in upgraded:
+            lines[i] = base_lines[i]
+        for i in upgraded:
+            lines[i] = self.req_lines[i]
+            if not self.run_trial(lines, full=True):
+                logger.info(f'upgrade failed together: {lines[i].strip()}')
+                req = Requirement(self.req_lines[i])
+                req.previous_version = Requirement(base_lines[i]).version
+                req.fix_error_version()
+                lines[i] = req.get_line()
+        self.req_lines[:] = lines
+
+    @staticmethod
+    def _version_changed(old_line, new_line):
+        old_package, _ = Requirement.split_line(old_line)
+        new_package, _ = Requirement.split_line(new_line)
+        if not old_package or old_package == new_package:
+            return False
+        return (Requirement.split_package(old_package)[1] !=
+                Requirement.split_package(new_package)[1])
+
+    def prefetch_packages(self):
+        """ Get pypi metadata of all packages to upgrade concurrently. """
+        names = []
+        for r_line in self.req_lines:
+            r_line = r_line.strip()
+            if self.is_ignored(r_line):
+                continue
+            name = Requirement.package_to_fetch(r_line)
+            if name:
+                names.append(name)
+        pypi_packages.prefetch(names, int(Config.PYPI_WORKERS))
+
+    def prefetch_dependencies(self):
+        """ Check the latest versions against the pins in one batch.
+
+        Requirements of the pins are fetched once for the whole run.
+        """
+        if not self.resolver:
+            return
+        pins = pinned_versions(self.req_lines)
+        latest = {}
+        for i in self.requirement_indexes():
+            try:
+                req = Requirement(self.req_lines[i].strip())
+            except RecognizeException:
+                continue
+            if (req.type == RequirementType.LATEST_VERSION and
+                    req.package.last_version):
+                latest[req.name] = req.package.last_version
+        self.resolver.prefetch(list(pins.items()) + list(latest.items()))
+        rejected = [name for name, version in latest.items()
+                    if self.resolver.prune(name, [version], pins)]
+        if rejected:
+            logger.info(f'resolver: the latest versions of {len(rejected)} '
+                        f'of {len(latest)} packages conflict with the pins: '
+                        f'{", ".join(rejected)}')
+
+    def prefetch_wheels(self):
+        """ Download candidate versions to the wheelhouse in background.
+        """
+        wheelhouse = Wheelhouse.from_config()
+        if not wheelhouse:
+            return None
+        wheelhouse.collect_garbage()
+        prefetcher = WheelPrefetcher(wheelhouse, self.client.download_wheel,
+                                     int(Config.WHEELHOUSE_WORKERS))
+        prefetcher.start(self.wheel_pins())
+        return prefetcher
+
+    def wheel_pins(self):
+        """ Get pins of the candidate versions in the search order.
+
+        The first versions the search tries of all the packages go first,
+        then the second ones and so on.
+        """
+        orders = []
+        for i in self.requirement_indexes():
+            try:
+                req = Requirement(self.req_lines[i].strip())
+            except RecognizeException:
+                continue
+            if req.type == RequirementType.FINAL_LATEST_VERSION:
+                continue
+            lt = None
+            if req.type == RequirementType.NOT_LATEST_VERSION:
+                lt = req.error_version
+            orders.append([f'{req.name}=={version}' for version in
+                           req.package.search_order(req.version, lt)])
+        return [pin for pins in zip_longest(*orders) for pin in pins if pin]
+
+    def log_skipped(self, req):
+        """ Log candidate versions that won't be tested. """
+        if req.type == RequirementType.FINAL_LATEST_VERSION:
+            return
+        skipped = req.package.skipped_after(req.version)
+        if skipped:
+            with self._lock:
+                self.skipped_trials += sum(skipped.values())
+            reasons = ', '.join(f'{count} {reason}'
+                                for reason, count in skipped.items())
+            logger.info(f'{req.name}: skip versions that can not be '
+                        f'installed: {reasons}')
+
+    @staticmethod
+    def is_ignored(r_line):
+        """ Check if the stripped line is not a requirement to upgrade. """
+        return (not r_line or
+                list(filter(r_line.startswith, Config.IGNORE_LINE_STARTS)))
 
     def try_upgrade_requirement(self, i):
         """ Upgrade requirements.
@@ -54,15 +430,187 @@ class Upgrade:
         and latest.
         """
         req = Requirement(self.req_lines[i])
+        self.log_skipped(req)
+        self.search_version(req, i, self.req_lines, self.run_trial)
+
+    def search_version(self, req, i, lines, run_trial):
+        """ Increase version of the requirement in lines[i] while it works.
+
+        run_trial tests requirements lines and returns True if they pass.
+        """
         while req.increase_version():
-            self.req_lines[i] = req.get_line()
-            self.req_file.write_lines(self.req_lines)
+            lines[i] = req.get_line()
 
-            logger.info(f'try upgrade requirements: {req.get_line().strip()}')
-            if self.client.run_tests():
+            if self.check_dependencies(req, req.version, lines):
+                logger.info(
+                    f'try upgrade requirements: {req.get_line().strip()}')
+                passed = self.timed_trial(req.name, req.version,
+                                          run_trial, lines)
+            else:
+                passed = False
+            if self.journal:
+                self.journal.decision(req, req.version, passed)
+            metrics.decision(req.name, req.version, passed)
+            if passed:
                 logger.info(f'requirements was upgraded: {req.get_line()}')
-                self.req_file.copy_file('', '_last_pass')
             else:
                 logger.info(f'upgrade failed: {req.get_line()}')
                 req.fix_error_version()
-        self.req_lines[i] = req.get_line()
+        lines[i] = req.get_line()
+
+    def search_version_concurrently(self, req, i, lines):
+        """ Search version of the requirement testing k versions at once.
+
+        The interval between the working and the error version is narrowed
+        about k + 1 times every round instead of 2 times.
+        """
+        while True:
+            versions = req.candidate_versions(int(Config.SEARCH_ARITY))
+            if not versions:
+                break
+
+            trials = {}
+            for version in versions:
+                trial_lines = list(lines)
+                trial_lines[i] = req.get_line_with_version(version)
+                if self.check_dependencies(req, version, trial_lines):
+                    trials[version] = trial_lines
+            results = [False] * len(versions)
+            if trials:
+                logger.info(f'try upgrade {req.name} to versions: '
+                            f'{", ".join(trials)}')
+                with ThreadPoolExecutor(len(trials)) as executor:
+                    passed = dict(zip(trials, executor.map(
+                        lambda version: self.timed_trial(
+                            req.name, version, self.run_pool_trial,
+                            trials[version]), trials)))
+                results = [passed.get(version, False) for version in versions]
+
+            for version, passed in zip(versions, results):
+                if self.journal:
+                    self.journal.decision(req, version, passed)
+                metrics.decision(req.name, version, passed)
+            req.apply_results(list(zip(versions, results)))
+            lines[i] = req.get_line()
+            logger.info(f'{req.name}: upgrade results: {lines[i].strip()}')
+        lines[i] = req.get_line()
+
+    @staticmethod
+    def timed_trial(name, version, run_trial, lines):
+        """ Run the trial of the package version counting its time. """
+        started = time.monotonic()
+        with tracer.span('candidate', package=name, version=version) as span:
+            passed = run_trial(lines)
+            span.set(passed=passed)
+        metrics.trial(name, time.monotonic() - started, passed)
+        return passed
+
+    def check_dependencies(self, req, version, lines):
+        """ Check the candidate against the specifiers of the requirement,
+        the constraints and the other pins of the lines without a trial,
+        False if it can't be installed with them. """
+        name = req.name
+        if not req.allows(version) or (
+                self.includes and not self.includes.allows(name, version)):
+            with self._lock:
+                self.skipped_trials += 1
+            metrics.count('constraint_skips')
+            logger.info(f'{name}=={version}: excluded by the specifiers')
+            return False
+        if not self.resolver:
+            return True
+        verdict = self.resolver.check(name, version, pinned_versions(lines))
+        if not verdict:
+            return True
+        with self._lock:
+            self.skipped_trials += 1
+        metrics.count('resolver_' + re.sub(r'\W+', '_', verdict.status))
+        conflicts = '; '.join(map(str, verdict.conflicts))
+        logger.info(f'{name}=={version}: {verdict.status}, {conflicts}')
+        return False
+
+    def run_trial(self, lines, full=False):
+        """ Test requirements lines with the main runner.
+
+        Only the tests impacted by the changes since the last passed trial
+        are run unless full is set.
+        """
+        command = None if full else self.trial_command(lines, self.passed_pins)
+        passed = self.known_result(lines, command)
+        if passed is None:
+            passed = self._run_trial(lines, command)
+        elif passed:
+            # the replayed result updates the passed state like the live one
+            self.req_file.write_lines(lines)
+        if passed:
+            self.req_file.copy_file('', '_last_pass')
+            if not full:
+                self.passed_pins = requirement_pins(lines)
+        return passed
+
+    def _run_trial(self, lines, command):
+        """ Run the trial with the main runner and journal its result. """
+        trial = (self.journal.trial_started(lines, command)
+                 if self.journal else None)
+        on_install = self.install_recorder(trial, lines)
+        self.req_file.write_lines(lines)
+        with metrics.phase('trial', impacted=command is not None) as span:
+            if self.trial_store:
+                passed = self.trial_store.run_trial(self.client, lines,
+                                                    command, on_install)
+            else:
+                passed = install_and_test(self.client, lines, command,
+                                          on_install)
+            span.set(passed=passed)
+        if self.journal:
+            self.journal.trial_result(trial, lines, passed, command)
+        return passed
+
+    def run_pool_trial(self, lines):
+        """ Test requirements lines on a free worker of the pool.
+
+        Only the tests impacted by the changes of the original lines are
+        run.
+        """
+        command = self.trial_command(lines, self.original_pins)
+        known = self.known_result(lines, command)
+        if known is not None:
+            return known
+
+        trial = (self.journal.trial_started(lines, command)
+                 if self.journal else None)
+        with metrics.phase('trial', impacted=command is not None) as span:
+            passed = self.pool.run_trial(lines, command,
+                                         self.install_recorder(trial, lines))
+            span.set(passed=passed)
+        if self.journal:
+            self.journal.trial_result(trial, lines, passed, command)
+        return passed
+
+    def install_recorder(self, trial, lines):
+        """ Get on_install() of the runners that journals the install
+        result of the trial, or None if the journal is off. """
+        if not self.journal:
+            return None
+        return lambda installed: self.journal.install_result(
+            trial, lines, bool(installed))
+
+    def trial_command(self, lines, base_pins):
+        """ Get test command of the impacted tests, None is the full suite.
+        """
+        if not self.impact:
+            return None
+        changed = [name for name, pin in requirement_pins(lines).items()
+                   if base_pins.get(name) != pin]
+        return self.impact.command(changed)
+
+    def known_result(self, lines, command=None):
+        """ Get result of the trial finished before the resume or None. """
+        if not self.journal:
+            return None
+        passed = self.journal.known_result(lines, command)
+        if passed is not None:
+            metrics.count('journal_results')
+            logger.info('journal: the trial is done before, '
+                        f'{"passed" if passed else "failed"}')
+        return passed
@@ -0,0 +1,122 @@
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    from packaging.specifiers import InvalidSpecifier, SpecifierSet
+except ImportError:
+    # noinspection PyProtectedMember,PyCompatibility
+    from pip._vendor.packaging.specifiers import InvalidSpecifier, SpecifierSet
+
+# prints the environment of the interpreter it is run with
+ENVIRONMENT_SCRIPT = (
+    'import json, os, platform, sys, sysconfig; '
+    'print(json.dumps({'
+    '"python_version": platform.python_version(), '
+    '"implementation": sys.implementation.name, '
+    '"platform": sysconfig.get_platform(), '
+    '"libc": platform.libc_ver()[0], '
+    '"markers": {'
+    '"os_name": os.name, '
+    '"sys_platform": sys.platform, '
+    '"platform_machine": platform.machine(), '
+    '"platform_release": platform.release(), '
+    '"platform_system": platform.system(), '
+    '"platform_version": platform.version(), '
+    '"platform_python_implementation": platform.python_implementation(), '
+    '"python_full_version": platform.python_version(), '
+    '"python_version": ".".join(platform.python_version_tuple()[:2]), '
+    '"implementation_name": sys.implementation.name}}))'
+)
+
+IMPLEMENTATION_TAGS = {'cpython': 'cp', 'pypy': 'pp'}
+
+
+class TargetEnvironment:
+    """ Interpreter and platform the tests are run with. """
+
+    def __init__(self, python_version, implementation='cpython',
+                 platform='any', libc='', markers=None):
+        self.python_version = python_version
+        self.implementation = implementation
+        self.platform = platform
+        self.libc = libc
+        self.markers = markers
+
+    @classmethod
+    def from_json(cls, text):
+        # type: (str) -> TargetEnvironment
+        """ Create from the output of ENVIRONMENT_SCRIPT. """
+        return cls(**json.loads(text))
+
+    def __str__(self):
+        return (f'{self.implementation} {self.python_version} '
+                f'({self.platform_family})')
+
+    @property
+    def python_tags(self):
+        """ Python tags of the wheels the interpreter supports. """
+        major, minor = self.python_version.split('.')[:2]
+        tags = {f'py{major}', f'py{major}{minor}'}
+        implementation = IMPLEMENTATION_TAGS.get(self.implementation)
+        if implementation:
+            tags.add(f'{implementation}{major}{minor}')
+        return tags
+
+    @property
+    def marker_environment(self):
+        """ Values of the environment markers (PEP 508).
+
+        If the markers are not reported, only the python ones are known.
+        """
+        if self.markers:
+            return dict(self.markers)
+        return {
+            'python_version': '.'.join(self.python_version.split('.')[:2]),
+            'python_full_version': self.python_version,
+            'implementation_name': self.implementation,
+        }
+
+    @property
+    def platform_family(self):
+        """ Family of the wheel platform tags, see wheel_tags. """
+        if self.platform.startswith('linux'):
+            # alpine based images use musl instead of glibc
+            return 'manylinux' if self.libc == 'glibc' else 'musllinux'
+        for prefix, family in (('macosx', 'macosx'), ('win', 'win')):
+            if self.platform.startswith(prefix):
+                return family
+        return self.platform
+
+    def is_python_supported(self, requires_python):
+        # type: (str) -> bool
+        """ Check requires-python of the release. """
+        if not requires_python:
+            return True
+        try:
+            specifier = SpecifierSet(requires_python)
+        except InvalidSpecifier:
+            return True
+        return specifier.contains(self.python_version, prereleases=True)
+
+    def is_wheel_supported(self, tag):
+        # type: (str) -> bool
+        """ Check compact wheel tag "python-abi-platform". """
+        python, abi, family = tag.split('-')
+        if family not in ('any', self.platform_family):
+            return False
+
+        python_tags = self.python_tags
+        implementation = IMPLEMENTATION_TAGS.get(self.implementation, '')
+        major, minor = map(int, self.python_version.split('.')[:2])
+        for python_tag in python.split('.'):
+            if python_tag in python_tags:
+                return True
+            # abi3 wheels work with all the next python versions
+            digits = python_tag[len(implementation):]
+            if (abi == 'abi3' and implementation and digits.isdigit() and
+                    python_tag.startswith(implementation) and
+                    (int(digits[0]), int(digits[1:] or 0)) <= (major, minor)):
+                return True
+        return False
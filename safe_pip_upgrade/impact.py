@@ -0,0 +1,262 @@
+"""
+Test impact selection.
+
+The project sources are parsed to a static import graph, test modules are
+mapped to the top-level modules of the third-party distributions they
+import transitively. A trial runs only the test modules that import the
+upgraded distributions, the full suite is run for the final accepted set
+(imports the parser can't see, e.g. django INSTALLED_APPS, are covered by
+it).
+
+Imports of every file are cached with its size and mtime, so only the
+changed files are parsed again.
+"""
+import ast
+import json
+import logging
+import os
+
+from safe_pip_upgrade.config import Config
+
+logger = logging.getLogger(__name__)
+
+try:
+    from packaging.utils import canonicalize_name
+except ImportError:
+    # noinspection PyProtectedMember,PyCompatibility
+    from pip._vendor.packaging.utils import canonicalize_name
+
+# prints {top-level module: [distribution, ...]} of the interpreter it is
+# run with
+TOP_LEVEL_SCRIPT = '''
+import json
+try:
+    from importlib import metadata
+except ImportError:
+    import importlib_metadata as metadata
+result = {}
+for dist in metadata.distributions():
+    tops = set((dist.read_text('top_level.txt') or '').split())
+    if not tops:
+        for file in dist.files or ():
+            top = file.parts[0]
+            if len(file.parts) == 1:
+                if top.endswith('.py'):
+                    tops.add(top[:-3])
+            elif not top.endswith(('.dist-info', '.egg-info', '.data')) \\
+                    and top not in ('..', '__pycache__'):
+                tops.add(top)
+    for top in tops:
+        result.setdefault(top, []).append(dist.metadata['Name'])
+print(json.dumps(result))
+'''
+
+CACHE_VERSION = 1
+
+
+def module_name(path):
+    # type: (str) -> str
+    """ Get dotted name of the module by its path relative to the project.
+    """
+    parts = path[:-len('.py')].replace(os.sep, '/').split('/')
+    if parts[-1] == '__init__':
+        parts.pop()
+    return '.'.join(parts)
+
+
+def parse_imports(source, name, is_package):
+    # type: (bytes, str, bool) -> list
+    """ Get absolute names of the modules imported by the source. """
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return []
+
+    imports = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            imports.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            if node.level:
+                # relative import from the package of the module
+                package = name.split('.')
+                if not is_package:
+                    package = package[:-1]
+                package = package[:len(package) - node.level + 1]
+                base = '.'.join(package + ([node.module] if node.module
+                                           else []))
+            else:
+                base = node.module
+            if not base:
+                continue
+            imports.add(base)
+            # "from package import module" imports the module
+            imports.update(f'{base}.{alias.name}' for alias in node.names
+                           if alias.name != '*')
+    return sorted(imports)
+
+
+def is_test_module(path):
+    # type: (str) -> bool
+    file_name = os.path.basename(path)
+    return file_name.startswith('test') and file_name.endswith('.py')
+
+
+class ImportGraph:
+    """ Static import graph of the project python files. """
+
+    def __init__(self, directory, cache_path=None):
+        self.directory = directory
+        self.cache_path = cache_path
+        self.files = {}  # path: [mtime_ns, size, imports]
+
+    def update(self):
+        """ Parse the new and the changed files, forget the removed ones.
+        """
+        cached = self._load_cache()
+        files = {}
+        parsed = 0
+        for root, dirs, file_names in os.walk(self.directory):
+            dirs[:] = sorted(d for d in dirs
+                             if not d.startswith('.') and d != '__pycache__')
+            for file_name in sorted(file_names):
+                if not file_name.endswith('.py'):
+                    continue
+                full_path = os.path.join(root, file_name)
+                path = os.path.relpath(full_path, self.directory)
+                stat = os.stat(full_path)
+                entry = cached.get(path)
+                if entry and entry[:2] == [stat.st_mtime_ns, stat.st_size]:
+                    files[path] = entry
+                    continue
+                with open(full_path, 'rb') as f:
+                    imports = parse_imports(f.read(), module_name(path),
+                                            file_name == '__init__.py')
+                files[path] = [stat.st_mtime_ns, stat.st_size, imports]
+                parsed += 1
+        self.files = files
+        logger.info(f'impact: {parsed} of {len(files)} project files parsed')
+        self._save_cache()
+
+    def _load_cache(self):
+        if not self.cache_path:
+            return {}
+        try:
+            with open(self.cache_path, encoding='utf-8') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if cache.get('version') != CACHE_VERSION:
+            return {}
+        return cache['files']
+
+    def _save_cache(self):
+        if not self.cache_path:
+            return
+        tmp_path = f'{self.cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': CACHE_VERSION, 'files': self.files}, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def external_imports(self):
+        """ Get {test module path: top-level names of the not project
+        modules it imports transitively}. """
+        modules = {module_name(path): path for path in self.files}
+        project_tops = {name.split('.')[0] for name in modules}
+
+        direct = {}
+        for path, (_, _, imports) in self.files.items():
+            internal, external = set(), set()
+            for name in imports:
+                parts = name.split('.')
+                if parts[0] not in project_tops:
+                    external.add(parts[0])
+                    continue
+                # importing a module imports its parent packages
+                for i in range(1, len(parts) + 1):
+                    module = modules.get('.'.join(parts[:i]))
+                    if module:
+                        internal.add(module)
+            direct[path] = (internal, external)
+
+        result = {}
+        for path in self.files:
+            if not is_test_module(path):
+                continue
+            seen, stack, external = {path}, [path], set()
+            while stack:
+                internal, tops = direct[stack.pop()]
+                external |= tops
+                for module in internal - seen:
+                    seen.add(module)
+                    stack.append(module)
+            result[path] = external
+        return result
+
+
+class ImpactSelector:
+    """ Choose the tests that import the upgraded distributions.
+
+    command_template is the test command with "{tests}" (dotted module
+    names) or "{test_files}" (paths) placeholders.
+    """
+
+    def __init__(self, graph, top_level_map, command_template):
+        self.graph = graph
+        self.command_template = command_template
+        self.distribution_tops = {}
+        for top, distributions in top_level_map.items():
+            for distribution in distributions:
+                self.distribution_tops.setdefault(
+                    canonicalize_name(distribution), set()).add(top)
+        self.tests = graph.external_imports()
+
+    @classmethod
+    def from_config(cls, runner):
+        """ Get selector configured in Config or None if it is off. """
+        if not Config.IMPACT_TEST_COMMAND:
+            return None
+        top_level_map = runner.top_level_map()
+        if not top_level_map:
+            logger.warning('impact: distributions of the test environment '
+                           'are unknown, the full suite is run.')
+            return None
+        cache_path = None
+        if Config.IMPACT_CACHE:
+            cache_path = os.path.join(Config.WORKING_DIRECTORY,
+                                      Config.IMPACT_CACHE)
+        graph = ImportGraph(Config.WORKING_DIRECTORY, cache_path)
+        graph.update()
+        return cls(graph, top_level_map, Config.IMPACT_TEST_COMMAND)
+
+    def select(self, distributions):
+        """ Get paths of the test modules that import the distributions.
+
+        None means the impact is unknown and the full suite is needed.
+        """
+        tops = set()
+        for distribution in distributions:
+            distribution_tops = self.distribution_tops.get(
+                canonicalize_name(distribution))
+            if distribution_tops is None:
+                return None
+            tops |= distribution_tops
+        return sorted(path for path, imports in self.tests.items()
+                      if imports & tops)
+
+    def command(self, distributions):
+        """ Get test command of the distributions upgrade.
+
+        None is the full suite, an empty string means there are no tests
+        to run.
+        """
+        tests = self.select(distributions)
+        if tests is None:
+            return None
+        logger.info(f'impact: {len(tests)} of {len(self.tests)} test modules '
+                    f'import {", ".join(distributions)}')
+        if not tests:
+            return ''
+        return self.command_template.format(
+            tests=' '.join(module_name(path) for path in tests),
+            test_files=' '.join(path.replace(os.sep, '/') for path in tests))
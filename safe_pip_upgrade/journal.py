@@ -0,0 +1,158 @@
+"""
+Write-ahead journal of the upgrade session.
+
+Every decision is appended to the journal file as a json line and synced
+to the disk before the upgrade goes on. After a crash the session is
+resumed from the journal: the original requirements are taken from it,
+finished packages are not upgraded again and the trials with known
+results are not run again, so the upgrade continues from the trial that
+was interrupted. The install result of a trial is recorded before its
+tests, so the lines that failed to install are not installed again
+whatever tests are run with them.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from safe_pip_upgrade.config import Config
+
+logger = logging.getLogger(__name__)
+
+
+def lines_hash(lines, command=None):
+    # type: (list, str) -> str
+    """ Get hash of the requirements lines ignoring the line ends and of
+    the test command. """
+    text = '\n'.join(line.rstrip('\n') for line in lines)
+    if command is not None:
+        text += f'\0{command}'
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+class Journal:
+    """ Journal of the upgrade session, see the module docstring. """
+
+    def __init__(self, path):
+        self.path = path
+        self.lines = None
+        self.results = {}
+        self.installs = {}
+        self.done = {}
+        self.finished = False
+        self._trials = 0
+        self._file = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls):
+        """ Get journal configured in Config or None if it is off. """
+        if not Config.JOURNAL_FILE:
+            return None
+        return cls(os.path.join(Config.WORKING_DIRECTORY, Config.JOURNAL_FILE))
+
+    def load(self):
+        # type: () -> bool
+        """ Replay the journal, check if there is a session to resume. """
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self._replay(json.loads(line))
+                    except ValueError:
+                        # the last line may be written partially
+                        break
+        except FileNotFoundError:
+            return False
+        return self.lines is not None and not self.finished
+
+    def _replay(self, record):
+        event = record['event']
+        if event == 'session':
+            self.lines = record['lines']
+            self.results.clear()
+            self.installs.clear()
+            self.done.clear()
+            self.finished = False
+            self._trials = 0
+        elif event == 'trial':
+            self._trials = max(self._trials, record['trial'])
+        elif event == 'install':
+            self.installs[record['lines']] = record['installed']
+        elif event == 'result':
+            self.results[record['lines']] = record['passed']
+        elif event == 'package':
+            self.done[record['index']] = record['line']
+        elif event == 'finished':
+            self.finished = True
+
+    def start(self, lines):
+        """ Start a new session with the original requirements lines. """
+        self._file = open(self.path, 'w', encoding='utf-8')
+        self.lines = list(lines)
+        self.record('session', lines=self.lines)
+
+    def resume(self):
+        """ Continue the loaded session. """
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self.record('resume', results=len(self.results),
+                    packages=len(self.done))
+        logger.info(f'journal: resume the session, {len(self.done)} '
+                    f'packages done, {len(self.results)} known trials')
+
+    def record(self, event, **data):
+        """ Append the event and sync it to the disk. """
+        data['event'] = event
+        data['time'] = time.time()
+        with self._lock:
+            self._file.write(json.dumps(data) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def known_result(self, lines, command=None):
+        """ Get result of the finished trial or None, the trial of the
+        lines that failed to install fails with any command. """
+        if self.installs.get(lines_hash(lines)) is False:
+            return False
+        return self.results.get(lines_hash(lines, command))
+
+    def trial_started(self, lines, command=None):
+        """ Record the trial with the lines changed since the start, get
+        its number. """
+        with self._lock:
+            self._trials += 1
+            trial = self._trials
+        changes = [line.strip() for line, original in zip(lines, self.lines)
+                   if line.strip() != original.strip()]
+        self.record('trial', trial=trial, lines=lines_hash(lines, command),
+                    changes=changes, command=command)
+        return trial
+
+    def install_result(self, trial, lines, installed):
+        """ Record if the lines of the trial are installed. """
+        key = lines_hash(lines)
+        self.installs[key] = installed
+        self.record('install', trial=trial, lines=key, installed=installed)
+
+    def trial_result(self, trial, lines, passed, command=None):
+        key = lines_hash(lines, command)
+        self.results[key] = passed
+        self.record('result', trial=trial, lines=key, passed=passed)
+
+    def decision(self, req, version, accepted):
+        """ Record accepted or rejected version of the requirement. """
+        self.record('accepted' if accepted else 'rejected', name=req.name,
+                    version=version)
+
+    def package_done(self, i, line):
+        """ Record the final line of the requirement. """
+        self.done[i] = line
+        self.record('package', index=i, line=line)
+
+    def finish(self, interrupted=False):
+        """ Close the journal, the interrupted session can be resumed. """
+        self.record('interrupted' if interrupted else 'finished')
+        self._file.close()
+        self._file = None
@@ -0,0 +1,247 @@
+"""
+Timing metrics of the upgrade run.
+
+Every phase (pypi requests, install, test stages, container restarts,
+trials...) is timed to the histogram of the phase, the trials are counted
+by package. At the end of the run a json report is written and,
+optionally, a Prometheus textfile for the node exporter textfile
+collector.
+"""
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from safe_pip_upgrade.config import Config
+from safe_pip_upgrade.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+try:
+    from packaging.utils import canonicalize_name
+except ImportError:
+    # noinspection PyProtectedMember,PyCompatibility
+    from pip._vendor.packaging.utils import canonicalize_name
+
+# upper bounds of the histogram buckets, seconds
+BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, math.inf)
+PREFIX = 'safe_pip_upgrade'
+
+
+class Histogram:
+    """ Durations of a phase. """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        """ Get (bound, count of values <= bound) pairs. """
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+
+class PackageStats:
+    """ Trials and decisions of a package. """
+
+    def __init__(self):
+        self.trials = 0
+        self.passed = 0
+        self.time = 0.0
+        self.accepted = []
+        self.rejected = []
+        self.original = None
+        self.final = None
+
+    def to_dict(self):
+        return {'from': self.original, 'to': self.final,
+                'trials': self.trials, 'passed': self.passed,
+                'time': round(self.time, 3), 'accepted': self.accepted,
+                'rejected': self.rejected}
+
+
+class Metrics:
+    """ Timing metrics of the run, see the module docstring.
+
+    The metrics are collected from all the threads.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.reset()
+
+    def reset(self):
+        """ Start a new run. """
+        self._lock = threading.Lock()
+        self.phases = {}
+        self.packages = {}
+        self.counters = Counter()
+        self.started_at = time.time()
+        self.started = self.clock()
+
+    @contextmanager
+    def phase(self, name, **attributes):
+        """ Time the block to the phase, it is traced as a span with the
+        attributes. """
+        started = self.clock()
+        try:
+            with tracer.span(name, **attributes) as span:
+                yield span
+        finally:
+            self.observe(name, self.clock() - started)
+
+    def observe(self, name, duration):
+        with self._lock:
+            self.phases.setdefault(name, Histogram()).observe(duration)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def trial(self, package, duration, passed):
+        """ Count the trial of the package version. """
+        with self._lock:
+            stats = self._package(package)
+            stats.trials += 1
+            stats.passed += bool(passed)
+            stats.time += duration
+
+    def decision(self, package, version, accepted):
+        """ Count accepted or rejected version of the package. """
+        with self._lock:
+            stats = self._package(package)
+            (stats.accepted if accepted else stats.rejected).append(version)
+
+    def versions(self, package, original, final):
+        """ Set the version of the package before and after the upgrade. """
+        with self._lock:
+            stats = self._package(package)
+            stats.original, stats.final = original, final
+
+    def _package(self, name):
+        return self.packages.setdefault(canonicalize_name(name),
+                                        PackageStats())
+
+    def report(self, interrupted=False):
+        # type: (bool) -> dict
+        """ Get the json report of the run. """
+        with self._lock:
+            return {
+                'started': self.started_at,
+                'duration': round(self.clock() - self.started, 3),
+                'interrupted': interrupted,
+                'phases': {
+                    name: {'count': histogram.count,
+                           'total': round(histogram.sum, 3),
+                           'max': round(histogram.max, 3)}
+                    for name, histogram in sorted(self.phases.items())},
+                'packages': {name: stats.to_dict() for name, stats
+                             in sorted(self.packages.items())},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def prometheus(self, interrupted=False):
+        # type: (bool) -> str
+        """ Get the metrics in the Prometheus text format. """
+        report = self.report(interrupted)
+        lines = [
+            f'# HELP {PREFIX}_phase_seconds Duration of the upgrade phases.',
+            f'# TYPE {PREFIX}_phase_seconds histogram',
+        ]
+        with self._lock:
+            phases = sorted(self.phases.items())
+            for name, histogram in phases:
+                label = f'phase="{_escape(name)}"'
+                for bound, count in histogram.cumulative():
+                    le = '+Inf' if bound == math.inf else f'{bound:g}'
+                    lines.append(f'{PREFIX}_phase_seconds_bucket'
+                                 f'{{{label},le="{le}"}} {count}')
+                lines.append(f'{PREFIX}_phase_seconds_sum{{{label}}} '
+                             f'{histogram.sum:.3f}')
+                lines.append(f'{PREFIX}_phase_seconds_count{{{label}}} '
+                             f'{histogram.count}')
+
+        packages = report['packages'].values()
+        upgraded = sum(stats['from'] != stats['to'] for stats in packages)
+        lines += [
+            f'# HELP {PREFIX}_trials_total Trials of the package versions.',
+            f'# TYPE {PREFIX}_trials_total counter',
+            f'{PREFIX}_trials_total{{result="passed"}} '
+            f'{sum(stats["passed"] for stats in packages)}',
+            f'{PREFIX}_trials_total{{result="failed"}} '
+            f'{sum(stats["trials"] - stats["passed"] for stats in packages)}',
+            f'# HELP {PREFIX}_events_total Events of the run.',
+            f'# TYPE {PREFIX}_events_total counter',
+        ]
+        lines += [f'{PREFIX}_events_total{{event="{_escape(name)}"}} {value}'
+                  for name, value in report['counters'].items()]
+        lines += [
+            f'# HELP {PREFIX}_upgraded_packages Packages upgraded by the run.',
+            f'# TYPE {PREFIX}_upgraded_packages gauge',
+            f'{PREFIX}_upgraded_packages {upgraded}',
+            f'# HELP {PREFIX}_run_seconds Duration of the run.',
+            f'# TYPE {PREFIX}_run_seconds gauge',
+            f'{PREFIX}_run_seconds {report["duration"]:.3f}',
+            f'# HELP {PREFIX}_run_interrupted 1 if the run was interrupted.',
+            f'# TYPE {PREFIX}_run_interrupted gauge',
+            f'{PREFIX}_run_interrupted {int(interrupted)}',
+            f'# HELP {PREFIX}_last_run_timestamp_seconds Start of the run.',
+            f'# TYPE {PREFIX}_last_run_timestamp_seconds gauge',
+            f'{PREFIX}_last_run_timestamp_seconds {report["started"]:.0f}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, interrupted=False):
+        """ Write the report and the textfile configured in Config. """
+        if Config.METRICS_REPORT:
+            path = os.path.join(Config.WORKING_DIRECTORY,
+                                Config.METRICS_REPORT)
+            _write_atomic(path, json.dumps(self.report(interrupted),
+                                           indent=2) + '\n')
+            logger.info(f'metrics: report is written to {path}')
+        if Config.METRICS_TEXTFILE:
+            path = os.path.expanduser(Config.METRICS_TEXTFILE)
+            _write_atomic(path, self.prometheus(interrupted))
+            logger.info(f'metrics: textfile is written to {path}')
+
+    def log_summary(self):
+        with self._lock:
+            phases = sorted(self.phases.items(), key=lambda p: -p[1].sum)
+        logger.info('metrics: ' + ', '.join(
+            f'{name} {histogram.sum:.0f}s/{histogram.count}'
+            for name, histogram in phases))
+
+
+def _escape(value):
+    return (value.replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+def _write_atomic(path, text):
+    """ Write the file at once, the collector never reads a partial file.
+    """
+    temporary = path + '.tmp'
+    with open(temporary, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(temporary, path)
+
+
+metrics = Metrics()
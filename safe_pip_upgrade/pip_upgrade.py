@@ -9,15 +9,35 @@ import argparse
 import os
 import sys
 
-from safe_pip_upgrade.config import config_file, Config
-from safe_pip_upgrade.requirements_file import RequirementsLocal
-from safe_pip_upgrade.runners.compose import ComposeRunner
-from safe_pip_upgrade.core.upgrade import Upgrade
+from safe_pip_upgrade.config import (check_config, config_file, Config,
+                                     setup_logging)
+
+# the runners, pypi client and the rest are imported by the commands that
+# use them, so --help and CREATE-INI don't load requests and the docker
+# client
+
 
 def start_upgrade():
-    core = Upgrade(client=get_client(),
-                   req_file=get_requirements())
-    core.start_upgrade()
+    from safe_pip_upgrade.core.upgrade import Upgrade
+    from safe_pip_upgrade.tracing import tracer
+
+    setup_logging()
+    if Config.TRACE_FILE:
+        tracer.enable()
+    try:
+        with tracer.span('upgrade', runner=Config.RUNNER,
+                         strategy=Config.STRATEGY):
+            client = get_client()
+            req_file = get_requirements()
+            core = Upgrade(client=client,
+                           req_file=req_file,
+                           pool=get_pool(client, req_file))
+            core.start_upgrade()
+    finally:
+        # the trace of the failed run is written too
+        if Config.TRACE_FILE:
+            tracer.save(os.path.join(Config.WORKING_DIRECTORY,
+                                     Config.TRACE_FILE))
 
 
 def get_requirements():
@@ -25,6 +45,7 @@ def get_requirements():
 
     Now there is only a file handler. Perhaps there will be more later.
     """
+    from safe_pip_upgrade.requirements_file import RequirementsLocal
     return RequirementsLocal(os.path.join(Config.WORKING_DIRECTORY,
                                           Config.LOCAL_REQUIREMENTS_FILE))
 
@@ -32,7 +53,19 @@ def get_requirements():
 def get_client():
     """ Get the test-runner. """
     if Config.RUNNER == 'compose':
+        from safe_pip_upgrade.runners.compose import ComposeRunner
         return ComposeRunner(Config)
+    if Config.RUNNER == 'venv':
+        from safe_pip_upgrade.runners.venv import VenvRunner
+        return VenvRunner(Config)
+
+
+def get_pool(client, req_file):
+    """ Get pool of the test-runners if there are several workers. """
+    if int(Config.WORKERS) > 1:
+        from safe_pip_upgrade.runners.pool import RunnerPool
+        return RunnerPool.create(client, req_file, int(Config.WORKERS))
+    return None
 
 
 class ManagementUtility:
@@ -46,7 +79,9 @@ class ManagementUtility:
         # noinspection PyTypeChecker
         parser = argparse.ArgumentParser(
             description=__doc__,  # printed with -h/--help
-            formatter_class=argparse.RawDescriptionHelpFormatter
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+            # only the given arguments override the ini file
+            argument_default=argparse.SUPPRESS,
         )
 
         # COMMANDS
@@ -82,10 +117,127 @@ class ManagementUtility:
             help='Specify local requirements file  '
                  '(default: requirements.txt)')
 
+        # includes
+        general_group.add_argument(
+            "--follow-includes", action='store_true', dest='FOLLOW_INCLUDES',
+            help='Upgrade the requirements of the -r included files too and '
+                 'test only the versions the -c constraint files allow')
+
+        # test stages
+        general_group.add_argument(
+            "--test-stages", metavar="STAGES", dest='TEST_STAGES',
+            help='Specify stages run before the tests, one per line as '
+                 '"name | timeout | command", cheapest first. The trial '
+                 'stops on the first failed stage (default: no stages)')
+
+        # failure patterns
+        general_group.add_argument(
+            "--failure-patterns", metavar="PATTERNS",
+            dest='TEST_FAILURE_PATTERNS',
+            help='Specify regular expressions of the output lines of failed '
+                 'tests, one per line, e.g. "^FAILED". The stage is aborted '
+                 'on the first matched line (default: no patterns)')
+
+        # adaptive deadlines
+        general_group.add_argument(
+            "--deadline-factor", metavar="FACTOR",
+            dest='TEST_DEADLINE_FACTOR', type=float,
+            help='Kill a stage running longer than its previous durations '
+                 'percentile times the factor, 0 turns it off (default: 3)')
+        general_group.add_argument(
+            "--deadline-percentile", metavar="PERCENT",
+            dest='TEST_DEADLINE_PERCENTILE', type=int,
+            help='Specify percentile of the previous durations of a stage '
+                 '(default: 95)')
+        general_group.add_argument(
+            "--deadline-min", metavar="SECONDS", dest='TEST_DEADLINE_MIN',
+            type=int,
+            help='Specify the minimal deadline of a stage (default: 60)')
+
+        # sdist only versions
+        general_group.add_argument(
+            "--skip-sdist-only", action='store_true', dest='SKIP_SDIST_ONLY',
+            help='Don\'t test versions without wheels for the test '
+                 'environment, otherwise versions with wheels are only '
+                 'preferred')
+
+        # incremental install
+        general_group.add_argument(
+            "--full-install", action='store_false',
+            dest='INCREMENTAL_INSTALL',
+            help='Install the whole requirements file on every trial instead '
+                 'of the changed pins only')
+
+        # strategy
+        general_group.add_argument(
+            "-s", "--strategy", dest='STRATEGY',
+            choices=['sequential', 'group'],
+            help='Specify upgrade strategy: "sequential" tests packages one '
+                 'by one, "group" tests all upgrades at once and splits '
+                 'them only if the tests fail (default: sequential)')
+
+        # workers
+        general_group.add_argument(
+            "-w", "--workers", metavar="N", dest='WORKERS', type=int,
+            help='Specify number of runners to test packages in parallel '
+                 '(default: 1)')
+
+        # dependency resolver
+        general_group.add_argument(
+            "--resolve-dependencies", action='store_true',
+            dest='RESOLVE_DEPENDENCIES',
+            help='Check requirements of the candidate versions against the '
+                 'other pins and reject the conflicting ones without '
+                 'trials (default: off)')
+
+        # search arity
+        general_group.add_argument(
+            "-k", "--search-arity", metavar="K", dest='SEARCH_ARITY',
+            type=int,
+            help='Specify number of versions of a package tested at once on '
+                 'the workers instead of the binary search, it needs '
+                 '--workers > 1 (default: 1)')
+
+        # trial store
+        general_group.add_argument(
+            "--trial-store", metavar="FILE", dest='TRIAL_STORE',
+            help='Specify sqlite file to keep trial results in, known '
+                 'results are reused by the next runs (default: off)')
+
+        # journal
+        general_group.add_argument(
+            "--journal", metavar="FILE", dest='JOURNAL_FILE',
+            help='Specify the journal of the upgrade session to resume it '
+                 'after an interruption, e.g. pip_upgrade.journal '
+                 '(default: off)')
+
+        # resume
+        general_group.add_argument(
+            "--resume", action='store_true', dest='RESUME',
+            help='Continue the interrupted upgrade from the journal without '
+                 'testing the finished packages and trials again')
+
+        # impacted tests
+        general_group.add_argument(
+            "--impact-test-command", metavar="COMMAND",
+            dest='IMPACT_TEST_COMMAND',
+            help='Run only the tests that import the upgraded packages with '
+                 'the command, {tests} is replaced with the dotted test '
+                 'modules and {test_files} with their paths. The full suite '
+                 'is run for the accepted upgrades at the end (default: off)')
+
+        # impact cache
+        general_group.add_argument(
+            "--impact-cache", metavar="FILE", dest='IMPACT_CACHE',
+            help='Specify the cache of the project imports '
+                 '(default: pip_upgrade.impact.json)')
+
         # runner
         general_group.add_argument(
             "-u", "--runner", metavar="RUNNER", dest='RUNNER',
-            help='Specify runner (only "compose" is available now).')
+            help='Specify runner: "compose" runs the tests in the docker '
+                 'compose service, "venv" in local virtual environments '
+                 '(default: compose)')
 
         # COMPOSE RUNNER SETTINGS
         compose_group = parser.add_argument_group('COMPOSE RUNNER PARAMETERS')
@@ -118,11 +270,166 @@ class ManagementUtility:
             help='Specify an alternate compose working directory in '
                  'container (default: CWD form Dockerfile)'),
 
-        args = parser.parse_args(namespace=Config)
+        # compose wheelhouse directory
+        compose_group.add_argument(
+            "--compose-wheelhouse-dir", metavar="DIR",
+            dest='COMPOSE_WHEELHOUSE_DIR',
+            help='Specify the directory the wheelhouse is mounted to in '
+                 'container (default: /wheelhouse)')
+
+        # compose snapshot
+        compose_group.add_argument(
+            "--compose-snapshot", action='store_true',
+            dest='COMPOSE_SNAPSHOT',
+            help='Install trial pins to a layer over the baseline packages '
+                 'and drop the layer after the trial instead of reinstalling')
+
+        # compose snapshot directory
+        compose_group.add_argument(
+            "--compose-snapshot-dir", metavar="DIR",
+            dest='COMPOSE_SNAPSHOT_DIR',
+            help='Specify the directory of the layer in container '
+                 '(default: /tmp/safe_pip_upgrade_layer)')
+
+        # docker engine socket
+        compose_group.add_argument(
+            "--compose-docker-socket", metavar="PATH",
+            dest='COMPOSE_DOCKER_SOCKET',
+            help='Talk to the docker engine API on the unix socket, e.g. '
+                 '/var/run/docker.sock, instead of running the docker CLI '
+                 'for every step (default: the CLI)')
+
+        # container events
+        compose_group.add_argument(
+            "--compose-poll", action='store_false',
+            dest='COMPOSE_WATCH_EVENTS',
+            help='Poll docker before every step instead of following the '
+                 'container events in background')
+
+        # compose timeout
+        compose_group.add_argument(
+            "--compose-timeout", metavar="SECONDS", dest='COMPOSE_TIMEOUT',
+            type=int,
+            help='Specify how long to wait for the test container to start '
+                 '(default: 20)')
+
+        # VENV RUNNER SETTINGS
+        venv_group = parser.add_argument_group('VENV RUNNER PARAMETERS')
+
+        # venv interpreter
+        venv_group.add_argument(
+            "--venv-python", metavar="PYTHON", dest='VENV_PYTHON',
+            help='Specify the interpreter the environments are created with '
+                 '(default: python3)')
+
+        # venv directory
+        venv_group.add_argument(
+            "--venv-dir", metavar="DIR", dest='VENV_DIR',
+            help='Specify the directory of the environments relative to '
+                 'the working directory (default: .safe_pip_upgrade_venv)')
+
+        # PYPI SETTINGS
+        pypi_group = parser.add_argument_group('PYPI PARAMETERS')
+
+        # cache directory
+        pypi_group.add_argument(
+            "--cache-dir", metavar="DIR", dest='PYPI_CACHE_DIR',
+            help='Specify the release lists cache directory, e.g. '
+                 '~/.cache/safe_pip_upgrade (default: off)')
+
+        # cache ttl
+        pypi_group.add_argument(
+            "--cache-ttl", metavar="SECONDS", dest='PYPI_CACHE_TTL', type=int,
+            help='Specify how long cached release lists are used without '
+                 'revalidation (default: 3600)')
+
+        # cache size
+        pypi_group.add_argument(
+            "--cache-max-size", metavar="BYTES", dest='PYPI_CACHE_MAX_SIZE',
+            type=int,
+            help='Specify the cache size limit (default: 20 MB)')
+
+        # concurrent requests
+        pypi_group.add_argument(
+            "--pypi-workers", metavar="N", dest='PYPI_WORKERS', type=int,
+            help='Specify the max number of concurrent requests to pypi '
+                 '(default: 8)')
+
+        # cache mode
+        cache_mode = pypi_group.add_mutually_exclusive_group()
+        cache_mode.add_argument(
+            "--refresh", action='store_true', dest='PYPI_REFRESH',
+            help='Download all release lists ignoring the cache')
+        cache_mode.add_argument(
+            "--offline", action='store_true', dest='PYPI_OFFLINE',
+            help='Use cached release lists only')
+
+        # WHEELHOUSE SETTINGS
+        wheelhouse_group = parser.add_argument_group('WHEELHOUSE PARAMETERS')
+
+        # wheelhouse directory
+        wheelhouse_group.add_argument(
+            "--wheelhouse", metavar="DIR", dest='WHEELHOUSE_DIR',
+            help='Specify the directory to prebuild candidate versions to, '
+                 'it is reused between runs (default: off)')
+
+        # wheelhouse size
+        wheelhouse_group.add_argument(
+            "--wheelhouse-max-size", metavar="BYTES",
+            dest='WHEELHOUSE_MAX_SIZE', type=int,
+            help='Specify the wheelhouse size limit (default: 2 GB)')
+
+        # wheelhouse age
+        wheelhouse_group.add_argument(
+            "--wheelhouse-max-age", metavar="SECONDS",
+            dest='WHEELHOUSE_MAX_AGE', type=int,
+            help='Specify how long unused wheels are kept (default: 30 days)')
+
+        # concurrent downloads
+        wheelhouse_group.add_argument(
+            "--wheelhouse-workers", metavar="N", dest='WHEELHOUSE_WORKERS',
+            type=int,
+            help='Specify the number of concurrent downloads (default: 4)')
+
+        # METRICS SETTINGS
+        metrics_group = parser.add_argument_group('METRICS PARAMETERS')
+
+        # json report
+        metrics_group.add_argument(
+            "--report", metavar="FILE", dest='METRICS_REPORT',
+            help='Write the json report of the run with the phase timings '
+                 'and the trials of every package, e.g. '
+                 'pip_upgrade.report.json (default: off)')
+
+        # prometheus textfile
+        metrics_group.add_argument(
+            "--prometheus-textfile", metavar="FILE", dest='METRICS_TEXTFILE',
+            help='Write the metrics of the run to the Prometheus textfile, '
+                 'e.g. /var/lib/node_exporter/safe_pip_upgrade.prom '
+                 '(default: off)')
+
+        # trace file
+        metrics_group.add_argument(
+            "--trace", metavar="FILE", dest='TRACE_FILE',
+            help='Write spans of the run to the Chrome trace-event file to '
+                 'open it in Perfetto, e.g. pip_upgrade.trace.json '
+                 '(default: off)')
+
+        args = parser.parse_args()
         if not hasattr(args, 'command_handler'):
             parser.print_help()
-        else:
-            args.command_handler()
+            return
+
+        # the ini file of the arguments is read, the arguments override it
+        Config.INI_FILE = getattr(args, 'INI_FILE', Config.INI_FILE)
+        config_file.read_from_file()
+        for key, value in vars(args).items():
+            setattr(Config, key, value)
+        try:
+            check_config()
+        except ValueError as e:
+            parser.error(str(e))
+        Config.command_handler()
 
 def main():
     utility = ManagementUtility()
@@ -1,80 +1,472 @@
 import json
 import logging
 import pprint
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
 from requests import RequestException
+from requests.adapters import HTTPAdapter
+
+from safe_pip_upgrade.config import Config
+from safe_pip_upgrade.metrics import metrics
+from safe_pip_upgrade.pypi_cache import PypiCache
+from safe_pip_upgrade.pypi_simple import (
+    CONTENT_TYPE, iter_files, releases_from_files, releases_from_legacy)
+from safe_pip_upgrade.releases import ReleaseTable, Version, version_key
+from safe_pip_upgrade.tracing import tracer
 
 logger = logging.getLogger(__name__)
 
 try:
-    from packaging.version import parse
+    from packaging.utils import canonicalize_name
 except ImportError:
     # noinspection PyProtectedMember,PyCompatibility
-    from pip._vendor.packaging.version import parse
+    from pip._vendor.packaging.utils import canonicalize_name
+
+
+def create_session():
+    """ Create http session with the keep-alive connections pool. """
+    http_session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    http_session.mount('https://', adapter)
+    http_session.mount('http://', adapter)
+    return http_session
+
+
+# shared by all pypi requests
+session = create_session()
+
+
+class SimpleApiUnsupported(Exception):
+    """ The index doesn't answer with the json simple API. """
+
+
+class TooManyRequests(ConnectionError):
+    """ Pypi asks to slow down (HTTP 429). """
+
+    def __init__(self, retry_after=None):
+        super().__init__('Too many requests to pypi API')
+        self.retry_after = retry_after
+
+
+class AdaptiveLimiter:
+    """ Limit of concurrent requests.
+
+    The limit is halved when pypi answers "too many requests" and grows back
+    by one after every successful request.
+    """
+
+    def __init__(self, max_limit):
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self._active = 0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        with self._condition:
+            while self._active >= self.limit:
+                self._condition.wait()
+            self._active += 1
+
+    def __exit__(self, *exc_info):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    def throttle(self):
+        with self._condition:
+            self.limit = max(1, self.limit // 2)
+            logger.info(f'pypi: too many requests, concurrency {self.limit}')
+
+    def relax(self):
+        with self._condition:
+            if self.limit < self.max_limit:
+                self.limit += 1
+                self._condition.notify_all()
+
+
+def release_url(name, version):
+    # type: (str, str) -> str
+    """ Get url of the json API of the release on the configured index.
+
+    The API is next to the simple one, e.g. https://pypi.org/pypi/ for
+    https://pypi.org/simple/.
+    """
+    root = Config.PYPI_INDEX_URL.rstrip('/')
+    if root.endswith('/simple'):
+        root = root[:-len('/simple')]
+    return f'{root}/pypi/{name}/{version}/json'
 
 
 class PypiPackages:
     """ Pypi packages cache. """
+    RETRIES = 5
 
     def __init__(self):
         self._packages = {}
+        self.environment = None
 
     def get_package(self, name):
         if name in self._packages:
             return self._packages[name]
         else:
             # setdefault evaluates default value even if the key exists
-            return self._packages.setdefault(name, PypiPackage(name))
+            return self._packages.setdefault(
+                name, PypiPackage(name, cache=PypiCache.from_config(),
+                                  environment=self.environment))
+
+    def set_environment(self, environment):
+        """ Filter candidates of all packages for the test environment. """
+        self.environment = environment
+        for package in self._packages.values():
+            package.set_environment(environment)
+
+    def prefetch(self, names, max_workers):
+        """ Get packages concurrently.
+
+        Failed packages are only logged, they will be requested again when
+        they are needed.
+        """
+        names = [n for n in dict.fromkeys(names) if n not in self._packages]
+        if not names:
+            return
+
+        logger.info(f'pypi: prefetch {len(names)} packages')
+        limiter = AdaptiveLimiter(max_workers)
+        with ThreadPoolExecutor(max_workers) as executor:
+            futures = {executor.submit(self._fetch, name, limiter): name
+                       for name in names}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except (ConnectionError, RequestException, ValueError) as e:
+                    logger.warning(
+                        f'pypi: prefetch of {futures[future]} failed: {e}')
+
+    def _fetch(self, name, limiter):
+        cache = PypiCache.from_config()
+        for attempt in range(self.RETRIES):
+            with limiter:
+                try:
+                    package = PypiPackage(name, cache=cache,
+                                          environment=self.environment)
+                except TooManyRequests as e:
+                    limiter.throttle()
+                    delay = e.retry_after or 2 ** attempt
+                else:
+                    limiter.relax()
+                    self._packages.setdefault(name, package)
+                    return
+            time.sleep(delay)
+        raise TooManyRequests()
 
 
 pypi_packages = PypiPackages()
 
 
 class PypiPackage:
-    """ Pypi packages parser. """
+    """ Pypi packages parser.
+
+    releases are all final releases of the package, candidates are the
+    releases that can be installed in the test environment and the kept
+    ones (e.g. the pinned release).
+    """
+    __slots__ = ('name', 'cache', 'releases', 'candidates', 'skipped',
+                 'environment', 'kept')
     URL_PATTERN = 'https://pypi.python.org/pypi/{package}/json'
 
-    def __init__(self, name):
+    def __init__(self, name, cache=None, environment=None):
+        # type: (str, PypiCache, TargetEnvironment) -> None
         self.name = name
+        self.cache = cache
+        self.environment = environment
+        self.kept = set()
         self._get_versions()
 
     @property
     def last_version(self):
-        return str(self.releases[-1])
+        # type: () -> Optional[str]
+        """ The latest candidate or None if no release can be installed.
+        """
+        return self.candidates[-1] if self.candidates else None
+
+    def keep(self, version):
+        # type: (str) -> None
+        """ Keep the release of the version in the candidates even if it
+        is skipped in the environment. """
+        if version in self.kept:
+            return
+        self.kept.add(version)
+        position = self.candidates.bisect_left(version)
+        if (position == len(self.candidates) or
+                self.candidates.keys[position] != version_key(
+                    Version(version))):
+            self.set_environment(self.environment)
 
     def next_version(self, version):
-        version = parse(version)
-        if version == self.last_version:
+        position = self.candidates.bisect_right(version)
+        if position == len(self.candidates):
             return None
-        return str(self.releases[self.releases.index(version) + 1])
+        return self.candidates[position]
 
     def get_middle_version(self, gt, lt=None):
         """ get version between """
-        gt_ind = self.releases.index(parse(gt))
+        # gt and lt may be not candidates, e.g. "0.5.0" for "0.5"
+        gt_ind = self.candidates.bisect_right(gt) - 1
         if lt:
-            lt_ind = self.releases.index(parse(lt))
+            lt_ind = self.candidates.bisect_left(lt)
         else:
-            lt_ind = len(self.releases)
+            lt_ind = len(self.candidates)
 
         if lt_ind - gt_ind <= 1:
             # there are no versions between
             return None
 
         middle_pos = (gt_ind + lt_ind) // 2
-        return str(self.releases[middle_pos])
+        return self.candidates[self._cheap_position(middle_pos, gt_ind,
+                                                    lt_ind)]
 
-    def _get_versions(self):
-        """Return version of package on pypi.python.org using json."""
+    def get_spread_versions(self, gt, lt=None, count=1):
+        """ Get up to count versions evenly spread between gt and lt.
+
+        If lt is not set, the last version is one of them.
+        """
+        gt_ind = self.candidates.bisect_right(gt) - 1
+        if lt:
+            lt_ind = self.candidates.bisect_left(lt)
+            positions = {gt_ind + j * (lt_ind - gt_ind) // (count + 1)
+                         for j in range(1, count + 1)}
+        else:
+            lt_ind = len(self.candidates)
+            between = lt_ind - gt_ind - 1
+            positions = {gt_ind - (-j * between // count)
+                         for j in range(1, count + 1)}
+        return [self.candidates[position] for position in sorted(positions)
+                if gt_ind < position < lt_ind]
+
+    def search_order(self, gt, lt=None):
+        """ Get versions between gt and lt in order the search tries them.
+
+        If lt is not set, the last version goes first. Then the middles of
+        the intervals follow, from the wider intervals to the narrower.
+        """
+        gt_ind = self.candidates.bisect_right(gt) - 1
+        order = []
+        if lt:
+            lt_ind = self.candidates.bisect_left(lt)
+        else:
+            lt_ind = len(self.candidates) - 1
+            if lt_ind > gt_ind:
+                order.append(lt_ind)
+
+        intervals = deque([(gt_ind, lt_ind)])
+        while intervals:
+            low, high = intervals.popleft()
+            if high - low <= 1:
+                continue
+            middle = (low + high) // 2
+            order.append(middle)
+            intervals.extend(((low, middle), (middle, high)))
+        return [self.candidates[position] for position in order]
+
+    def get_requires(self, version):
+        # type: (str) -> Optional[list]
+        """ Get requires-dist of the release or None if it is unknown. """
+        if self.cache:
+            requires = self.cache.load_requires(Config.PYPI_INDEX_URL,
+                                                self.name, version)
+            if requires is not None:
+                return requires
+        if Config.PYPI_OFFLINE:
+            return None
+
+        url = release_url(self.name, version)
         try:
-            req = requests.get(self.URL_PATTERN.format(package=self.name))
+            with metrics.phase('pypi_requires', package=self.name,
+                               version=version) as span:
+                req = session.get(url)
+                span.set(status=req.status_code)
             req.raise_for_status()
+            requires = json.loads(req.text)['info'].get('requires_dist') or []
+        except (RequestException, ValueError, KeyError) as e:
+            logger.debug(f'pypi: can not get requirements of '
+                         f'{self.name}=={version}: {e}')
+            return None
+        if self.cache:
+            self.cache.store_requires(Config.PYPI_INDEX_URL, self.name,
+                                      version, requires)
+        return requires
+
+    def set_environment(self, environment):
+        # type: (TargetEnvironment) -> None
+        """ Choose candidates that can be installed in the environment.
+
+        Yanked releases are skipped always, releases for other python
+        versions and (if Config.SKIP_SDIST_ONLY) releases without
+        suitable wheels are skipped if the environment is known.
+        """
+        self.environment = environment
+        self.skipped = {}
+        positions = []
+        kept = {version_key(Version(version)) for version in self.kept}
+        for position, release in enumerate(self.releases):
+            reason = self._skip_reason(release)
+            if reason and self.releases.keys[position] not in kept:
+                self.skipped[release.version] = reason
+            else:
+                positions.append(position)
+        self.candidates = self.releases.select(positions)
+
+    def skipped_after(self, version):
+        # type: (str) -> Counter
+        """ Count reasons of the releases skipped after the version. """
+        key = version_key(Version(version))
+        return Counter(reason for v, reason in self.skipped.items()
+                       if version_key(Version(v)) > key)
+
+    def _skip_reason(self, release):
+        if release.yanked:
+            return 'yanked'
+        if self.environment is None:
+            return None
+        if not self.environment.is_python_supported(release.requires_python):
+            return 'requires another python'
+        if Config.SKIP_SDIST_ONLY and not self._has_wheel(release.wheels):
+            return 'has no wheel'
+        return None
+
+    def _has_wheel(self, wheels):
+        return any(map(self.environment.is_wheel_supported, wheels))
+
+    def _cheap_position(self, middle_pos, gt_ind, lt_ind):
+        """ Get the nearest to the middle candidate with a suitable wheel.
+
+        Candidates without wheels are built from sources, that may take
+        minutes. The search doesn't leave the middle half of the interval.
+        """
+        if self.environment is None:
+            return middle_pos
+        for offset in range((lt_ind - gt_ind) // 4 + 1):
+            for position in (middle_pos - offset, middle_pos + offset):
+                if (gt_ind < position < lt_ind and
+                        self._has_wheel(self.candidates.wheels[position])):
+                    return position
+        return middle_pos
+
+    def _get_versions(self):
+        """ Get versions of package from the cache or pypi. """
+        with tracer.span('pypi.versions', package=self.name) as span:
+            self._load_versions(span)
+            span.set(candidates=len(self.candidates))
+
+    def _load_versions(self, span):
+        entry = None
+        if self.cache:
+            entry = self.cache.load(Config.PYPI_INDEX_URL, self.name)
+
+        fresh = (entry and self.cache.is_fresh(entry) and
+                 not Config.PYPI_REFRESH)
+        if entry and (Config.PYPI_OFFLINE or fresh):
+            metrics.count('pypi_cache_hits')
+            span.set(source='cache')
+            self._set_releases(entry['releases'])
+            return
+
+        if Config.PYPI_OFFLINE:
+            raise ConnectionError(
+                f'There is no cached releases of {self.name} in offline mode')
+
+        if Config.PYPI_REFRESH:
+            entry = None
+        span.set(source='pypi')
+        with metrics.phase('pypi', package=self.name):
+            releases = self._request_versions(entry)
+        self._set_releases(releases)
+
+    def _request_versions(self, entry=None):
+        """ Get releases from the simple API or from the legacy json API.
+
+        If there is a cached entry the request is conditional.
+        """
+        url = self.URL_PATTERN.format(package=self.name)
+        if not entry or entry.get('url') != url:
+            try:
+                return self._request_simple(entry)
+            except (RequestException, SimpleApiUnsupported) as e:
+                logger.debug(f'pypi: simple API is not available for '
+                             f'{self.name}: {e}')
+
+        try:
+            req = self._get(url, entry)
         except RequestException as e:
             logger.exception('Can not get access to pypi API: %s',
                              pprint.saferepr(e))
             raise ConnectionError(e)
+        if req is None:
+            return entry['releases']
 
         j = json.loads(req.text)
-        raw_releases = j.get('releases', [])
-        all_releases = sorted([parse(r) for r in raw_releases])
-        self.releases = [r for r in all_releases if not r.is_prerelease]
+        releases = releases_from_legacy(j.get('releases', {}))
+        self._store(url, req, releases)
+        return releases
+
+    def _request_simple(self, entry=None):
+        """ Get releases from the PEP 691 json simple API. """
+        url = (Config.PYPI_INDEX_URL.rstrip('/') + '/' +
+               canonicalize_name(self.name) + '/')
+        req = self._get(url, entry, headers={'Accept': CONTENT_TYPE},
+                        stream=True)
+        if req is None:
+            return entry['releases']
+
+        try:
+            content_type = req.headers.get('Content-Type', '')
+            if content_type.split(';')[0].strip() != CONTENT_TYPE:
+                raise SimpleApiUnsupported(content_type)
+            try:
+                releases = releases_from_files(
+                    self.name, iter_files(
+                        req.iter_content(chunk_size=64 * 1024)))
+            except ValueError as e:
+                raise SimpleApiUnsupported(e)
+        finally:
+            req.close()
+        self._store(url, req, releases)
+        return releases
+
+    def _get(self, url, entry, headers=None, stream=False):
+        """ Send request, return None if the cached entry is not modified.
+        """
+        headers = dict(headers or {})
+        conditional = entry and entry.get('url') == url
+        if conditional and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if conditional and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        req = session.get(url, headers=headers, stream=stream)
+        if req.status_code == requests.codes.too_many_requests:
+            retry_after = req.headers.get('Retry-After', '')
+            raise TooManyRequests(
+                int(retry_after) if retry_after.isdigit() else None)
+        req.raise_for_status()
+
+        if conditional and req.status_code == requests.codes.not_modified:
+            logger.debug(f'pypi: {self.name} is not modified')
+            req.close()
+            self.cache.touch(Config.PYPI_INDEX_URL, self.name, entry)
+            return None
+        return req
+
+    def _store(self, url, req, releases):
+        if self.cache:
+            self.cache.store(Config.PYPI_INDEX_URL, self.name, releases,
+                             req.headers.get('ETag'),
+                             req.headers.get('Last-Modified'), url)
+
+    def _set_releases(self, releases):
+        self.releases = ReleaseTable(releases)
+        self.set_environment(self.environment)
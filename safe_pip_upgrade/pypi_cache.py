@@ -0,0 +1,185 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from safe_pip_upgrade.config import Config
+
+logger = logging.getLogger(__name__)
+
+try:
+    from packaging.utils import canonicalize_name
+except ImportError:
+    # noinspection PyProtectedMember,PyCompatibility
+    from pip._vendor.packaging.utils import canonicalize_name
+
+
+class PypiCache:
+    """ On-disk cache of the parsed pypi release lists.
+
+    Every package is stored in a separate json file inside a directory
+    of its index url, so the cache can be shared by several indexes.
+
+    The size of the cache is counted once and then kept up to date by the
+    writes, the directory is scanned again only to evict the entries.
+    """
+    FORMAT_VERSION = 3
+    # the eviction frees some space below the limit, so the next writes
+    # don't scan the directory again
+    EVICT_TO = 0.9  # share of max_size
+    _instances = {}  # {(directory, ttl, max_size): PypiCache}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, directory, ttl, max_size):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self._size = None  # bytes, None until the directory is scanned
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls):
+        """ Get cache configured in Config or None if the cache is off.
+
+        The packages of a run share the cache of the same configuration.
+        """
+        if not Config.PYPI_CACHE_DIR:
+            return None
+        key = (os.path.expanduser(Config.PYPI_CACHE_DIR),
+               int(Config.PYPI_CACHE_TTL), int(Config.PYPI_CACHE_MAX_SIZE))
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(*key)
+            return cls._instances[key]
+
+    def load(self, index_url, name):
+        # type: (str, str) -> dict
+        """ Get cached entry or None. """
+        try:
+            with open(self._path(index_url, name), encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('format') != self.FORMAT_VERSION:
+            return None
+        return entry
+
+    def store(self, index_url, name, releases, etag=None,
+              last_modified=None, url=None):
+        """ Save parsed releases with the validators of the response.
+
+        url is the address the validators belong to.
+        """
+        entry = {
+            'format': self.FORMAT_VERSION,
+            'releases': releases,
+            'etag': etag,
+            'last_modified': last_modified,
+            'url': url,
+            'fetched': time.time(),
+        }
+        self._write(self._path(index_url, name), entry)
+        return entry
+
+    def load_requires(self, index_url, name, version):
+        # type: (str, str, str) -> list
+        """ Get cached requires-dist of the release or None.
+
+        Metadata of a release never changes, so it is always fresh.
+        """
+        try:
+            with open(self._requires_path(index_url, name, version),
+                      encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('format') != self.FORMAT_VERSION:
+            return None
+        return entry['requires']
+
+    def store_requires(self, index_url, name, version, requires):
+        self._write(self._requires_path(index_url, name, version),
+                    {'format': self.FORMAT_VERSION, 'requires': requires})
+
+    def touch(self, index_url, name, entry):
+        """ Mark the entry as revalidated now. """
+        return self.store(index_url, name, entry['releases'],
+                          entry.get('etag'), entry.get('last_modified'),
+                          entry.get('url'))
+
+    def is_fresh(self, entry):
+        return time.time() - entry.get('fetched', 0) < self.ttl
+
+    def evict(self, size=None):
+        """ Remove the least recently fetched entries above the size limit
+        or above size. """
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for file_name in names:
+                path = os.path.join(root, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        limit = self.max_size if size is None else size
+        total_size = sum(file_size for _, file_size, _ in files)
+        for _, file_size, path in sorted(files):
+            if total_size <= limit:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= file_size
+            logger.debug(f'pypi cache: evict {path}')
+        with self._lock:
+            self._size = total_size
+
+    def _write(self, path, data):
+        """ Write the json entry and evict the old ones if the cache is
+        full. """
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # write to a unique temporary file, so a reader never sees a
+        # partial entry and the concurrent writers of the entry don't mix
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            size = os.path.getsize(tmp_path)
+            try:
+                replaced = os.path.getsize(path)
+            except OSError:
+                replaced = 0
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        with self._lock:
+            counted = self._size is not None
+            if counted:
+                self._size += size - replaced
+            full = not counted or self._size > self.max_size
+        if full:
+            # the first write of the run counts the size of the cache
+            self.evict(int(self.max_size * self.EVICT_TO) if counted
+                       else None)
+
+    def _path(self, index_url, name):
+        index_dir = hashlib.sha1(index_url.encode()).hexdigest()[:16]
+        return os.path.join(self.directory, index_dir,
+                            canonicalize_name(name) + '.json')
+
+    def _requires_path(self, index_url, name, version):
+        index_dir = hashlib.sha1(index_url.encode()).hexdigest()[:16]
+        return os.path.join(self.directory, index_dir, 'requires',
+                            f'{canonicalize_name(name)}-{version}.json')
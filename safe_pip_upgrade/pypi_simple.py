@@ -0,0 +1,175 @@
+"""
+Streaming parser of the PEP 691 json simple API.
+
+Simple API documents list every file of every release, for the big
+projects they are megabytes of data. The parser reads the "files" array
+item by item and keeps only versions with the yanked and requires-python
+flags.
+"""
+import codecs
+import json
+import re
+from collections import namedtuple
+
+try:
+    from packaging.utils import canonicalize_name
+    from packaging.version import InvalidVersion, Version
+except ImportError:
+    # noinspection PyProtectedMember,PyCompatibility
+    from pip._vendor.packaging.utils import canonicalize_name
+    # noinspection PyProtectedMember,PyCompatibility
+    from pip._vendor.packaging.version import InvalidVersion, Version
+
+CONTENT_TYPE = 'application/vnd.pypi.simple.v1+json'
+
+SDIST_EXTENSIONS = ('.tar.gz', '.tar.bz2', '.tar.xz', '.tar', '.tgz',
+                    '.zip')
+
+# release of the package with the flags aggregated over its files,
+# wheels are compact tags "python-abi-platform" of its wheel files
+Release = namedtuple('Release', 'version yanked requires_python wheels',
+                     defaults=((),))
+
+_FILES_KEY_RE = re.compile(r'"files"\s*:\s*\[')
+_SEPARATORS = ' \t\r\n,'
+
+
+def iter_files(chunks):
+    """ Yield items of the "files" array from chunks of json bytes. """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    in_files = False
+    for chunk in chunks:
+        buffer += text_decoder.decode(chunk)
+        if not in_files:
+            match = _FILES_KEY_RE.search(buffer)
+            if not match:
+                # keep the tail, the key may be split between chunks
+                buffer = buffer[-32:]
+                continue
+            buffer = buffer[match.end():]
+            in_files = True
+
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in _SEPARATORS:
+                pos += 1
+            if buffer.startswith(']', pos):
+                return
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # the item is not received completely
+                break
+            yield item
+        buffer = buffer[pos:]
+
+    raise ValueError('Unexpected end of the simple API document')
+
+
+def version_from_filename(name, filename):
+    # type: (str, str) -> str
+    """ Get version from the distribution file name or None. """
+    if filename.endswith(('.whl', '.egg')):
+        parts = filename.split('-')
+        return parts[1] if len(parts) > 2 else None
+
+    for extension in SDIST_EXTENSIONS:
+        if filename.endswith(extension):
+            base = filename[:-len(extension)]
+            break
+    else:
+        return None
+
+    # the project name may contain dashes, so compare all the prefixes
+    canonical_name = canonicalize_name(name)
+    for pos, char in enumerate(base):
+        if char == '-' and canonicalize_name(base[:pos]) == canonical_name:
+            return base[pos + 1:]
+    return None
+
+
+def platform_family(platform):
+    # type: (str) -> str
+    """ Reduce the wheel platform tag to the family of platforms. """
+    for prefix, family in (('manylinux', 'manylinux'),
+                           ('linux', 'manylinux'),
+                           ('musllinux', 'musllinux'),
+                           ('macosx', 'macosx'),
+                           ('win', 'win')):
+        if platform.startswith(prefix):
+            return family
+    return platform
+
+
+def wheel_tags(filename):
+    # type: (str) -> list
+    """ Get compact "python-abi-platform" tags of the wheel file.
+
+    The abi is reduced to "none", "abi3" or "cp" (an interpreter specific
+    abi), the platform to its family.
+    """
+    if not filename.endswith('.whl'):
+        return []
+    parts = filename[:-len('.whl')].split('-')
+    if len(parts) < 5:
+        return []
+    python, abi, platforms = parts[-3:]
+    if abi not in ('none', 'abi3'):
+        abi = 'cp'
+    families = {platform_family(p) for p in platforms.split('.')}
+    return [f'{python}-{abi}-{family}' for family in sorted(families)]
+
+
+def releases_from_files(name, files):
+    """ Aggregate files of the simple API to the list of releases. """
+    grouped = {}
+    for file in files:
+        filename = file.get('filename', '')
+        version = version_from_filename(name, filename)
+        if version is None:
+            continue
+        grouped.setdefault(version, []).append(
+            (bool(file.get('yanked')), file.get('requires-python') or None,
+             wheel_tags(filename)))
+    return releases_from_groups(grouped)
+
+
+def releases_from_legacy(releases):
+    """ Get the list of releases from the legacy json API "releases". """
+    return releases_from_groups({
+        version: [(bool(file.get('yanked')),
+                   file.get('requires_python') or None,
+                   wheel_tags(file.get('filename', '')))
+                  for file in files]
+        for version, files in releases.items()
+    })
+
+
+def releases_from_groups(grouped):
+    """ Get releases from {version: [(yanked, requires_python, wheel tags),
+    ...]}.
+
+    The release is yanked if all its files are yanked. Requires-python is
+    known only if all the files agree on it.
+    """
+    releases = {}
+    for raw_version, flags in grouped.items():
+        try:
+            version = str(Version(raw_version))
+        except InvalidVersion:
+            continue
+        flags.extend(releases.pop(version, ()))
+        releases[version] = flags
+
+    result = []
+    for version, flags in releases.items():
+        yanked = bool(flags) and all(yanked for yanked, _, _ in flags)
+        requires_python = {value for _, value, _ in flags}
+        wheels = {tag for _, _, tags in flags for tag in tags}
+        result.append(Release(
+            version, yanked,
+            requires_python.pop() if len(requires_python) == 1 else None,
+            tuple(sorted(wheels))))
+    return result
@@ -0,0 +1,104 @@
+import sys
+from bisect import bisect_left, bisect_right
+
+from safe_pip_upgrade.pypi_simple import Release
+
+try:
+    from packaging.version import Version
+except ImportError:
+    # noinspection PyProtectedMember,PyCompatibility
+    from pip._vendor.packaging.version import Version
+
+
+def version_key(version):
+    # type: (Version) -> tuple
+    """ Get compact sort key of the version.
+
+    The key orders versions as PEP 440 does, local versions are not
+    supported because pypi doesn't accept them.
+    """
+    release = version.release
+    while release and release[-1] == 0:
+        release = release[:-1]
+
+    if (version.pre is None and version.post is None and
+            version.dev is not None):
+        # 1.0.dev0 is before 1.0a0
+        pre = (0,)
+    elif version.pre is None:
+        pre = (2,)
+    else:
+        pre = (1,) + version.pre
+
+    post = -1 if version.post is None else version.post
+    dev = (1,) if version.dev is None else (0, version.dev)
+    return version.epoch, release, pre, post, dev
+
+
+class ReleaseTable:
+    """ Sorted final releases of the package.
+
+    Versions are parsed once, the table keeps only their canonical strings
+    and sort keys. Exact versions are found by the position map, other
+    versions (e.g. "0.5.0" for "0.5" or a pinned pre-release) by bisect.
+    """
+    __slots__ = ('versions', 'keys', 'positions', 'yanked',
+                 'requires_python', 'wheels')
+
+    def __init__(self, releases=()):
+        rows = []
+        for release in releases:
+            version, yanked, requires_python, wheels = Release(*release)
+            parsed = Version(version)
+            if parsed.is_prerelease:
+                continue
+            if requires_python:
+                requires_python = sys.intern(requires_python)
+            wheels = tuple(sys.intern(tag) for tag in wheels)
+            rows.append((version_key(parsed), str(parsed), bool(yanked),
+                         requires_python, wheels))
+        rows.sort(key=lambda row: row[0])
+        self._set_rows(rows)
+
+    def _set_rows(self, rows):
+        self.keys = tuple(row[0] for row in rows)
+        self.versions = tuple(row[1] for row in rows)
+        self.yanked = tuple(row[2] for row in rows)
+        self.requires_python = tuple(row[3] for row in rows)
+        self.wheels = tuple(row[4] for row in rows)
+        self.positions = {v: i for i, v in enumerate(self.versions)}
+
+    def select(self, positions):
+        """ Get a table of the releases on positions. """
+        table = ReleaseTable()
+        table._set_rows([
+            (self.keys[i], self.versions[i], self.yanked[i],
+             self.requires_python[i], self.wheels[i]) for i in positions])
+        return table
+
+    def __len__(self):
+        return len(self.versions)
+
+    def __getitem__(self, position):
+        # type: (int) -> str
+        return self.versions[position]
+
+    def __iter__(self):
+        return map(Release, self.versions, self.yanked, self.requires_python,
+                   self.wheels)
+
+    def bisect_left(self, version):
+        # type: (str) -> int
+        """ Get position of the first release that is not less. """
+        position = self.positions.get(version)
+        if position is not None:
+            return position
+        return bisect_left(self.keys, version_key(Version(version)))
+
+    def bisect_right(self, version):
+        # type: (str) -> int
+        """ Get position of the first release that is greater. """
+        position = self.positions.get(version)
+        if position is not None:
+            return position + 1
+        return bisect_right(self.keys, version_key(Version(version)))
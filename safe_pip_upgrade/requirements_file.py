@@ -2,6 +2,8 @@ import logging
 import os
 from shutil import copy
 
+from safe_pip_upgrade.tracing import tracer
+
 logger = logging.getLogger(__name__)
 
 
@@ -23,19 +25,33 @@ class RequirementsLocal:
         """ Write requirements file. """
         # type (list) -> None
         logger.debug(f'write requirements')
-        with open(self.full_name, 'w', newline='\n', encoding='utf-8') as f:
+        with tracer.span('requirements.write', file=self.full_name,
+                         lines=len(requirements)), \
+                open(self.full_name, 'w', newline='\n',
+                     encoding='utf-8') as f:
             f.writelines(requirements)
 
     def copy_file(self, from_suffix, to_suffix):
         """ Copy requirements file with another suffix. """
-        copy(self.file_with_suffix(from_suffix),
-             self.file_with_suffix(to_suffix))
+        source = self.file_with_suffix(from_suffix)
+        target = self.file_with_suffix(to_suffix)
+        with tracer.span('requirements.copy', source=source, target=target):
+            copy(source, target)
 
     def file_with_suffix(self, suffix):
         """ Give file name with a suffix. """
         return os.path.join(self.path,
                             self.name + suffix + '.' + self.extension)
 
+    def with_suffix(self, suffix):
+        """ Get manager of the requirements file with a suffix. """
+        return RequirementsLocal(self.file_with_suffix(suffix))
+
+    def remove(self):
+        """ Remove requirements file. """
+        if os.path.exists(self.full_name):
+            os.remove(self.full_name)
+
     def make_backup(self):
         """ Make backup. """
         i = 1
@@ -0,0 +1,435 @@
+"""
+Single pass parser of the pip requirements files.
+
+A line is scanned once by the tokens of the requirements file grammar:
+the project name with extras, version specifiers, an url after "@",
+environment markers after ";", pip options (-r, -c, --hash...) and the
+comment. The parsed line keeps the spans of the original text, so the
+upgrade rewrites only the version and the comment of a requirement and
+leaves the extras, the markers and the other specifiers as they were
+written.
+
+The -r includes are expanded in place between marker comments, so the
+trials install one self-contained file, and the upgraded lines are split
+back to their files at the end. The -c files constrain the candidate
+versions. Every file is read and parsed once per run however many files
+include it.
+"""
+import logging
+import os
+import re
+from collections import namedtuple
+
+from safe_pip_upgrade.config import Config
+from safe_pip_upgrade.requirements_file import RequirementsLocal
+
+logger = logging.getLogger(__name__)
+
+try:
+    from packaging.specifiers import InvalidSpecifier, SpecifierSet
+    from packaging.utils import canonicalize_name
+except ImportError:
+    # noinspection PyProtectedMember,PyCompatibility
+    from pip._vendor.packaging.specifiers import (InvalidSpecifier,
+                                                  SpecifierSet)
+    # noinspection PyProtectedMember,PyCompatibility
+    from pip._vendor.packaging.utils import canonicalize_name
+
+# kinds of the lines
+BLANK = 'blank'
+COMMENT = 'comment'
+REQUIREMENT = 'requirement'
+URL = 'url'  # "name @ url", a bare url or a local path
+INCLUDE = 'include'  # -r
+CONSTRAINT = 'constraint'  # -c
+OPTION = 'option'  # other pip options, e.g. --index-url
+INVALID = 'invalid'
+
+INCLUDE_OPTIONS = {'-r': INCLUDE, '--requirement': INCLUDE,
+                   '-c': CONSTRAINT, '--constraint': CONSTRAINT}
+VALUE_OPTIONS = {'-r', '--requirement', '-c', '--constraint', '-e',
+                 '--editable', '-i', '--index-url', '--extra-index-url',
+                 '-f', '--find-links', '--no-binary', '--only-binary',
+                 '--trusted-host', '--use-feature', '--hash',
+                 '--global-option', '--install-option', '--config-settings'}
+# the version of the requirement is the version of the first lower bound,
+# the upgrade replaces them with the "==" pin and keeps the upper bounds
+LOWER_BOUNDS = ('==', '===', '~=', '>=', '>')
+
+_TOKEN_RE = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<comment>(?:(?<=\s)|(?<![\s\S]))\#.*)
+  | (?P<operator>===|==|!=|~=|>=|<=|<|>)
+  | (?P<option>--[A-Za-z][\w-]*|-[A-Za-z])
+  | (?P<marker>;.*?(?=\s+\#|\s*$))
+  | (?P<at>@\s*)
+  | (?P<punctuation>[\[\],])
+  | (?P<word>(?:[^\s\#\[\],;@<>=!~]|[!~](?!=))+)
+  | (?P<error>.)
+''', re.VERBOSE)
+_VALUE_RE = re.compile(r'\s*=?\s*(\S+)')
+_URL_RE = re.compile(r'\S+')
+# bare urls and paths of the distributions
+_LOCATION_RE = re.compile(r'[\w+.-]+://|\.{0,2}[/\\]|file:')
+_REMOTE_RE = re.compile(r'[\w+.-]+://|file:')
+
+
+class Specifier(namedtuple('Specifier', 'operator version')):
+
+    def __str__(self):
+        return self.operator + self.version
+
+
+class ParsedLine(namedtuple('ParsedLine', 'kind name extras specifiers '
+                                          'url marker options value '
+                                          'comment continued text spans')):
+    """ Requirements file line.
+
+    options are the pip options of the line as (option, value) pairs,
+    value is the value of the first of them (e.g. the file of -r). spans
+    are (start, end) of the requirement and of its specifiers in text,
+    continued is True if the line ends with a backslash.
+    """
+
+    @property
+    def version(self):
+        """ Version of the requirement, see LOWER_BOUNDS, or None. """
+        return next((specifier.version for specifier in self.specifiers
+                     if specifier.operator in LOWER_BOUNDS), None)
+
+    @property
+    def other_specifiers(self):
+        """ Specifiers the "==" pin of the upgrade keeps, "!=" and the
+        upper bounds. """
+        return [specifier for specifier in self.specifiers
+                if specifier.operator not in LOWER_BOUNDS]
+
+    @property
+    def requirement(self):
+        """ Text of the line without the comment and the spaces. """
+        start, end = self.spans[0]
+        return self.text[start:end]
+
+    def with_version(self, version, comment=''):
+        # type: (str, str) -> str
+        """ Get the line pinned to the version with the comment.
+
+        The text around the specifiers is kept as written. The "<=" bound
+        of the pinned version says nothing more than the pin and is
+        dropped, the caps above the pin and "!=" are kept.
+        """
+        start, end = self.spans[0]
+        spec_start, spec_end = self.spans[1]
+        kept = [specifier for specifier in self.other_specifiers
+                if specifier.operator != '<=' or
+                not _same_version(specifier.version, version)]
+        line = (self.text[start:spec_start].rstrip() +
+                ','.join([f'=={version}'] + list(map(str, kept))) +
+                self.text[spec_end:end])
+        if comment:
+            line += ' # ' + comment
+        return line + '\n'
+
+
+def parse_line(line):
+    # type: (str) -> ParsedLine
+    """ Parse the requirements file line in one pass. """
+    text = line.rstrip('\r\n')
+    kind = name = url = marker = value = operator = None
+    extras, specifiers, options = [], [], []
+    comment = ''
+    continued = in_extras = False
+    start = end = extras_end = spec_start = spec_end = None
+
+    pos = len(text) - len(text.lstrip())
+    if _LOCATION_RE.match(text, pos):
+        match = _URL_RE.match(text, pos)
+        kind, url, start, pos = URL, match.group(), pos, match.end()
+        end = pos
+
+    while pos < len(text):
+        match = _TOKEN_RE.match(text, pos)
+        token, chunk = match.lastgroup, match.group()
+        pos = match.end()
+        if token == 'space':
+            continue
+        if token == 'comment':
+            comment = chunk[1:].strip()
+            break
+        if chunk == '\\' and not text[pos:].strip():
+            continued = True
+            break
+        if start is None:
+            start = match.start()
+        # only options follow the pip options or the options of the
+        # requirement
+        after_options = bool(options)
+
+        if token == 'option':
+            found = _VALUE_RE.match(text, pos)
+            option_value = None
+            if chunk in VALUE_OPTIONS and found:
+                option_value, pos = found.group(1), found.end()
+            options.append((chunk, option_value))
+            if kind is None:
+                kind = INCLUDE_OPTIONS.get(chunk, OPTION)
+                value = option_value
+        elif kind is None and token == 'word':
+            kind, name = REQUIREMENT, chunk
+        elif (kind == URL and token == 'marker' and marker is None and
+              not after_options):
+            marker = chunk[1:].strip()
+        elif kind != REQUIREMENT or after_options:
+            kind = INVALID
+        elif in_extras:
+            if token == 'word':
+                extras.append(chunk)
+            elif chunk == ']':
+                in_extras, extras_end = False, pos
+            elif chunk != ',':
+                kind = INVALID
+        elif operator:
+            if token == 'word':
+                specifiers.append(Specifier(operator, chunk))
+                operator, spec_end = None, pos
+            else:
+                kind = INVALID
+        elif marker is not None:
+            kind = INVALID
+        elif token == 'marker':
+            marker = chunk[1:].strip()
+        elif (chunk == '[' and extras_end is None and
+              spec_start is None and url is None):
+            in_extras = True
+        elif token == 'operator' and url is None and (
+                not specifiers or text[spec_end:match.start()].strip() == ','):
+            operator = chunk
+            if spec_start is None:
+                spec_start = match.start()
+        elif chunk == ',' and specifiers:
+            continue
+        elif token == 'at' and url is None and spec_start is None:
+            url_match = _URL_RE.match(text, pos)
+            if not url_match:
+                kind = INVALID
+                break
+            kind, url, pos = URL, url_match.group(), url_match.end()
+        else:
+            kind = INVALID
+        end = pos
+
+    if kind is None:
+        kind = COMMENT if comment else BLANK
+    elif in_extras or operator:
+        kind = INVALID
+    if start is None:
+        start = end = 0
+    if spec_start is None:
+        # the pin of the unpinned requirement is inserted after the name
+        spec_start = spec_end = extras_end or start + len(name or '')
+    return ParsedLine(kind, name, tuple(extras), tuple(specifiers), url,
+                      marker, tuple(options), value, comment, continued,
+                      text, ((start, end), (spec_start, spec_end)))
+
+
+def _same_version(version, other):
+    # type: (str, str) -> bool
+    """ Compare versions as pip does, e.g. "1.0" is "1.0.0". """
+    try:
+        return SpecifierSet('==' + version).contains(other, prereleases=True)
+    except InvalidSpecifier:
+        return version == other
+
+
+def specifier_set(specifiers):
+    # type: (list) -> SpecifierSet
+    """ Get SpecifierSet of the Specifier list, invalid ones are ignored.
+    """
+    result = SpecifierSet()
+    for specifier in specifiers:
+        try:
+            result &= SpecifierSet(str(specifier))
+        except InvalidSpecifier:
+            pass
+    return result
+
+
+class RequirementsIncludes:
+    """ -r and -c includes of the requirements file, see the module
+    docstring. """
+    BEGIN = '# >>> '  # the original line follows the marker
+    END = '# <<< '
+
+    def __init__(self):
+        self.constraints = {}  # {canonical name: SpecifierSet}
+        self._files = {}  # {real path: [(line, ParsedLine), ...]}
+        self._constrained = set()
+
+    @classmethod
+    def from_config(cls):
+        """ Get includes of the requirements or None if they are not
+        followed. """
+        if not Config.FOLLOW_INCLUDES:
+            return None
+        return cls()
+
+    def parse_file(self, path):
+        # type: (str) -> list
+        """ Get [(line, ParsedLine), ...] of the file, it is read once. """
+        path = os.path.realpath(path)
+        if path not in self._files:
+            with open(path, newline='\n', encoding='utf-8') as f:
+                self._files[path] = [(line, parse_line(line)) for line in f]
+        return self._files[path]
+
+    def expand(self, path, lines):
+        # type: (str, list) -> list
+        """ Get lines of the requirements file with its -r includes
+        expanded and collect its constraints.
+
+        A file included several times is expanded once, the lines that
+        are already expanded are kept.
+        """
+        root = os.path.realpath(path)
+        return self._expand(root, root, [(line, parse_line(line))
+                                         for line in lines], {root})
+
+    def _expand(self, root, path, entries, expanded):
+        result = []
+        # the includes of the expanded lines are relative to their files,
+        # None is the block of a rewritten line
+        files = [path]
+        for line, parsed in entries:
+            if line.startswith(self.BEGIN):
+                files.append(self._target(files[-1] or path, line))
+                if files[-1]:
+                    expanded.add(files[-1])
+                result.append(line)
+                continue
+            if line.startswith(self.END):
+                files.pop()
+                result.append(line)
+                continue
+            if not line.endswith('\n'):
+                line += '\n'
+            if (parsed.kind not in (INCLUDE, CONSTRAINT) or
+                    not self._is_local(parsed.value)):
+                result.append(line)
+                continue
+
+            # the rewritten lines are relative to the requirements file
+            target = self._resolve(files[-1] or root, parsed.value)
+            if parsed.kind == CONSTRAINT:
+                self._constrain(target)
+                relative = os.path.relpath(target, os.path.dirname(root))
+                if files[-1] is None or os.path.dirname(
+                        files[-1]) == os.path.dirname(root):
+                    result.append(line)
+                    continue
+                # the path of the constraints is relative to the file of
+                # the trials
+                body = [f'-c {relative}\n']
+            elif target in expanded:
+                body = []
+            else:
+                try:
+                    included = self.parse_file(target)
+                except OSError as e:
+                    logger.warning(f'requirements: can not include '
+                                   f'{parsed.value}: {e}')
+                    result.append(line)
+                    continue
+                expanded.add(target)
+                body = self._expand(root, target, included, expanded)
+            result.append(self.BEGIN + parsed.text + '\n')
+            result.extend(body)
+            result.append(self.END + parsed.text + '\n')
+        return result
+
+    def split(self, path, lines):
+        # type: (str, list) -> dict
+        """ Get {real path: lines} of the expanded lines. """
+        root = os.path.realpath(path)
+        files = {root: []}
+        # None is a block of the rewritten line, it is dropped
+        stack = [root]
+        for line in lines:
+            if line.startswith(self.BEGIN):
+                original = line[len(self.BEGIN):]
+                if stack[-1] is not None:
+                    files[stack[-1]].append(original)
+                target = (self._target(stack[-1], line)
+                          if stack[-1] is not None else None)
+                if target is not None:
+                    files.setdefault(target, [])
+                stack.append(target)
+            elif line.startswith(self.END):
+                stack.pop()
+            elif stack[-1] is not None:
+                files[stack[-1]].append(line)
+        return files
+
+    def write_back(self, req_file, lines):
+        """ Write the expanded lines to the requirements file and the
+        changed included files. """
+        files = self.split(req_file.full_name, lines)
+        root = os.path.realpath(req_file.full_name)
+        for path, file_lines in files.items():
+            if path == root:
+                continue
+            original = [line for line, _ in self.parse_file(path)]
+            if ([line.rstrip('\n') for line in file_lines] ==
+                    [line.rstrip('\n') for line in original]):
+                continue
+            included = RequirementsLocal(path)
+            included.make_backup()
+            included.write_lines(file_lines)
+            logger.info(f'requirements: {path} is upgraded')
+        req_file.write_lines(files[root])
+
+    def allows(self, name, version):
+        # type: (str, str) -> bool
+        """ Check the version of the package against the constraints. """
+        specifier = self.constraints.get(canonicalize_name(name))
+        return specifier is None or specifier.contains(version,
+                                                       prereleases=True)
+
+    def _constrain(self, path):
+        """ Collect the specifiers of the constraints file and of the files
+        it includes. """
+        if path in self._constrained:
+            return
+        self._constrained.add(path)
+        try:
+            entries = self.parse_file(path)
+        except OSError as e:
+            logger.warning(f'requirements: can not read constraints {path}: '
+                           f'{e}')
+            return
+        for _, parsed in entries:
+            if parsed.kind == REQUIREMENT and parsed.specifiers:
+                name = canonicalize_name(parsed.name)
+                self.constraints[name] = (
+                    self.constraints.get(name, SpecifierSet()) &
+                    specifier_set(parsed.specifiers))
+            elif (parsed.kind in (INCLUDE, CONSTRAINT) and
+                  self._is_local(parsed.value)):
+                self._constrain(self._resolve(path, parsed.value))
+
+    def _target(self, path, marker_line):
+        """ Get the file of the -r marker line or None for other lines. """
+        parsed = parse_line(marker_line[len(self.BEGIN):])
+        if parsed.kind != INCLUDE:
+            return None
+        return self._resolve(path, parsed.value)
+
+    @staticmethod
+    def _resolve(path, value):
+        """ Get real path of the include relative to the including file.
+        """
+        return os.path.realpath(os.path.join(os.path.dirname(path), value))
+
+    @staticmethod
+    def _is_local(value):
+        """ Check if the include is a local file, urls are left to pip. """
+        return bool(value) and not _REMOTE_RE.match(value)
@@ -0,0 +1,212 @@
+"""
+Offline check of the candidate versions against the other pins.
+
+Requirements (requires-dist) of the candidates and of the pinned versions
+are fetched from pypi once and evaluated with the environment markers of
+the test container. A candidate that can't be installed with the other
+pins is rejected without a trial: it "needs co-upgrade" if newer versions
+of the conflicting packages fit it, otherwise it is skipped.
+
+Requirements and verdicts are memoized for the whole run, so they are
+shared by all the packages.
+"""
+import logging
+import re
+import threading
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from safe_pip_upgrade.config import Config
+from safe_pip_upgrade.runners.incremental import requirement_pins
+
+logger = logging.getLogger(__name__)
+
+try:
+    from packaging.markers import UndefinedEnvironmentName
+    from packaging.requirements import InvalidRequirement, Requirement
+    from packaging.specifiers import SpecifierSet
+    from packaging.utils import canonicalize_name
+except ImportError:
+    # noinspection PyProtectedMember,PyCompatibility
+    from pip._vendor.packaging.markers import UndefinedEnvironmentName
+    # noinspection PyProtectedMember,PyCompatibility
+    from pip._vendor.packaging.requirements import (InvalidRequirement,
+                                                    Requirement)
+    # noinspection PyProtectedMember,PyCompatibility
+    from pip._vendor.packaging.specifiers import SpecifierSet
+    # noinspection PyProtectedMember,PyCompatibility
+    from pip._vendor.packaging.utils import canonicalize_name
+
+SKIP = 'skip'
+CO_UPGRADE = 'needs co-upgrade'
+
+_PIN_RE = re.compile(r'[^=<>!~]+==\s*([^\s=<>!~,]+)')
+
+
+class Conflict(namedtuple('Conflict', 'package version required_by '
+                                      'specifier fixable')):
+    """ required_by requires package with the specifier, but it is pinned
+    to the version. fixable means a newer version resolves the conflict.
+    """
+
+    def __str__(self):
+        return (f'{self.required_by} requires {self.package}{self.specifier}, '
+                f'{self.package}=={self.version}')
+
+
+Verdict = namedtuple('Verdict', 'status conflicts')
+
+
+def pinned_versions(lines):
+    # type: (list) -> dict
+    """ Get {canonical name: version} of the "==" pins of the lines. """
+    versions = {}
+    for name, requirement in requirement_pins(lines).items():
+        match = _PIN_RE.fullmatch(requirement.split(';')[0].strip())
+        if match:
+            versions[name] = match[1]
+    return versions
+
+
+class DependencyResolver:
+    """ Check if candidate versions can be installed with the pins.
+
+    packages is the pypi packages cache, markers are the values of the
+    environment markers of the test environment.
+    """
+
+    def __init__(self, packages, markers, workers=1):
+        self.packages = packages
+        self.markers = dict(markers, extra='')
+        self.workers = workers
+        self.rejections = Counter()
+        self._requires = {}
+        self._verdicts = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, packages, environment):
+        """ Get resolver configured in Config or None if it is off. """
+        if not Config.RESOLVE_DEPENDENCIES:
+            return None
+        if environment is None:
+            logger.warning('resolver: the test environment is unknown, '
+                           'dependencies are not checked.')
+            return None
+        return cls(packages, environment.marker_environment,
+                   int(Config.PYPI_WORKERS))
+
+    def requires(self, name, version):
+        # type: (str, str) -> dict
+        """ Get {canonical name: specifier} the release requires in the test
+        environment, None if it is unknown. """
+        key = (canonicalize_name(name), version)
+        if key in self._requires:
+            return self._requires[key]
+        try:
+            lines = self.packages.get_package(name).get_requires(version)
+        except ConnectionError:
+            lines = None
+        requires = None if lines is None else self._parse(lines)
+        with self._lock:
+            return self._requires.setdefault(key, requires)
+
+    def _parse(self, lines):
+        requires = {}
+        for line in lines:
+            try:
+                requirement = Requirement(line)
+                if (requirement.marker and
+                        not requirement.marker.evaluate(self.markers)):
+                    continue
+            except (InvalidRequirement, UndefinedEnvironmentName):
+                # an unknown requirement must not reject the candidate
+                continue
+            name = canonicalize_name(requirement.name)
+            requires[name] = (requires.get(name, SpecifierSet()) &
+                              requirement.specifier)
+        return requires
+
+    def prefetch(self, releases):
+        """ Get requirements of the (name, version) releases concurrently.
+        """
+        releases = [(name, version) for name, version in releases if
+                    (canonicalize_name(name), version) not in self._requires]
+        if not releases:
+            return
+        with ThreadPoolExecutor(self.workers) as executor:
+            list(executor.map(lambda release: self.requires(*release),
+                              releases))
+
+    def check(self, name, version, pins):
+        # type: (str, str, dict) -> Verdict
+        """ Check the candidate against {canonical name: version} pins.
+
+        None means the candidate may be installed with the pins or its
+        requirements are unknown.
+        """
+        name = canonicalize_name(name)
+        pins = {package: pinned for package, pinned in pins.items()
+                if package != name}
+        key = (name, version, frozenset(pins.items()))
+        if key in self._verdicts:
+            return self._verdicts[key]
+
+        self.prefetch([(name, version)] + list(pins.items()))
+        conflicts = []
+        for package, specifier in (self.requires(name, version) or {}).items():
+            pinned = pins.get(package)
+            if pinned and not specifier.contains(pinned, prereleases=True):
+                conflicts.append(Conflict(
+                    package, pinned, name, specifier,
+                    self._newer_fits(package, pinned, specifier)))
+        for package, pinned in pins.items():
+            specifier = (self.requires(package, pinned) or {}).get(name)
+            if specifier and not specifier.contains(version, prereleases=True):
+                conflicts.append(Conflict(
+                    name, version, package, specifier,
+                    self._latest_allows(package, pinned, name, version)))
+
+        verdict = None
+        if conflicts:
+            fixable = all(conflict.fixable for conflict in conflicts)
+            verdict = Verdict(CO_UPGRADE if fixable else SKIP, conflicts)
+        with self._lock:
+            self._verdicts[key] = verdict
+            if verdict:
+                self.rejections[verdict.status] += 1
+        return verdict
+
+    def prune(self, name, versions, pins):
+        # type: (str, list, dict) -> dict
+        """ Get {version: verdict} of the versions that can't be installed
+        with the pins. """
+        self.prefetch([(name, version) for version in versions])
+        verdicts = {version: self.check(name, version, pins)
+                    for version in versions}
+        return {version: verdict for version, verdict in verdicts.items()
+                if verdict}
+
+    def _candidates(self, name):
+        try:
+            return self.packages.get_package(name).candidates
+        except ConnectionError:
+            return None
+
+    def _newer_fits(self, package, pinned, specifier):
+        """ Check if a newer version of the package fits the specifier. """
+        candidates = self._candidates(package)
+        if not candidates:
+            return False
+        return any(specifier.contains(version, prereleases=True) for version
+                   in candidates.versions[candidates.bisect_right(pinned):])
+
+    def _latest_allows(self, package, pinned, name, version):
+        """ Check if the latest version of the package allows the version
+        of name. """
+        candidates = self._candidates(package)
+        if (not candidates or
+                candidates.bisect_right(pinned) == len(candidates)):
+            return False
+        specifier = (self.requires(package, candidates[-1]) or {}).get(name)
+        return not specifier or specifier.contains(version, prereleases=True)
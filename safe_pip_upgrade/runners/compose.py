@@ -1,15 +1,39 @@
+import json
 import logging
+import posixpath
+import shlex
 import subprocess
+import threading
+import time
 
 from safe_pip_upgrade.core.upgrade import RunnerException
+from safe_pip_upgrade.environment import ENVIRONMENT_SCRIPT, TargetEnvironment
+from safe_pip_upgrade.impact import TOP_LEVEL_SCRIPT
+from safe_pip_upgrade.metrics import metrics
+from safe_pip_upgrade.runners.docker_api import DockerApiError, DockerClient
+from safe_pip_upgrade.runners.incremental import Installer
+from safe_pip_upgrade.runners.output import FailureMatcher, OutputMonitor, \
+    follow
+from safe_pip_upgrade.runners.pool import worker_suffix
+from safe_pip_upgrade.runners.watcher import ContainerWatcher, cli_events
+from safe_pip_upgrade.stages import TrialPipeline
+from safe_pip_upgrade.tracing import tracer
+from safe_pip_upgrade.wheelhouse import Wheelhouse, find_links
 
 logger = logging.getLogger(__name__)
 
+DOCKER_TIMEOUT = 60 * 10
+# restarts of the container died during a step before the runner gives up
+RESTART_ATTEMPTS = 2
+# a failed step waits so long for the die event of the container
+DEATH_GRACE = 1.0
+
 
 class ComposeRunner:
     requirements_file_name = 'requirements.txt'
+    _image_id = None
 
-    def __init__(self, config):
+    def __init__(self, config, worker=None, pipeline=None):
         self.config = config
         self.remote_work_dir = config.COMPOSE_WORK_DIR
         self.project_folder = config.COMPOSE_PROJECT_FOLDER
@@ -17,36 +41,298 @@ class ComposeRunner:
         self.requirements_file_name = config.COMPOSE_REQUIREMENTS_FILE.replace(
             r'\\', '/')
         self.daemon_name = self.service_name + '_upgrade'
+        if worker is not None:
+            # pool worker has its own container and requirements file
+            self.daemon_name += f'_{worker}'
+            root, extension = posixpath.splitext(self.requirements_file_name)
+            self.requirements_file_name = (root + worker_suffix(worker) +
+                                           extension)
+        # stages are shared with the pool workers to count them together
+        self.pipeline = pipeline or TrialPipeline.from_config(config)
+        # the stage is aborted on the first output line of a failure
+        self.failure_matcher = FailureMatcher.from_config(config)
+        # the stage cut short by the patterns or the deadline is left
+        # running in the container, its pid is saved to kill it
+        self.pid_file = None
+        if self.failure_matcher or self.pipeline.deadlines:
+            self.pid_file = f'/tmp/{self.daemon_name}.pid'
+        self.wheelhouse = Wheelhouse.from_config()
+        self.wheelhouse_dir = config.COMPOSE_WHEELHOUSE_DIR
+        # trial pins are installed to the layer over the baseline packages
+        self.layer_dir = (config.COMPOSE_SNAPSHOT_DIR
+                          if config.COMPOSE_SNAPSHOT else None)
+        self.installer = Installer(
+            self._pip_install_all, self._pip_install_pins, self._pip_check,
+            reset_layer=self._reset_layer if self.layer_dir else None,
+            merge_layer=self._merge_layer if self.layer_dir else None)
+        # the engine API is used instead of the docker CLI if it is set
+        self.docker = DockerClient.from_config(config)
+        # liveness of the container is kept by its events
+        self.watcher = None
+        self.watch_events = config.COMPOSE_WATCH_EVENTS
+        self.restarts = []  # time lost by every restart
+        self._requirements = None
+        self._processes = set()
+        self._lock = threading.Lock()
         self._docker_up()
 
-    def run_tests(self):
-        self._check_or_run_daemon()
-        params = (f'exec {self.daemon_name} pip install -r '
-                  f'{self.requirements_file_name}').split(' ')
-        code = self._run_docker(*params).returncode
+    def spawn(self, worker):
+        """ Create runner of the pool worker. """
+        return ComposeRunner(self.config, worker=worker,
+                             pipeline=self.pipeline)
 
-        logger.info(f'docker: install requirements, return code {code}')
-        if code:
+    def run_tests(self, requirements=None, command=None):
+        """ Install requirements lines and run the tests.
+
+        Without the lines the whole requirements file is installed, without
+        the command the test start command is run.
+        """
+        return self.install(requirements) and self.test(command)
+
+    def install(self, requirements=None):
+        """ Install requirements lines. """
+        self._requirements = requirements
+        with metrics.phase('install'):
+            return self._restart_on_death(self._install, requirements)
+
+    def _install(self, requirements):
+        self._check_or_run_daemon()
+        if not self.installer.install(requirements):
             logger.error('docker: failed to install requirements.')
             return False
+        return True
 
+    def install_baseline(self, requirements, req_file):
+        """ Install the original requirements lines of req_file under the
+        layer of the trials, True if there is no layer. """
+        if not self.layer_dir:
+            return True
+        req_file.write_lines(requirements)
+        with metrics.phase('install'):
+            self._check_or_run_daemon()
+            return self.installer.install_baseline(requirements)
+
+    def test(self, command=None):
+        """ Run the stages and the tests with the installed requirements.
+
+        An empty command means there are no tests to run, the stages are
+        run anyway.
+        """
+        passed = self._restart_on_death(self._test, command)
+        if passed:
+            self.installer.passed()
+        return passed
+
+    def _test(self, command):
+        if command is None:
+            command = self.config.TEST_START_COMMAND
         self._check_or_run_daemon()
         logger.info(f'docker: start tests')
-        code = self._run_docker(
-            'exec', self.daemon_name, *self.config.TEST_START_COMMAND.split()
-        ).returncode
-        logger.info(f'docker: tests done, return code {code}')
+        passed = self.pipeline.run(self._run_stage, command, time.monotonic)
+        logger.info(f'docker: tests done, {"passed" if passed else "failed"}')
+        return passed
+
+    def _restart_on_death(self, step, *args):
+        """ Run the step in a new container if the container dies during
+        it, the tests need the requirements to be installed again. """
+        started = time.monotonic()
+        for attempt in range(RESTART_ATTEMPTS + 1):
+            deaths = self.watcher.deaths if self.watcher else None
+            try:
+                passed = step(*args)
+            except DockerApiError:
+                # the stream of the dead container is broken
+                if not self._died(deaths, False):
+                    raise
+            else:
+                if not self._died(deaths, passed):
+                    return passed
+            if attempt == RESTART_ATTEMPTS:
+                break
+            logger.warning('docker: the container died during the step, '
+                           'restart it.')
+            self._docker_up()
+            if step == self._test and not self._install(self._requirements):
+                return False
+            self._count_restart(started)
+            started = time.monotonic()
+        logger.error('docker: the container dies again and again!')
+        raise DockerException()
+
+    def _died(self, deaths, passed):
+        """ Check if the container died after the deaths count. """
+        if deaths is None:
+            return False
+        if self.watcher.deaths != deaths:
+            return True
+        # the step may fail before the die event comes
+        return (not passed and self.watcher.watching and
+                self.watcher.wait_death(deaths, DEATH_GRACE))
+
+    def _count_restart(self, started):
+        lost = time.monotonic() - started
+        self.restarts.append(lost)
+        metrics.observe('restart', lost)
+        logger.info(f'docker: the container is restarted, {lost:.0f}s lost')
+
+    def _run_stage(self, stage):
+        monitor = (OutputMonitor(self.failure_matcher)
+                   if self.failure_matcher else None)
+        try:
+            code = self._exec(*self._stage_command(stage.command),
+                              timeout=stage.timeout or DOCKER_TIMEOUT,
+                              on_output=monitor and monitor.feed).returncode
+        except subprocess.TimeoutExpired:
+            logger.info(f'docker: {stage.name} timed out')
+            self._kill_stage()
+            return False
+        if monitor and monitor.failure:
+            logger.info(f'docker: {stage.name} aborted on '
+                        f'"{monitor.failure}"')
+            self._kill_stage()
+            return False
+        if monitor and monitor.close():
+            logger.info(f'docker: {stage.name} failed on "{monitor.failure}"')
+            return False
+        logger.info(f'docker: {stage.name} done, return code {code}')
         return code == 0
 
+    def _stage_command(self, command):
+        """ Get command of the stage that saves its pid in the container.
+        """
+        args = self._with_layer(shlex.split(command))
+        if not self.pid_file:
+            return args
+        return ['sh', '-c', 'echo $$ > "$0" && exec "$@"', self.pid_file,
+                *args]
+
+    def _kill_stage(self):
+        """ Kill the aborted stage, it is left running in the container. """
+        if not self.pid_file:
+            return
+        try:
+            self._exec('sh', '-c', 'kill -9 "$(cat "$0")"', self.pid_file,
+                       capture_output=True)
+        except (DockerApiError, subprocess.SubprocessError) as e:
+            logger.warning(f'docker: can not kill the aborted stage: {e}')
+
+    def log_stats(self):
+        logger.info(f'docker: install: {self.installer.stats}')
+        if self.docker:
+            logger.info(f'docker: api: {self.docker.stats}')
+        if self.restarts:
+            logger.info(
+                f'docker: {len(self.restarts)} container restarts, '
+                f'{sum(self.restarts):.0f}s lost ('
+                + ', '.join(f'{lost:.0f}s' for lost in self.restarts) + ')')
+        self.pipeline.log_stats()
+
+    def freeze(self):
+        """ Get pip freeze of the installed requirements. """
+        result = self._exec(*self._with_layer(['pip', 'freeze', '--all']),
+                            capture_output=True)
+        return result.stdout.decode()
+
+    def top_level_map(self):
+        """ Get {top-level module: [distribution, ...]} of the container.
+        """
+        self._check_or_run_daemon()
+        result = self._exec(*self._with_layer(
+            ['python', '-c', TOP_LEVEL_SCRIPT]), capture_output=True)
+        if result.returncode:
+            logger.warning('docker: can not get the top-level modules.')
+            return {}
+        return json.loads(result.stdout.decode())
+
+    def image_id(self):
+        """ Get id of the image the test container is created from. """
+        if self._image_id is None and self.docker:
+            info = self.docker.inspect(self.daemon_name)
+            self._image_id = info['Image'] if info else ''
+        if self._image_id is None:
+            result = self._run_docker('inspect', '--format', '{{.Image}}',
+                                      self.daemon_name, capture_output=True)
+            self._image_id = result.stdout.decode().strip()
+        return self._image_id
+
+    def download_wheel(self, pin):
+        """ Build wheel of the pin into the wheelhouse. """
+        result = self._exec('pip', 'wheel', '--no-deps', '--quiet', '-w',
+                            self.wheelhouse_dir, pin, capture_output=True)
+        logger.debug(f'docker: download {pin}, return code '
+                     f'{result.returncode}')
+        return result.returncode == 0
+
+    def _find_links(self, pins=None):
+        """ Get pip options to install from the wheelhouse. """
+        return find_links(self.wheelhouse, self.wheelhouse_dir, pins)
+
+    def _pip_install_all(self):
+        code = self._exec('pip', 'install', '-r', self.requirements_file_name,
+                          *self._find_links()).returncode
+        logger.info(f'docker: install requirements, return code {code}')
+        return code == 0
+
+    def _pip_install_pins(self, pins):
+        target = ['--target', self.layer_dir] if self.layer_dir else []
+        code = self._exec('pip', 'install', '--no-deps', *target,
+                          *self._find_links(pins), *pins).returncode
+        logger.info(f'docker: install {len(pins)} pins, return code {code}')
+        return code == 0
+
+    def _pip_check(self):
+        code = self._exec(*self._with_layer(['pip', 'check'])).returncode
+        logger.info(f'docker: check requirements, return code {code}')
+        return code == 0
+
+    def _reset_layer(self):
+        """ Drop the packages of the previous trial. """
+        self._exec('rm', '-rf', self.layer_dir)
+
+    def _merge_layer(self, pins):
+        """ Install the pins of the passed trial to the baseline packages.
+        """
+        code = self._exec('pip', 'install', '--no-deps',
+                          *self._find_links(pins), *pins).returncode
+        logger.info(f'docker: merge {len(pins)} pins to the baseline, '
+                    f'return code {code}')
+        return code == 0
+
+    def _with_layer(self, args):
+        """ Get command that sees the packages of the layer first. """
+        if not self.layer_dir:
+            return list(args)
+        return ['sh', '-c', 'PYTHONPATH="$0${PYTHONPATH:+:$PYTHONPATH}" '
+                            'exec "$@"', self.layer_dir, *args]
+
+    def get_environment(self):
+        """ Get interpreter and platform of the container. """
+        self._check_or_run_daemon()
+        result = self._exec('python', '-c', ENVIRONMENT_SCRIPT,
+                            capture_output=True)
+        if result.returncode:
+            logger.warning('docker: can not get the python environment.')
+            return None
+        environment = TargetEnvironment.from_json(result.stdout.decode())
+        logger.info(f'docker: test environment {environment}')
+        return environment
+
     def _docker_up(self):
+        # the new container has the packages of the image
+        self.installer.reset()
+        self._image_id = None
         self._delete_test_container()
         params = ['-d', '--name', self.daemon_name]
         if self.remote_work_dir:
             params.extend(['-w', self.remote_work_dir])
-        code = self._run_compose(
-            'run',
-            params,
-            args=['sleep', str(60 * 60 * 10)]).returncode
+        if self.wheelhouse:
+            params.extend(['-v', f'{self.wheelhouse.directory}:'
+                                 f'{self.wheelhouse_dir}'])
+        with metrics.phase('container_up'):
+            code = self._run_compose(
+                'run',
+                params,
+                args=['sleep', str(60 * 60 * 10)]).returncode
         logger.info(f'docker: up, return code {code}')
         return code == 0
 
@@ -54,17 +340,66 @@ class ComposeRunner:
         self._run_docker('rm', self.daemon_name, '-f')
 
     def _check_daemon(self):
+        if self.docker:
+            return self.docker.is_running(self.daemon_name)
         options = ['-f', f'name={self.daemon_name}']
         result = self._run_docker('ps', *options, capture_output=True)
         return self.daemon_name.encode() in result.stdout
 
     def _check_or_run_daemon(self):
+        if self._is_alive():
+            return
+        logger.info('docker: check container: stopped, restart.')
+        started = time.monotonic()
+        self._docker_up()
         if not self._check_daemon():
-            logger.info('docker: check container: stopped, restart.')
-            self._docker_up()
-            if not self._check_daemon():
-                logger.error('docker: container is stopped after restart!')
-                raise DockerException()
+            logger.error('docker: container is stopped after restart!')
+            raise DockerException()
+        if self.watcher:
+            self.watcher.set_alive(True)
+        self._count_restart(started)
+
+    def _is_alive(self):
+        """ Get liveness of the container from its events, docker is
+        polled only if it is unknown. """
+        if self.watch_events and not (self.watcher and self.watcher.watching):
+            self._watch()
+        if (self.watcher and self.watcher.watching and
+                self.watcher.alive is not None):
+            return self.watcher.alive
+        alive = self._check_daemon()
+        if self.watcher:
+            self.watcher.set_alive(alive)
+        return alive
+
+    def _watch(self):
+        """ Follow the events of the container in background. """
+        if self.watcher:
+            self.watcher.stop()
+        filters = {'container': [self.daemon_name], 'type': ['container']}
+        if self.docker:
+            watcher = ContainerWatcher(lambda: self.docker.events(filters),
+                                       on_die=self._abort_steps)
+        else:
+            watcher = ContainerWatcher(lambda: cli_events(self.daemon_name),
+                                       on_die=self._abort_steps)
+        try:
+            watcher.start()
+        except (OSError, DockerApiError) as e:
+            logger.warning(f'docker: can not follow the container events, '
+                           f'it is polled: {e}')
+            self.watch_events = False
+            return
+        self.watcher = watcher
+
+    def _abort_steps(self):
+        """ Stop the commands of the dead container. """
+        if self.docker:
+            self.docker.abort()
+        with self._lock:
+            processes = list(self._processes)
+        for process in processes:
+            process.kill()
 
     def _run_compose(self, command, options=(), args=()):
         run_params = ['docker-compose']
@@ -73,16 +408,72 @@ class ComposeRunner:
         run_params.append(self.service_name)
         run_params.extend(args)
         logger.info(f'>>{" ".join(run_params)}')
-        sp = subprocess.run(run_params, check=True, timeout=20,
-                            cwd=self.project_folder)
+        with tracer.span('docker-compose', command=command,
+                         service=self.service_name) as span:
+            sp = subprocess.run(run_params, check=True,
+                                timeout=int(self.config.COMPOSE_TIMEOUT),
+                                cwd=self.project_folder)
+            span.set(exit_code=sp.returncode)
         return sp
 
-    def _run_docker(self, *options, capture_output=False):
+    def _exec(self, *args, capture_output=False, timeout=DOCKER_TIMEOUT,
+              on_output=None):
+        """ Run the command in the test container.
+
+        on_output(stream, data) gets the streamed output and returns True
+        to leave the command.
+        """
+        if self.docker:
+            logger.info(f'>>exec {self.daemon_name} {" ".join(args)}')
+            with tracer.span('docker.exec', container=self.daemon_name,
+                             args=' '.join(args)) as span:
+                result = self.docker.exec(self.daemon_name, args,
+                                          capture_output=capture_output,
+                                          timeout=timeout,
+                                          on_output=on_output)
+                span.set(exit_code=result.returncode)
+            return result
+        return self._run_docker('exec', self.daemon_name, *args,
+                                capture_output=capture_output, timeout=timeout,
+                                abortable=True, on_output=on_output)
+
+    def _run_docker(self, *options, capture_output=False,
+                    timeout=DOCKER_TIMEOUT, abortable=False, on_output=None):
+        """ Run the docker CLI, abortable processes are killed when the
+        container dies. """
         run_params = ['docker', *options]
         logger.info(f'>>{" ".join(run_params)}')
-        daemon = subprocess.run(run_params, timeout=60 * 10,
-                                capture_output=capture_output)
-        return daemon
+        with tracer.span('docker', command=options[0],
+                         args=' '.join(options[1:])) as span:
+            result = self._popen_docker(run_params, capture_output, timeout,
+                                        abortable, on_output)
+            span.set(exit_code=result.returncode)
+        return result
+
+    def _popen_docker(self, run_params, capture_output, timeout, abortable,
+                      on_output):
+        pipe = subprocess.PIPE if capture_output or on_output else None
+        # the output is followed line by line as the merged stdout
+        stderr = subprocess.STDOUT if on_output else pipe
+        with subprocess.Popen(run_params, stdout=pipe,
+                              stderr=stderr) as process:
+            if abortable:
+                with self._lock:
+                    self._processes.add(process)
+            try:
+                if on_output:
+                    stdout = stderr = None
+                    follow(process, on_output, timeout)
+                else:
+                    stdout, stderr = process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                raise
+            finally:
+                with self._lock:
+                    self._processes.discard(process)
+        return subprocess.CompletedProcess(run_params, process.returncode,
+                                           stdout, stderr)
 
 
 class DockerException(RunnerException):
@@ -0,0 +1,258 @@
+"""
+Docker Engine API client over the unix socket.
+
+The runner talks to the daemon directly instead of starting the docker CLI
+for every step: the requests reuse pooled keep-alive connections and the
+output of the commands is streamed back from the multiplexed exec stream.
+"""
+import http.client
+import json
+import logging
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import quote, urlencode
+
+from safe_pip_upgrade.core.upgrade import RunnerException
+
+logger = logging.getLogger(__name__)
+
+API_PREFIX = '/v1.40'
+STDOUT, STDERR = 1, 2
+# return code of the exec left by the client
+ABORTED = -9
+
+
+class DockerApiError(RunnerException):
+    """ The engine is not available or answered with an error. """
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """ HTTP connection to the unix socket. """
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class CallStats:
+    """ Overhead of the exec calls: the requests around the command. """
+
+    def __init__(self):
+        self.calls = 0
+        self.overhead = 0.0
+
+    def add(self, duration):
+        self.calls += 1
+        self.overhead += duration
+
+    def __str__(self):
+        average = self.overhead / self.calls if self.calls else 0.0
+        return (f'{self.calls} exec calls, ~{average * 1000:.0f}ms '
+                f'overhead per call')
+
+
+class DockerClient:
+    """ Docker Engine API client.
+
+    Short requests share a pool of keep-alive connections. The exec stream
+    takes a connection over, so every exec gets a new one.
+    """
+
+    def __init__(self, socket_path, timeout=60):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.stats = CallStats()
+        self._idle = []
+        self._streams = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """ Get client configured in config or None to use the docker CLI.
+        """
+        if not config.COMPOSE_DOCKER_SOCKET:
+            return None
+        return cls(config.COMPOSE_DOCKER_SOCKET)
+
+    def request(self, method, path, body=None):
+        # type: (str, str, dict) -> tuple
+        """ Send the request on a pooled connection, get (status, data). """
+        payload = None if body is None else json.dumps(body).encode()
+        headers = {'Content-Type': 'application/json'} if payload else {}
+        for attempt in range(2):
+            with self._lock:
+                connection = (self._idle.pop() if self._idle else
+                              UnixHTTPConnection(self.socket_path,
+                                                 self.timeout))
+            try:
+                connection.request(method, API_PREFIX + path, payload,
+                                   headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                connection.close()
+                # the daemon may close an idle connection, try a new one
+                if attempt:
+                    raise DockerApiError(f'docker api: {method} {path}: {e}')
+                continue
+            with self._lock:
+                self._idle.append(connection)
+            if response.getheader('Content-Type', '').startswith(
+                    'application/json'):
+                data = json.loads(data) if data else None
+            return response.status, data
+
+    def _call(self, method, path, body=None, expected=(200,)):
+        status, data = self.request(method, path, body)
+        if status not in expected:
+            raise DockerApiError(f'docker api: {method} {path}: {status} '
+                                 f'{data}')
+        return data
+
+    def inspect(self, container):
+        # type: (str) -> dict
+        """ Get details of the container or None if there is no one. """
+        path = f'/containers/{quote(container)}/json'
+        status, data = self.request('GET', path)
+        if status == 404:
+            return None
+        if status != 200:
+            raise DockerApiError(f'docker api: GET {path}: {status} {data}')
+        return data
+
+    def is_running(self, container):
+        # type: (str) -> bool
+        info = self.inspect(container)
+        return bool(info and info['State']['Running'])
+
+    def exec(self, container, args, capture_output=False, timeout=None,
+             on_output=None):
+        # type: (str, list, bool, float, Callable) -> CompletedProcess
+        """ Run the command in the container.
+
+        The output is streamed to stdout and stderr or captured. The stream
+        is left as soon as on_output(stream, data) of a streamed chunk
+        returns True, the command is not stopped in the container. Raises
+        subprocess.TimeoutExpired if the command is not done in time.
+        """
+        args = list(args)
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+        exec_id = self._call(
+            'POST', f'/containers/{quote(container)}/exec',
+            {'AttachStdout': True, 'AttachStderr': True, 'Tty': False,
+             'Cmd': args}, expected=(201,))['Id']
+
+        output = {STDOUT: [], STDERR: []}
+        connection = UnixHTTPConnection(self.socket_path, self.timeout)
+        sock = None
+        try:
+            connection.request('POST', f'{API_PREFIX}/exec/{exec_id}/start',
+                               json.dumps({'Detach': False, 'Tty': False}),
+                               {'Content-Type': 'application/json'})
+            # the response takes the socket over from the connection
+            sock = connection.sock
+            with self._lock:
+                self._streams.add(sock)
+            response = connection.getresponse()
+            overhead = time.monotonic() - started
+            if response.status != 200:
+                raise DockerApiError(f'docker api: exec start: '
+                                     f'{response.status} {response.read()}')
+            for stream, data in self._frames(response, sock, deadline):
+                if capture_output:
+                    output.setdefault(stream, []).append(data)
+                    continue
+                self._write(stream, data)
+                if on_output and on_output(stream, data):
+                    logger.info(f'docker api: exec {args[0]} is aborted')
+                    return subprocess.CompletedProcess(args, ABORTED)
+        except socket.timeout:
+            raise subprocess.TimeoutExpired(args, timeout)
+        except (http.client.HTTPException, OSError) as e:
+            raise DockerApiError(f'docker api: exec {args[0]}: {e}')
+        finally:
+            with self._lock:
+                self._streams.discard(sock)
+            connection.close()
+
+        inspect_started = time.monotonic()
+        code = self._call('GET', f'/exec/{exec_id}/json')['ExitCode']
+        self.stats.add(overhead + time.monotonic() - inspect_started)
+        if not capture_output:
+            return subprocess.CompletedProcess(args, code)
+        return subprocess.CompletedProcess(args, code,
+                                           b''.join(output[STDOUT]),
+                                           b''.join(output[STDERR]))
+
+    def abort(self):
+        """ Break the exec streams in progress. """
+        with self._lock:
+            streams = list(self._streams)
+        for sock in streams:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def events(self, filters):
+        # type: (dict) -> tuple
+        """ Subscribe to the events, get (iterator of events, close()). """
+        connection = UnixHTTPConnection(self.socket_path)
+        try:
+            connection.request('GET', f'{API_PREFIX}/events?' + urlencode(
+                {'filters': json.dumps(filters)}))
+            sock = connection.sock
+            response = connection.getresponse()
+        except (http.client.HTTPException, OSError) as e:
+            connection.close()
+            raise DockerApiError(f'docker api: events: {e}')
+        if response.status != 200:
+            connection.close()
+            raise DockerApiError(f'docker api: events: {response.status}')
+
+        def close():
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            connection.close()
+
+        events = (json.loads(line) for line in response if line.strip())
+        return events, close
+
+    @staticmethod
+    def _frames(response, sock, deadline):
+        """ Iterate (stream, data) frames of the multiplexed exec stream.
+        """
+        while True:
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout()
+                sock.settimeout(remaining)
+            header = response.read(8)
+            if len(header) < 8:
+                return
+            stream, size = struct.unpack('>BxxxL', header)
+            yield stream, response.read(size)
+
+    @staticmethod
+    def _write(stream, data):
+        output = sys.stderr if stream == STDERR else sys.stdout
+        buffer = getattr(output, 'buffer', None)
+        if buffer is None:
+            output.write(data.decode(errors='replace'))
+        else:
+            output.flush()
+            buffer.write(data)
+            buffer.flush()
@@ -0,0 +1,216 @@
+"""
+Incremental installs of the requirements.
+
+Runners remember the pins they installed last time and install only the
+pins the trial changed, that skips resolving and checking the whole
+requirements file by pip on every trial.
+"""
+import logging
+import re
+import time
+
+from safe_pip_upgrade.config import Config
+
+logger = logging.getLogger(__name__)
+
+_NAME_RE = re.compile(r'([A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[[^\]]*\])?\s*'
+                      r'(==|===|~=|!=|<=|>=|<|>|;|@|$)')
+
+
+def requirement_pins(lines):
+    # type: (list) -> dict
+    """ Get {canonical name: requirement} of requirements lines.
+
+    Comments are dropped. Pip options, urls and other lines without a
+    project name are keyed by themselves.
+    """
+    pins = {}
+    for line in lines:
+        requirement = line.split(' #', 1)[0].strip()
+        if not requirement or requirement.startswith('#'):
+            continue
+        match = _NAME_RE.match(requirement)
+        if match:
+            key = re.sub(r'[-_.]+', '-', match[1]).lower()
+        else:
+            key = requirement
+        pins[key] = requirement
+    return pins
+
+
+def changed_pins(installed, pins):
+    # type: (dict, dict) -> list
+    """ Get requirements to install to move from installed to pins.
+
+    None means the change can't be installed incrementally: nothing is
+    installed yet or a line without a project name is changed.
+    """
+    if installed is None:
+        return None
+    changed = []
+    for key, pin in pins.items():
+        if installed.get(key) == pin:
+            continue
+        if key == pin and not _NAME_RE.match(pin):
+            return None
+        changed.append(pin)
+    return changed
+
+
+class InstallStats:
+    """ Install phase timing of a runner. """
+
+    def __init__(self):
+        self.full_installs = 0
+        self.full_time = 0.0
+        self.incremental_installs = 0
+        self.incremental_time = 0.0
+        self.resets = 0
+        self.reset_time = 0.0
+        self.saved_time = 0.0
+
+    @property
+    def average_full_time(self):
+        if not self.full_installs:
+            return None
+        return self.full_time / self.full_installs
+
+    def add_full(self, duration):
+        self.full_installs += 1
+        self.full_time += duration
+
+    def add_incremental(self, duration):
+        """ Count the incremental install, get the time it saved or None.
+
+        The saving is estimated by the average full install.
+        """
+        self.incremental_installs += 1
+        self.incremental_time += duration
+        if not self.full_installs:
+            return None
+        saved = self.average_full_time - duration
+        self.saved_time += saved
+        return saved
+
+    def add_reset(self, duration):
+        self.resets += 1
+        self.reset_time += duration
+
+    def __str__(self):
+        text = (f'{self.full_installs} full installs in '
+                f'{self.full_time:.0f}s, {self.incremental_installs} '
+                f'incremental in {self.incremental_time:.0f}s')
+        if self.resets:
+            text += f', {self.resets} resets in {self.reset_time:.0f}s'
+        return text + f', saved ~{self.saved_time:.0f}s'
+
+
+class Installer:
+    """ Install requirements lines changing only the changed pins.
+
+    The runner provides the callables: install_all() installs the whole
+    requirements file, install_pins(pins) installs the pins without their
+    dependencies and check() is the cheap consistency check of the
+    installed distributions. They return True on success. If the check
+    fails the dependencies moved and all the pins are installed again.
+
+    If the runner provides reset_layer() too, install_pins installs to a
+    separate layer over the baseline environment. The layer is dropped
+    before every trial, so the pins are compared with the baseline and the
+    failed trials leave nothing behind. The baseline is the original
+    requirements (see install_baseline), merge_layer(pins) moves the pins
+    of the passed trial from the layer to the baseline, so a trial installs
+    only the pins changed since the last passed one.
+    """
+
+    def __init__(self, install_all, install_pins, check, reset_layer=None,
+                 merge_layer=None, clock=time.monotonic):
+        self.install_all = install_all
+        self.install_pins = install_pins
+        self.check = check
+        self.reset_layer = reset_layer
+        self.merge_layer = merge_layer
+        self.clock = clock
+        self.installed = None
+        self.baseline = None
+        self.stats = InstallStats()
+
+    def reset(self):
+        """ The environment is changed outside, install all next time. """
+        self.installed = None
+        self.baseline = None
+
+    def install(self, requirements):
+        # type: (list) -> bool
+        """ Install requirements lines, None is the unknown requirements file.
+        """
+        pins = None if requirements is None else requirement_pins(requirements)
+        base = self.installed
+        if self.reset_layer:
+            self._reset_layer()
+            base = self.baseline
+
+        changed = None
+        if Config.INCREMENTAL_INSTALL and pins is not None:
+            changed = changed_pins(base, pins)
+
+        if changed is not None:
+            started = self.clock()
+            if not changed or self.install_pins(changed) and self.check():
+                saved = self.stats.add_incremental(self.clock() - started)
+                self.installed = pins
+                logger.info(
+                    f'install: {len(changed)} changed pins installed'
+                    + ('' if saved is None else f', saved ~{saved:.0f}s')
+                    + f' ({self.stats})')
+                return True
+            logger.info('install: dependencies moved, install all pins.')
+            if self.reset_layer:
+                self._reset_layer()
+        return self._install_all(pins)
+
+    def install_baseline(self, requirements):
+        # type: (list) -> bool
+        """ Install the original requirements lines as the baseline of the
+        layers. """
+        if self.reset_layer:
+            self._reset_layer()
+        return self._install_all(requirement_pins(requirements))
+
+    def passed(self):
+        """ The installed requirements passed the tests, merge the layer to
+        the baseline. """
+        if not self.merge_layer or self.installed is None:
+            return
+        changed = changed_pins(self.baseline, self.installed)
+        if not changed:
+            return
+        started = self.clock()
+        if self.merge_layer(changed):
+            self.baseline = self.installed
+            logger.info(f'install: {len(changed)} passed pins merged to the '
+                        f'baseline in {self.clock() - started:.1f}s')
+        else:
+            # the baseline is changed partly, install all next time
+            logger.info('install: can not merge the layer, install all '
+                        'pins next time.')
+            self.reset()
+
+    def _install_all(self, pins):
+        started = self.clock()
+        success = self.install_all()
+        self.stats.add_full(self.clock() - started)
+        self.installed = pins if success else None
+        # the layer is empty, the environment is the new baseline
+        self.baseline = self.installed
+        return success
+
+    def _reset_layer(self):
+        started = self.clock()
+        self.reset_layer()
+        duration = self.clock() - started
+        self.stats.add_reset(duration)
+        average = self.stats.average_full_time
+        logger.info(f'install: reset to the baseline in {duration:.1f}s'
+                    + ('' if average is None else
+                       f' instead of ~{average:.0f}s reinstall'))
@@ -0,0 +1,121 @@
+"""
+Live output of the trial commands.
+
+The output is echoed line by line while the command runs and every line is
+checked by the failure patterns, so the trial is aborted on the first
+certain failure (e.g. the first "FAILED" line) instead of waiting for the
+whole suite.
+"""
+import re
+import subprocess
+import sys
+import threading
+
+STDOUT = 1
+
+
+class FailureMatcher:
+    """ Regular expressions of the output lines of a failed command. """
+
+    def __init__(self, patterns):
+        self.patterns = [re.compile(pattern) for pattern in patterns]
+
+    @classmethod
+    def from_config(cls, config):
+        """ Get matcher configured in config or None if there are no
+        patterns. """
+        patterns = [line.strip() for line in
+                    (config.TEST_FAILURE_PATTERNS or '').splitlines()
+                    if line.strip()]
+        if not patterns:
+            return None
+        return cls(patterns)
+
+    def match(self, line):
+        # type: (str) -> bool
+        return any(pattern.search(line) for pattern in self.patterns)
+
+
+class OutputMonitor:
+    """ Output of a command checked line by line.
+
+    The chunks of the streams are split to lines, failure is the first line
+    matched by the matcher.
+    """
+
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self.failure = None
+        self._buffers = {}
+
+    def feed(self, stream, data):
+        # type: (int, bytes) -> bool
+        """ Check the chunk of the stream, get True if the command failed.
+        """
+        lines = (self._buffers.pop(stream, b'') + data).split(b'\n')
+        self._buffers[stream] = lines.pop()
+        for line in lines:
+            self._check(line)
+        return self.failure is not None
+
+    def close(self):
+        """ Check the unfinished lines of the ended command. """
+        for line in self._buffers.values():
+            self._check(line)
+        self._buffers.clear()
+        return self.failure is not None
+
+    def _check(self, line):
+        if self.failure is not None or not line:
+            return
+        text = line.decode(errors='replace').rstrip('\r')
+        if self.matcher.match(text):
+            self.failure = text.strip()
+
+
+def follow(process, on_output=None, timeout=None, kill=None):
+    # type: (subprocess.Popen, Callable, float, Callable) -> int
+    """ Wait for the process echoing its output, get the return code.
+
+    The output is read line by line if on_output(stream, line) is set, the
+    process stdout is the merged output then. on_output returns True to
+    abort the process. kill(process) stops the process on the abort or the
+    timeout, it is process.kill() by default. Raises
+    subprocess.TimeoutExpired if the process is not done in time.
+    """
+    kill = kill or subprocess.Popen.kill
+    expired = threading.Event()
+
+    def expire():
+        expired.set()
+        kill(process)
+
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, expire)
+        timer.daemon = True
+        timer.start()
+    try:
+        if on_output:
+            for line in iter(process.stdout.readline, b''):
+                _echo(line)
+                if on_output(STDOUT, line):
+                    kill(process)
+                    break
+        process.wait()
+    finally:
+        if timer:
+            timer.cancel()
+    if expired.is_set():
+        raise subprocess.TimeoutExpired(process.args, timeout)
+    return process.returncode
+
+
+def _echo(data):
+    buffer = getattr(sys.stdout, 'buffer', None)
+    if buffer is None:
+        sys.stdout.write(data.decode(errors='replace'))
+    else:
+        sys.stdout.flush()
+        buffer.write(data)
+        buffer.flush()
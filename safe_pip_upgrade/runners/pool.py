@@ -0,0 +1,106 @@
+import logging
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+def worker_suffix(worker):
+    # type: (int) -> str
+    """ Suffix of the requirements file of the pool worker. """
+    return f'_worker_{worker}'
+
+
+def install_and_test(runner, lines, command=None, on_install=None):
+    """ Test requirements lines with the runner.
+
+    on_install(installed) is called between the install and the tests.
+    """
+    if on_install is None:
+        return runner.run_tests(lines, command=command)
+    installed = runner.install(lines)
+    on_install(installed)
+    return bool(installed) and runner.test(command)
+
+
+class Worker:
+    """ Runner with its own view of the requirements file. """
+
+    def __init__(self, runner, req_file, number):
+        self.runner = runner
+        self.req_file = req_file
+        self.number = number
+        self.trials = 0
+        self.busy_time = 0.0
+
+
+class RunnerPool:
+    """ Pool of runners to test several requirements states at once.
+
+    The worker 0 is the main runner with the main requirements file, the
+    other workers are spawned by the main runner.
+    """
+
+    def __init__(self, workers, trial_store=None):
+        self.workers = workers
+        self.trial_store = trial_store
+        self._free = queue.Queue()
+        for worker in workers:
+            self._free.put(worker)
+        self.started = time.monotonic()
+
+    @classmethod
+    def create(cls, client, req_file, size):
+        """ Spawn size - 1 workers concurrently. """
+        logger.info(f'pool: start {size} workers')
+        with ThreadPoolExecutor(size - 1) as executor:
+            runners = list(executor.map(client.spawn, range(1, size)))
+        workers = [Worker(client, req_file, 0)]
+        for number, runner in enumerate(runners, 1):
+            workers.append(Worker(
+                runner, req_file.with_suffix(worker_suffix(number)), number))
+        return cls(workers)
+
+    def __len__(self):
+        return len(self.workers)
+
+    @contextmanager
+    def acquire(self):
+        """ Wait for a free worker. """
+        worker = self._free.get()
+        started = time.monotonic()
+        try:
+            yield worker
+        finally:
+            worker.trials += 1
+            worker.busy_time += time.monotonic() - started
+            self._free.put(worker)
+
+    def run_trial(self, lines, command=None, on_install=None):
+        """ Test requirements lines on a free worker, see
+        install_and_test(). """
+        with self.acquire() as worker:
+            worker.req_file.write_lines(lines)
+            if self.trial_store:
+                return self.trial_store.run_trial(worker.runner, lines,
+                                                  command, on_install)
+            return install_and_test(worker.runner, lines, command,
+                                    on_install)
+
+    def log_utilization(self):
+        wall_time = max(time.monotonic() - self.started, 1e-9)
+        for worker in self.workers:
+            logger.info(
+                f'pool: worker {worker.number}: {worker.trials} trials, '
+                f'busy {worker.busy_time:.0f}s of {wall_time:.0f}s '
+                f'({100 * worker.busy_time / wall_time:.0f}%)')
+            if worker.number:
+                # the main runner is logged by the upgrade
+                worker.runner.log_stats()
+
+    def close(self):
+        """ Remove requirements files of the spawned workers. """
+        for worker in self.workers[1:]:
+            worker.req_file.remove()
@@ -0,0 +1,314 @@
+"""
+Virtual environment runner.
+
+The tests are run in a local virtual environment without docker. The
+original requirements are installed to the baseline environment once, every
+trial gets a clone of it with only the changed pins installed. Files of the
+clone are hardlinks to the baseline, pip replaces the files instead of
+writing into them, so the baseline is never changed by the trials.
+
+Pool workers have their own baseline and clone, so the trials use all the
+local cores.
+"""
+import json
+import logging
+import os
+import shlex
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+from safe_pip_upgrade.environment import ENVIRONMENT_SCRIPT, TargetEnvironment
+from safe_pip_upgrade.impact import TOP_LEVEL_SCRIPT
+from safe_pip_upgrade.metrics import metrics
+from safe_pip_upgrade.requirements_file import RequirementsLocal
+from safe_pip_upgrade.runners.incremental import Installer
+from safe_pip_upgrade.runners.output import FailureMatcher, OutputMonitor, \
+    follow
+from safe_pip_upgrade.runners.pool import worker_suffix
+from safe_pip_upgrade.stages import TrialPipeline
+from safe_pip_upgrade.wheelhouse import Wheelhouse, find_links
+
+logger = logging.getLogger(__name__)
+
+VENV_TIMEOUT = 60 * 10
+BIN_DIR = 'Scripts' if sys.platform == 'win32' else 'bin'
+
+
+def _link(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        # another file system
+        shutil.copy2(source, target)
+
+
+def _kill_group(process):
+    """ Kill the process with its children. """
+    if not hasattr(os, 'killpg'):
+        process.kill()
+        return
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def clone_environment(source, target):
+    # type: (str, str) -> None
+    """ Clone the virtual environment with hardlinks of its files.
+
+    Scripts with the path of the source environment (shebangs, activate
+    scripts) are rewritten for the target.
+    """
+    if os.path.lexists(target):
+        shutil.rmtree(target)
+    shutil.copytree(source, target, symlinks=True, copy_function=_link)
+
+    source_path = os.path.abspath(source).encode()
+    target_path = os.path.abspath(target).encode()
+    bin_dir = os.path.join(target, BIN_DIR)
+    for file_name in os.listdir(bin_dir):
+        path = os.path.join(bin_dir, file_name)
+        if os.path.islink(path) or not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            content = f.read()
+        if source_path not in content:
+            continue
+        mode = os.stat(path).st_mode
+        # the hardlink is replaced, the source script stays as it is
+        os.remove(path)
+        with open(path, 'wb') as f:
+            f.write(content.replace(source_path, target_path))
+        os.chmod(path, mode)
+
+
+class VenvRunner:
+    """ Runner of the tests in a clone of the baseline environment. """
+
+    def __init__(self, config, worker=None, pipeline=None, source=None):
+        self.config = config
+        self.work_dir = config.WORKING_DIRECTORY
+        directory = os.path.join(config.WORKING_DIRECTORY, config.VENV_DIR)
+        suffix = '' if worker is None else worker_suffix(worker)
+        self.baseline_dir = os.path.abspath(
+            os.path.join(directory, 'baseline' + suffix))
+        self.clone_dir = os.path.abspath(
+            os.path.join(directory, 'trial' + suffix))
+        requirements = RequirementsLocal(os.path.join(
+            config.WORKING_DIRECTORY, config.LOCAL_REQUIREMENTS_FILE))
+        if worker is not None:
+            # pool worker has its own environments and requirements file
+            requirements = requirements.with_suffix(suffix)
+        self.requirements_file_name = requirements.full_name
+        # stages are shared with the pool workers to count them together
+        self.pipeline = pipeline or TrialPipeline.from_config(config)
+        # the stage is aborted on the first output line of a failure
+        self.failure_matcher = FailureMatcher.from_config(config)
+        self.wheelhouse = Wheelhouse.from_config()
+        self.installer = Installer(
+            self._pip_install_all, self._pip_install_pins, self._pip_check,
+            reset_layer=self._clone, merge_layer=self._merge_clone)
+        self._image_id = None
+        self._create_baseline(source)
+
+    def spawn(self, worker):
+        """ Create runner of the pool worker with a clone of the baseline.
+        """
+        return VenvRunner(self.config, worker=worker, pipeline=self.pipeline,
+                          source=self.baseline_dir)
+
+    def run_tests(self, requirements=None, command=None):
+        """ Install requirements lines and run the tests.
+
+        Without the lines the whole requirements file is installed, without
+        the command the test start command is run.
+        """
+        return self.install(requirements) and self.test(command)
+
+    def install(self, requirements=None):
+        """ Install requirements lines to the trial environment. """
+        with metrics.phase('install'):
+            installed = self.installer.install(requirements)
+        if not installed:
+            logger.error('venv: failed to install requirements.')
+            return False
+        return True
+
+    def install_baseline(self, requirements, req_file):
+        """ Install the original requirements lines of req_file to the
+        baseline environment. """
+        req_file.write_lines(requirements)
+        with metrics.phase('install'):
+            return self.installer.install_baseline(requirements)
+
+    def test(self, command=None):
+        """ Run the stages and the tests in the trial environment.
+
+        An empty command means there are no tests to run, the stages are
+        run anyway.
+        """
+        if command is None:
+            command = self.config.TEST_START_COMMAND
+        logger.info('venv: start tests')
+        passed = self.pipeline.run(self._run_stage, command, time.monotonic)
+        logger.info(f'venv: tests done, {"passed" if passed else "failed"}')
+        if passed:
+            self.installer.passed()
+        return passed
+
+    def _run_stage(self, stage):
+        monitor = (OutputMonitor(self.failure_matcher)
+                   if self.failure_matcher else None)
+        args, env = self._command(shlex.split(stage.command), self.clone_dir)
+        logger.info(f'>>{" ".join(args)}')
+        pipe = subprocess.PIPE if monitor else None
+        # the stage and its children are killed together
+        with subprocess.Popen(args, cwd=self.work_dir, env=env, stdout=pipe,
+                              stderr=monitor and subprocess.STDOUT,
+                              start_new_session=True) as process:
+            try:
+                code = follow(process, monitor and monitor.feed,
+                              stage.timeout or VENV_TIMEOUT, _kill_group)
+            except subprocess.TimeoutExpired:
+                logger.info(f'venv: {stage.name} timed out')
+                return False
+        if monitor and (monitor.failure or monitor.close()):
+            logger.info(f'venv: {stage.name} failed on "{monitor.failure}"')
+            return False
+        logger.info(f'venv: {stage.name} done, return code {code}')
+        return code == 0
+
+    def log_stats(self):
+        logger.info(f'venv: install: {self.installer.stats}')
+        self.pipeline.log_stats()
+
+    def freeze(self):
+        """ Get pip freeze of the trial environment. """
+        result = self._run(['python', '-m', 'pip', 'freeze', '--all'],
+                           capture_output=True)
+        return result.stdout.decode()
+
+    def top_level_map(self):
+        """ Get {top-level module: [distribution, ...]} of the baseline. """
+        result = self._run(['python', '-c', TOP_LEVEL_SCRIPT],
+                           directory=self.baseline_dir, capture_output=True)
+        if result.returncode:
+            logger.warning('venv: can not get the top-level modules.')
+            return {}
+        return json.loads(result.stdout.decode())
+
+    def image_id(self):
+        """ Get id of the interpreter the environments are created with. """
+        if self._image_id is None:
+            result = self._run(
+                ['python', '-c', 'import sys; print(sys.version)'],
+                directory=self.baseline_dir, capture_output=True)
+            self._image_id = 'venv:' + result.stdout.decode().strip()
+        return self._image_id
+
+    def download_wheel(self, pin):
+        """ Build wheel of the pin into the wheelhouse. """
+        result = self._run(['python', '-m', 'pip', 'wheel', '--no-deps',
+                            '--quiet', '-w', self.wheelhouse.directory, pin],
+                           directory=self.baseline_dir, capture_output=True)
+        logger.debug(f'venv: download {pin}, return code '
+                     f'{result.returncode}')
+        return result.returncode == 0
+
+    def get_environment(self):
+        """ Get interpreter and platform of the environments. """
+        result = self._run(['python', '-c', ENVIRONMENT_SCRIPT],
+                           directory=self.baseline_dir, capture_output=True)
+        if result.returncode:
+            logger.warning('venv: can not get the python environment.')
+            return None
+        environment = TargetEnvironment.from_json(result.stdout.decode())
+        logger.info(f'venv: test environment {environment}')
+        return environment
+
+    def _find_links(self, pins=None):
+        """ Get pip options to install from the wheelhouse. """
+        return find_links(self.wheelhouse,
+                          self.wheelhouse and self.wheelhouse.directory, pins)
+
+    def _pip_install_all(self):
+        """ Install the requirements file to the baseline, the trial gets
+        a new clone of it. """
+        code = self._run(['python', '-m', 'pip', 'install', '-r',
+                          self.requirements_file_name, *self._find_links()],
+                         directory=self.baseline_dir).returncode
+        logger.info(f'venv: install requirements, return code {code}')
+        if code:
+            return False
+        self._clone()
+        return True
+
+    def _pip_install_pins(self, pins):
+        code = self._run(['python', '-m', 'pip', 'install', '--no-deps',
+                          *self._find_links(pins), *pins]).returncode
+        logger.info(f'venv: install {len(pins)} pins, return code {code}')
+        return code == 0
+
+    def _pip_check(self):
+        code = self._run(['python', '-m', 'pip', 'check']).returncode
+        logger.info(f'venv: check requirements, return code {code}')
+        return code == 0
+
+    def _clone(self):
+        """ Drop the trial environment and clone the baseline. """
+        with metrics.phase('venv_clone'):
+            clone_environment(self.baseline_dir, self.clone_dir)
+
+    def _merge_clone(self, pins):
+        """ The environment of the passed trial becomes the baseline, the
+        next trials are cloned from it. """
+        try:
+            with metrics.phase('venv_clone'):
+                clone_environment(self.clone_dir, self.baseline_dir)
+        except OSError as e:
+            logger.warning(f'venv: can not clone the passed environment: {e}')
+            self._create_baseline()
+            return False
+        return True
+
+    def _create_baseline(self, source=None):
+        # the new environment has no packages installed by the runner
+        self.installer.reset()
+        if source:
+            clone_environment(source, self.baseline_dir)
+            return
+        if os.path.lexists(self.baseline_dir):
+            shutil.rmtree(self.baseline_dir)
+        self._run([self.config.VENV_PYTHON, '-m', 'venv', self.baseline_dir],
+                  directory=None, check=True)
+        logger.info(f'venv: created {self.baseline_dir}')
+
+    def _run(self, args, directory='', capture_output=False,
+             timeout=VENV_TIMEOUT, check=False):
+        """ Run the command in the environment, the trial one by default.
+        """
+        if directory == '':
+            directory = self.clone_dir
+        args, env = self._command(args, directory)
+        logger.info(f'>>{" ".join(args)}')
+        return subprocess.run(args, cwd=self.work_dir, env=env,
+                               capture_output=capture_output, timeout=timeout,
+                               check=check)
+
+    @staticmethod
+    def _command(args, directory):
+        """ Get the command and its variables to run it in the environment
+        of the directory, None is the own environment. """
+        env = dict(os.environ)
+        if directory:
+            env['VIRTUAL_ENV'] = directory
+            env['PATH'] = (os.path.join(directory, BIN_DIR) + os.pathsep +
+                           env.get('PATH', ''))
+            env.pop('PYTHONHOME', None)
+            if args[0] == 'python':
+                args = [os.path.join(directory, BIN_DIR, 'python'), *args[1:]]
+        return args, env
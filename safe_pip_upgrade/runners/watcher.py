@@ -0,0 +1,116 @@
+"""
+Liveness of the test container by the docker events stream.
+
+The watcher follows the events of the container in a background thread,
+so the runner knows if the container is alive without polling docker
+before every step, and the step in progress is aborted as soon as the
+container dies.
+"""
+import atexit
+import json
+import logging
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEAD_ACTIONS = {'die', 'destroy', 'oom', 'pause'}
+ALIVE_ACTIONS = {'start', 'restart', 'unpause'}
+
+
+def cli_events(container):
+    """ Follow events of the container with the docker CLI, get (iterator
+    of events, close()). """
+    process = subprocess.Popen(
+        ['docker', 'events', '--filter', f'container={container}',
+         '--filter', 'type=container', '--format', '{{json .}}'],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    events = (json.loads(line) for line in process.stdout if line.strip())
+    return events, process.kill
+
+
+class ContainerWatcher:
+    """ Container state kept in memory by its events.
+
+    open_events() subscribes to the events, it returns (iterator of event
+    dicts, close()). on_die() is called from the watcher thread when the
+    container dies. alive is None while the state is unknown: before the
+    first event or if the stream is broken.
+    """
+
+    def __init__(self, open_events, on_die=None, clock=time.monotonic):
+        self.open_events = open_events
+        self.on_die = on_die
+        self.clock = clock
+        self.alive = None
+        self.deaths = 0
+        self.died_at = None
+        self._close = None
+        self._thread = None
+        self._stopped = False
+        self._condition = threading.Condition()
+
+    @property
+    def watching(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """ Subscribe to the events and follow them in background. """
+        events, self._close = self.open_events()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._watch, args=(events,),
+                                        daemon=True)
+        self._thread.start()
+        # the stopped watcher is not kept alive by the exit handler
+        atexit.register(self.stop)
+
+    def stop(self):
+        atexit.unregister(self.stop)
+        self._stopped = True
+        if self._close:
+            self._close()
+            self._close = None
+
+    def set_alive(self, alive):
+        """ Set the polled state, the next events change it. """
+        with self._condition:
+            self.alive = alive
+
+    def wait_death(self, deaths, timeout):
+        # type: (int, float) -> bool
+        """ Wait until the container dies after the deaths count. """
+        with self._condition:
+            return self._condition.wait_for(lambda: self.deaths != deaths,
+                                            timeout)
+
+    def handle(self, event):
+        """ Update the state by the event. """
+        action = (event.get('Action') or event.get('status') or '')
+        action = action.split(':')[0]
+        if action in DEAD_ACTIONS:
+            with self._condition:
+                died = self.alive is not False
+                self.alive = False
+                if died:
+                    self.deaths += 1
+                    self.died_at = self.clock()
+                    self._condition.notify_all()
+            if died:
+                logger.warning(f'watcher: container {action}')
+                if self.on_die:
+                    self.on_die()
+        elif action in ALIVE_ACTIONS:
+            self.set_alive(True)
+
+    def _watch(self, events):
+        try:
+            for event in events:
+                self.handle(event)
+        except (OSError, ValueError) as e:
+            if not self._stopped:
+                logger.warning(f'watcher: events stream failed: {e}')
+        self.set_alive(None)
+        if not self._stopped:
+            logger.warning('watcher: events stream is closed, the '
+                           'container is polled.')
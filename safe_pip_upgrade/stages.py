@@ -0,0 +1,170 @@
+"""
+Multi-stage trial pipeline.
+
+Cheap smoke stages (pip check, an import, django check...) are run before
+the test command and the trial stops on the first failed stage, so a bad
+candidate costs seconds instead of the whole suite.
+
+Stages are configured one per line as "name | timeout | command".
+
+The deadline of a stage is derived from its previous durations (a
+percentile times a factor), so a hung trial is killed as soon as it runs
+much longer than usual instead of after the fixed timeout.
+"""
+import logging
+import math
+import threading
+from collections import deque, namedtuple
+
+from safe_pip_upgrade.metrics import metrics
+from safe_pip_upgrade.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+Stage = namedtuple('Stage', 'name timeout command')
+
+TESTS_STAGE = 'tests'
+
+
+def parse_stages(text):
+    # type: (str) -> list
+    """ Parse "name | timeout | command" lines to the list of stages. """
+    stages = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        parts = [part.strip() for part in line.split('|', 2)]
+        if len(parts) != 3 or not parts[0] or not parts[2]:
+            raise ValueError(f'Stage must be "name | timeout | command": '
+                             f'{line}')
+        name, timeout, command = parts
+        stages.append(Stage(name, int(timeout) if timeout else None, command))
+    return stages
+
+
+class StageStats:
+    """ Timing and rejections of a stage. """
+
+    def __init__(self):
+        self.runs = 0
+        self.rejections = 0
+        self.time = 0.0
+
+
+class StageDeadlines:
+    """ Deadlines of the stages by their previous durations.
+
+    The durations are kept by the command, the tests of the impacted
+    modules get no deadline from the full suite and vice versa.
+    """
+    # durations of a command kept for the percentile
+    WINDOW = 50
+
+    def __init__(self, factor, percentile=95, minimum=60):
+        self.factor = factor
+        self.percentile = percentile
+        self.minimum = minimum
+        self.durations = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """ Get deadlines configured in config or None if they are off. """
+        factor = float(config.TEST_DEADLINE_FACTOR or 0)
+        if factor <= 0:
+            return None
+        return cls(factor, int(config.TEST_DEADLINE_PERCENTILE),
+                   int(config.TEST_DEADLINE_MIN))
+
+    def add(self, command, duration):
+        """ Remember the duration of the passed stage. """
+        with self._lock:
+            durations = self.durations.setdefault(command,
+                                                  deque(maxlen=self.WINDOW))
+            durations.append(duration)
+
+    def get(self, command):
+        # type: (str) -> float
+        """ Get deadline of the command or None if it has never passed. """
+        with self._lock:
+            durations = sorted(self.durations.get(command, ()))
+        if not durations:
+            return None
+        # nearest-rank percentile
+        rank = math.ceil(self.percentile / 100 * len(durations))
+        duration = durations[max(rank, 1) - 1]
+        return max(duration * self.factor, self.minimum)
+
+
+class TrialPipeline:
+    """ Stages of a trial followed by the tests.
+
+    The pipeline is shared by the runners of the pool, so the stats and
+    the durations are collected for all of them.
+    """
+
+    def __init__(self, stages=(), deadlines=None):
+        self.stages = list(stages)
+        self.deadlines = deadlines
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(parse_stages(config.TEST_STAGES or ''),
+                   StageDeadlines.from_config(config))
+
+    def run(self, run_stage, test_command, clock):
+        # type: (Callable, str, Callable) -> bool
+        """ Run stages while they pass.
+
+        run_stage(stage) runs the stage command within stage.timeout (None
+        is the runner default) and returns True if it passes, an empty
+        test_command means there are no tests to run.
+        """
+        stages = list(self.stages)
+        if test_command:
+            stages.append(Stage(TESTS_STAGE, None, test_command))
+        for stage in stages:
+            stage = self._with_deadline(stage)
+            started = clock()
+            with tracer.span(f'stage:{stage.name}',
+                             timeout=stage.timeout or 0) as span:
+                passed = run_stage(stage)
+                span.set(passed=passed)
+            duration = clock() - started
+            self._count(stage.name, duration, passed)
+            if not passed:
+                logger.info(f'stages: rejected by {stage.name}')
+                return False
+            if self.deadlines:
+                self.deadlines.add(stage.command, duration)
+        return True
+
+    def _with_deadline(self, stage):
+        """ Get the stage with the deadline by its previous durations, the
+        configured timeout is the upper bound. """
+        deadline = self.deadlines and self.deadlines.get(stage.command)
+        if not deadline or stage.timeout and stage.timeout <= deadline:
+            return stage
+        logger.info(f'stages: {stage.name} deadline {deadline:.0f}s')
+        return stage._replace(timeout=deadline)
+
+    def _count(self, name, duration, passed):
+        metrics.observe(f'stage:{name}', duration)
+        with self._lock:
+            stats = self.stats.setdefault(name, StageStats())
+            stats.runs += 1
+            stats.time += duration
+            if not passed:
+                stats.rejections += 1
+
+    def log_stats(self):
+        for stage in self.stages + [Stage(TESTS_STAGE, None, '')]:
+            stats = self.stats.get(stage.name)
+            if not stats:
+                continue
+            logger.info(f'stages: {stage.name}: {stats.runs} runs, '
+                        f'{stats.rejections} rejections, {stats.time:.0f}s '
+                        f'(~{stats.time / stats.runs:.1f}s per run)')
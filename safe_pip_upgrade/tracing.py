@@ -0,0 +1,125 @@
+"""
+Spans of the upgrade run in the Chrome trace-event format.
+
+The spans show where the wall-clock time goes: the overlap of the pypi
+requests, the trials on the pool workers and the idle gaps between them.
+The trace file opens in Perfetto (ui.perfetto.dev) or chrome://tracing.
+
+Tracing is off by default and a span of the disabled tracer is a shared
+no-op object, so the instrumented code costs nothing then.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _NoSpan:
+    """ Span of the disabled tracer. """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+class Span:
+    """ Span of the enabled tracer, attributes are shown as its args. """
+    __slots__ = ('tracer', 'name', 'attributes', 'started')
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.started = None
+
+    def __enter__(self):
+        self.started = self.tracer.clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        self.tracer.add(self.name, self.started, self.tracer.clock(),
+                        self.attributes)
+        return False
+
+    def set(self, **attributes):
+        """ Add attributes known at the end, e.g. the exit code. """
+        self.attributes.update(attributes)
+
+
+class Tracer:
+    """ Collector of the spans of all the threads. """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.enabled = False
+        self.events = []
+        self._threads = {}
+        self._origin = clock()
+        self._lock = threading.Lock()
+
+    def enable(self):
+        """ Start collecting spans. """
+        self.events = []
+        self._threads = {}
+        self._origin = self.clock()
+        self.enabled = True
+
+    def span(self, name, **attributes):
+        """ Get span context manager of the block. """
+        if not self.enabled:
+            return NO_SPAN
+        return Span(self, name, attributes)
+
+    def add(self, name, started, finished, attributes):
+        thread = threading.current_thread()
+        event = {
+            'name': name, 'ph': 'X', 'pid': os.getpid(),
+            'ts': round((started - self._origin) * 1e6, 1),
+            'dur': round((finished - started) * 1e6, 1),
+            'args': {key: value if isinstance(value, (int, float, bool))
+                     else str(value) for key, value in attributes.items()},
+        }
+        with self._lock:
+            event['tid'] = self._threads.setdefault(
+                thread.ident, (len(self._threads) + 1, thread.name))[0]
+            self.events.append(event)
+
+    def trace(self):
+        # type: () -> dict
+        """ Get the trace-event json object. """
+        pid = os.getpid()
+        with self._lock:
+            names = [{'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                      'tid': tid, 'args': {'name': name}}
+                     for tid, name in self._threads.values()]
+            events = sorted(self.events, key=lambda event: event['ts'])
+        process = {'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+                   'args': {'name': 'safe-pip-upgrade'}}
+        return {'traceEvents': [process, *names, *events],
+                'displayTimeUnit': 'ms'}
+
+    def save(self, path):
+        """ Write the trace file of the spans collected so far. """
+        if not self.enabled:
+            return
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.trace(), f)
+        logger.info(f'tracing: {len(self.events)} spans are written to '
+                    f'{path}')
+
+
+tracer = Tracer()
@@ -0,0 +1,151 @@
+"""
+Persistent store of the trial results.
+
+Nightly runs test mostly the same requirements as the previous night. The
+store keeps the outcome of every trial keyed by the installed environment
+(pip freeze inside the container), the image of the container, the test
+command and the hash of the project code, so a known outcome is reused
+instead of running the tests again.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from safe_pip_upgrade.config import Config
+from safe_pip_upgrade.runners.incremental import requirement_pins
+
+logger = logging.getLogger(__name__)
+
+# phase is the failed phase: "install" or "tests", None if the trial passed
+Trial = namedtuple('Trial', 'passed phase install_time test_time')
+
+
+def project_hash(directory):
+    # type: (str) -> str
+    """ Get hash of the python sources of the project. """
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs
+                         if not d.startswith('.') and d != '__pycache__')
+        for file_name in sorted(files):
+            if not file_name.endswith('.py'):
+                continue
+            path = os.path.join(root, file_name)
+            digest.update(os.path.relpath(path, directory).encode())
+            with open(path, 'rb') as f:
+                digest.update(hashlib.sha1(f.read()).digest())
+    return digest.hexdigest()
+
+
+class TrialStore:
+    """ SQLite store of the trial results.
+
+    Rows of another image or project hash are removed by invalidate(). The
+    install failures are keyed by the pins, because there is no installed
+    environment to fingerprint.
+    """
+
+    def __init__(self, path, project):
+        self.path = path
+        self.project = project
+        self.hits = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS trials ('
+                'key TEXT PRIMARY KEY, image TEXT, project TEXT, '
+                'passed INTEGER, phase TEXT, install_time REAL, '
+                'test_time REAL, created REAL)')
+
+    @classmethod
+    def from_config(cls):
+        """ Get store configured in Config or None if it is off. """
+        if not Config.TRIAL_STORE:
+            return None
+        return cls(os.path.join(Config.WORKING_DIRECTORY, Config.TRIAL_STORE),
+                   project_hash(Config.WORKING_DIRECTORY))
+
+    def invalidate(self, image):
+        # type: (str) -> None
+        """ Remove results of other images and project versions. """
+        with self._lock, self._connection:
+            removed = self._connection.execute(
+                'DELETE FROM trials WHERE image IS NOT ? OR project IS NOT ?',
+                (image, self.project)).rowcount
+        if removed:
+            logger.info(f'trial store: {removed} outdated results removed')
+
+    def key(self, *parts):
+        digest = hashlib.sha256(self.project.encode())
+        for part in parts:
+            digest.update(b'\0' + str(part).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        # type: (str) -> Trial
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT passed, phase, install_time, test_time FROM trials '
+                'WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return Trial(bool(row[0]), *row[1:])
+
+    def put(self, key, image, trial):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO trials '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, image, self.project, int(trial.passed), trial.phase,
+                 trial.install_time, trial.test_time, time.time()))
+
+    def run_trial(self, runner, lines, command=None, on_install=None):
+        """ Test requirements lines with the runner or get a known result.
+
+        The runner installs lines, returns pip freeze of the installed
+        environment and runs the tests separately. Without the command the
+        test start command is run. on_install(installed) is called after
+        the install.
+        """
+        image = runner.image_id()
+        pins_key = self.key('install', image,
+                            *sorted(requirement_pins(lines).values()))
+        trial = self.get(pins_key)
+        if trial is not None:
+            return self._reuse(trial, trial.install_time)
+
+        started = time.monotonic()
+        installed = runner.install(lines)
+        install_time = time.monotonic() - started
+        if on_install:
+            on_install(installed)
+        if not installed:
+            self.put(pins_key, image,
+                     Trial(False, 'install', install_time, 0.0))
+            return False
+
+        if command is None:
+            command = Config.TEST_START_COMMAND
+        key = self.key('tests', image, command, runner.freeze())
+        trial = self.get(key)
+        if trial is not None:
+            return self._reuse(trial, trial.test_time)
+
+        started = time.monotonic()
+        passed = runner.test(command)
+        self.put(key, image, Trial(passed, None if passed else 'tests',
+                                   install_time, time.monotonic() - started))
+        return passed
+
+    def _reuse(self, trial, skipped_time):
+        with self._lock:
+            self.hits += 1
+        outcome = 'passed' if trial.passed else f'{trial.phase} failed'
+        logger.info(f'trial store: known result, {outcome}, '
+                    f'~{skipped_time:.0f}s skipped')
+        return trial.passed
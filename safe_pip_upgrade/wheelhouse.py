@@ -0,0 +1,162 @@
+import logging
+import os
+import threading
+import time
+
+from safe_pip_upgrade.config import Config
+
+logger = logging.getLogger(__name__)
+
+try:
+    from packaging.utils import canonicalize_name
+    from packaging.version import InvalidVersion, Version
+except ImportError:
+    # noinspection PyProtectedMember,PyCompatibility
+    from pip._vendor.packaging.utils import canonicalize_name
+    # noinspection PyProtectedMember,PyCompatibility
+    from pip._vendor.packaging.version import InvalidVersion, Version
+
+
+def find_links(wheelhouse, directory, pins=None):
+    # type: (Wheelhouse, str, list) -> list
+    """ Get pip options to install from the wheelhouse seen by the runner
+    at directory.
+
+    The index is not used if all the pins are in the wheelhouse.
+    """
+    if not wheelhouse:
+        return []
+    options = ['--find-links', directory]
+    if pins and all(map(wheelhouse.has, pins)):
+        options.insert(0, '--no-index')
+    return options
+
+
+def _canonical_version(version):
+    try:
+        return Version(version)
+    except InvalidVersion:
+        return version
+
+
+class Wheelhouse:
+    """ Local directory of the built wheels shared with the test runners.
+
+    It is reused between runs, the wheels unused for max_age seconds and
+    the least recently used wheels above max_size are removed.
+    """
+
+    def __init__(self, directory, max_size, max_age):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_config(cls):
+        """ Get wheelhouse configured in Config or None if it is off. """
+        if not Config.WHEELHOUSE_DIR:
+            return None
+        return cls(os.path.abspath(os.path.expanduser(Config.WHEELHOUSE_DIR)),
+                   int(Config.WHEELHOUSE_MAX_SIZE),
+                   int(Config.WHEELHOUSE_MAX_AGE))
+
+    def has(self, pin):
+        # type: (str) -> bool
+        """ Check if there is a wheel of the "name==version" pin. """
+        name, _, version = pin.partition('==')
+        if not version:
+            return False
+        key = (canonicalize_name(name.strip()),
+               _canonical_version(version.strip()))
+        found = False
+        for file_name in os.listdir(self.directory):
+            parts = file_name.split('-')
+            if not file_name.endswith('.whl') or len(parts) < 5:
+                continue
+            if (canonicalize_name(parts[0]),
+                    _canonical_version(parts[1])) == key:
+                # the wheel is used, keep it longer
+                os.utime(os.path.join(self.directory, file_name))
+                found = True
+        return found
+
+    def collect_garbage(self):
+        """ Remove old wheels and the oldest wheels above the size limit. """
+        files = []
+        for file_name in os.listdir(self.directory):
+            path = os.path.join(self.directory, file_name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        expired = time.time() - self.max_age
+        total_size = sum(size for _, size, _ in files)
+        for mtime, size, path in sorted(files):
+            if mtime >= expired and total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+            logger.debug(f'wheelhouse: remove {path}')
+
+
+class WheelPrefetcher:
+    """ Download pins to the wheelhouse in background threads.
+
+    The pins are downloaded in the given order, download(pin) is the
+    runner method that builds the wheel into the wheelhouse.
+    """
+
+    def __init__(self, wheelhouse, download, workers):
+        self.wheelhouse = wheelhouse
+        self.download = download
+        self.workers = workers
+        self._pins = iter(())
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = []
+        self.downloaded = 0
+        self.failed = 0
+
+    def start(self, pins):
+        self._pins = iter(pins)
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """ Skip the pins that are not downloaded yet.
+
+        Running downloads are not waited for, the threads are daemons.
+        """
+        self._stopped.set()
+        logger.info(f'wheelhouse: {self.downloaded} wheels downloaded, '
+                    f'{self.failed} failed')
+
+    def _next_pin(self):
+        with self._lock:
+            return next(self._pins, None)
+
+    def _work(self):
+        while not self._stopped.is_set():
+            pin = self._next_pin()
+            if pin is None:
+                return
+            if self.wheelhouse.has(pin):
+                continue
+            try:
+                success = self.download(pin)
+            except Exception as ex:
+                logger.warning(f'wheelhouse: {pin}: {ex}')
+                success = False
+            with self._lock:
+                if success:
+                    self.downloaded += 1
+                else:
+                    self.failed += 1
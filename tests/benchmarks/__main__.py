@@ -0,0 +1,50 @@
+"""
+Run the simulation benchmarks and compare them with the baselines.
+
+    python -m tests.benchmarks [--full] [--update] [scenario ...]
+"""
+import argparse
+import sys
+
+from tests.benchmarks.simulation import FULL_SIZE, SCENARIOS, compare, \
+    load_baselines, run, save_baselines
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m tests.benchmarks')
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help='names of the scenarios to run '
+                             '(default: all but the full size ones)')
+    parser.add_argument('--full', action='store_true',
+                        help=f'run the scenarios of {FULL_SIZE} packages too')
+    parser.add_argument('--update', action='store_true',
+                        help='write the results as the new baselines')
+    args = parser.parse_args()
+
+    scenarios = [scenario for scenario in SCENARIOS
+                 if scenario.name in args.scenarios or not args.scenarios
+                 and (args.full or scenario.packages < FULL_SIZE)]
+    baselines = load_baselines()
+    failed = False
+    print(f'{"scenario":<16} {"trials":>7} {"upgraded":>8} '
+          f'{"simulated":>10} {"cpu":>8} {"memory":>9}')
+    for scenario in scenarios:
+        result = run(scenario)
+        print(f'{scenario.name:<16} {result["trials"]:>7} '
+              f'{result["upgraded"]:>8} {result["simulated_time"]:>9.0f}s '
+              f'{result["cpu_time"]:>7.2f}s '
+              f'{result["peak_memory"] / 2 ** 20:>7.1f}MB')
+        if args.update:
+            baselines[scenario.name] = result
+        elif scenario.name in baselines:
+            for problem in compare(scenario, result,
+                                   baselines[scenario.name]):
+                failed = True
+                print(f'  regression: {problem}')
+    if args.update:
+        save_baselines(baselines)
+    return int(failed)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,358 @@
+"""
+Deterministic simulation of the upgrade run.
+
+A seeded generator makes a project of synthetic packages: the pinned
+requirements, the release histories of the packages and the versions that
+break the tests. The release histories are served by the local stand-in of
+pypi and the fake runner answers the trials by the breaking versions with
+a simulated install and test latency instead of real installs. The
+orchestrator (the Upgrade class, the pool and the pypi client) is the real
+one, so a run measures its trials, the simulated wall time of the trials
+and the CPU time and the peak memory of the orchestrator process.
+
+The results of the scenarios are compared with baselines.json, run
+``python -m tests.benchmarks --update`` to record new baselines.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import ExitStack, contextmanager
+from random import Random
+from unittest.mock import patch
+
+from safe_pip_upgrade.config import Config
+from safe_pip_upgrade.core.upgrade import Upgrade
+from safe_pip_upgrade.pypi import PypiPackage, pypi_packages
+from safe_pip_upgrade.requirements_file import RequirementsLocal
+from safe_pip_upgrade.resolver import pinned_versions
+from safe_pip_upgrade.runners.pool import RunnerPool
+from tests.unittests.fixtures.pypi_server import FakePypiServer
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+
+# allowed deviation of the results from the baselines
+POOL_TIME_TOLERANCE = 0.25  # share of the simulated time of a pool
+CPU_TIME_FACTOR = 3  # CPU time depends on the machine
+CPU_TIME_SLACK = 0.5  # seconds
+MEMORY_FACTOR = 2
+MEMORY_SLACK = 1024 * 1024  # bytes
+
+
+class Scenario:
+    """ Synthetic project and upgrade settings of a benchmark.
+
+    break_rate is the share of the packages that have a breaking version,
+    break_at is its position among the newer releases: "uniform" or
+    "latest". conflict_rate is the share of the packages whose newer
+    version breaks the tests only together with a newer version of another
+    package. Latencies are simulated seconds.
+    """
+
+    def __init__(self, name, packages, strategy='sequential', workers=1,
+                 arity=1, seed=0, break_rate=0.3, break_at='uniform',
+                 conflict_rate=0.02, install_time=20.0,
+                 install_time_per_pin=2.0, test_time=60.0):
+        self.name = name
+        self.packages = packages
+        self.strategy = strategy
+        self.workers = workers
+        self.arity = arity
+        self.seed = seed
+        self.break_rate = break_rate
+        self.break_at = break_at
+        self.conflict_rate = conflict_rate
+        self.install_time = install_time
+        self.install_time_per_pin = install_time_per_pin
+        self.test_time = test_time
+
+    def __repr__(self):
+        return f'Scenario({self.name})'
+
+
+SCENARIOS = [
+    Scenario('sequential-10', 10),
+    Scenario('group-10', 10, strategy='group'),
+    Scenario('pool-10', 10, workers=4),
+    Scenario('sequential-100', 100),
+    Scenario('group-100', 100, strategy='group'),
+    Scenario('pool-100', 100, workers=4),
+    Scenario('arity-100', 100, workers=4, arity=3),
+    Scenario('sequential-1000', 1000),
+    Scenario('group-1000', 1000, strategy='group'),
+    Scenario('pool-1000', 1000, workers=8),
+]
+# the scenarios of 1000 packages take minutes, they are run on demand
+FULL_SIZE = 1000
+
+
+class Project:
+    """ Synthetic requirements, releases and breaking versions. """
+
+    def __init__(self, releases, pins, breaking, conflicts):
+        self.releases = releases  # {name: [version, ...]}
+        self.pins = pins  # {name: pinned version}
+        self.breaking = breaking  # {name: index of the first bad version}
+        # [(name, index, other name, other index), ...]
+        self.conflicts = conflicts
+        self._index = {name: {version: i for i, version
+                              in enumerate(versions)}
+                       for name, versions in releases.items()}
+        self._lines = {}
+
+    @classmethod
+    def generate(cls, scenario):
+        """ Generate the project of the scenario by its seed. """
+        random = Random(scenario.seed)
+        releases, pins, breaking, conflicts = {}, {}, {}, []
+        for i in range(scenario.packages):
+            name = f'sim-{i:04d}'
+            versions = []
+            major, minor, patch_ = random.randint(0, 3), 0, 0
+            for _ in range(random.randint(2, 30)):
+                versions.append(f'{major}.{minor}.{patch_}')
+                step = random.random()
+                if step < 0.1:
+                    major, minor, patch_ = major + 1, 0, 0
+                elif step < 0.4:
+                    minor, patch_ = minor + 1, 0
+                else:
+                    patch_ += 1
+            current = random.randrange(len(versions))
+            releases[name] = versions
+            pins[name] = versions[current]
+            last = len(versions) - 1
+            if current < last and random.random() < scenario.break_rate:
+                breaking[name] = (last if scenario.break_at == 'latest'
+                                  else random.randint(current + 1, last))
+            if (current < last and i and
+                    random.random() < scenario.conflict_rate):
+                other = f'sim-{random.randrange(i):04d}'
+                other_current = releases[other].index(pins[other])
+                other_last = len(releases[other]) - 1
+                if other_current < other_last:
+                    conflicts.append(
+                        (name, random.randint(current + 1, last), other,
+                         random.randint(other_current + 1, other_last)))
+        return cls(releases, pins, breaking, conflicts)
+
+    @property
+    def lines(self):
+        return [f'{name}=={version}\n' for name, version in self.pins.items()]
+
+    def pinned_versions(self, lines):
+        # type: (list) -> dict
+        """ Get {name: version} of the lines.
+
+        The pins of the lines are cached, so the fake runner does not add
+        its own parsing to the CPU time of the orchestrator.
+        """
+        pins = {}
+        for line in lines:
+            pin = self._lines.get(line)
+            if pin is None:
+                pin = self._lines[line] = tuple(
+                    pinned_versions([line]).items())
+            pins.update(pin)
+        return pins
+
+    def passes(self, pins):
+        # type: (dict) -> bool
+        """ Check if the tests pass with the pinned versions. """
+        index = {name: self._index[name][version]
+                 for name, version in pins.items()}
+        if any(index[name] >= bad for name, bad in self.breaking.items()):
+            return False
+        return not any(index[name] >= bad and index[other] >= other_bad
+                       for name, bad, other, other_bad in self.conflicts)
+
+
+class SimulatedClock:
+    """ Simulated wall time of the trials on the workers.
+
+    A trial is booked on the worker that is free first as the pool hands
+    it to any free worker, so the time is exact for one worker and a
+    greedy estimate for a pool.
+    """
+
+    def __init__(self, workers):
+        self.timelines = [0.0] * workers
+        self.trials = 0
+        self._lock = threading.Lock()
+
+    def book(self, duration):
+        with self._lock:
+            worker = self.timelines.index(min(self.timelines))
+            self.timelines[worker] += duration
+            self.trials += 1
+
+    @property
+    def time(self):
+        return max(self.timelines)
+
+
+class FakeRunner:
+    """ Runner that answers the trials by the project instead of tests.
+
+    The install time of a trial grows with the pins changed since the
+    original requirements, like an install on top of the baseline layer.
+    """
+
+    def __init__(self, scenario, project, clock, worker=0):
+        self.scenario = scenario
+        self.project = project
+        self.clock = clock
+        self.worker = worker
+
+    def spawn(self, worker):
+        return FakeRunner(self.scenario, self.project, self.clock, worker)
+
+    def run_tests(self, requirements=None, command=None):
+        pins = self.project.pinned_versions(requirements or
+                                            self.project.lines)
+        changed = sum(self.project.pins[name] != version
+                      for name, version in pins.items())
+        self.clock.book(self.scenario.install_time +
+                        self.scenario.install_time_per_pin * changed +
+                        self.scenario.test_time)
+        return self.project.passes(pins)
+
+    def install_baseline(self, requirements, req_file):
+        return True
+
+    def freeze(self):
+        return self.project.lines
+
+    def top_level_map(self):
+        return {}
+
+    def image_id(self):
+        return 'simulation'
+
+    def download_wheel(self, pin):
+        return False
+
+    def get_environment(self):
+        return None
+
+    def log_stats(self):
+        pass
+
+
+@contextmanager
+def _settings(scenario, directory, server):
+    """ Configure the upgrade of the scenario with the local pypi. """
+    settings = {
+        'WORKING_DIRECTORY': directory,
+        'LOCAL_REQUIREMENTS_FILE': 'requirements.txt',
+        'STRATEGY': scenario.strategy,
+        'WORKERS': scenario.workers,
+        'SEARCH_ARITY': scenario.arity,
+        'RESUME': False,
+        'RESOLVE_DEPENDENCIES': False,
+        'SKIP_SDIST_ONLY': False,
+        'JOURNAL_FILE': '',
+        'TRIAL_STORE': '',
+        'IMPACT_TEST_COMMAND': '',
+        'WHEELHOUSE_DIR': '',
+        'METRICS_REPORT': '',
+        'METRICS_TEXTFILE': '',
+        'PYPI_CACHE_DIR': '',
+        'PYPI_OFFLINE': False,
+        'PYPI_REFRESH': False,
+        'PYPI_INDEX_URL': server.index_url,
+    }
+    with ExitStack() as stack:
+        for name, value in settings.items():
+            stack.enter_context(patch.object(Config, name, value))
+        stack.enter_context(patch.object(PypiPackage, 'URL_PATTERN',
+                                         server.json_url_pattern))
+        stack.enter_context(patch.object(pypi_packages, '_packages', {}))
+        stack.enter_context(patch.object(pypi_packages, 'environment', None))
+        # the log of thousands of trials costs more than the orchestration
+        logging.disable(logging.INFO)
+        stack.callback(logging.disable, logging.NOTSET)
+        yield
+
+
+def run(scenario):
+    # type: (Scenario) -> dict
+    """ Run the upgrade of the scenario and get its results. """
+    project = Project.generate(scenario)
+    packages = {name: dict.fromkeys(versions, {})
+                for name, versions in project.releases.items()}
+    with tempfile.TemporaryDirectory() as directory, \
+            FakePypiServer(packages) as server, \
+            _settings(scenario, directory, server):
+        req_file = RequirementsLocal(os.path.join(directory,
+                                                  'requirements.txt'))
+        req_file.write_lines(project.lines)
+        clock = SimulatedClock(scenario.workers)
+        client = FakeRunner(scenario, project, clock)
+
+        tracemalloc.start()
+        started = time.process_time()
+        try:
+            pool = (RunnerPool.create(client, req_file, scenario.workers)
+                    if scenario.workers > 1 else None)
+            upgrade = Upgrade(client, req_file, pool)
+            upgrade.start_upgrade()
+        finally:
+            cpu_time = time.process_time() - started
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    final = pinned_versions(upgrade.req_lines)
+    return {
+        'trials': clock.trials,
+        'upgraded': sum(final[name] != version
+                        for name, version in project.pins.items()),
+        'simulated_time': round(clock.time, 1),
+        'cpu_time': round(cpu_time, 3),
+        'peak_memory': peak_memory,
+    }
+
+
+def load_baselines(path=BASELINES):
+    # type: (str) -> dict
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baselines(baselines, path=BASELINES):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(dict(sorted(baselines.items())), f, indent=2)
+        f.write('\n')
+
+
+def compare(scenario, result, baseline):
+    # type: (Scenario, dict, dict) -> list
+    """ Get regressions of the result against the baseline.
+
+    The trials are deterministic and must match, the simulated time is
+    exact for one worker only, CPU time and memory may only grow a little.
+    """
+    problems = []
+    for key in ('trials', 'upgraded'):
+        if result[key] != baseline[key]:
+            problems.append(f'{key}: {result[key]} != {baseline[key]}')
+    tolerance = POOL_TIME_TOLERANCE if scenario.workers > 1 else 0
+    if (abs(result['simulated_time'] - baseline['simulated_time']) >
+            tolerance * baseline['simulated_time'] + 0.1):
+        problems.append(f'simulated_time: {result["simulated_time"]}s, '
+                        f'baseline {baseline["simulated_time"]}s')
+    if (result['cpu_time'] >
+            baseline['cpu_time'] * CPU_TIME_FACTOR + CPU_TIME_SLACK):
+        problems.append(f'cpu_time: {result["cpu_time"]}s, '
+                        f'baseline {baseline["cpu_time"]}s')
+    if (result['peak_memory'] >
+            baseline['peak_memory'] * MEMORY_FACTOR + MEMORY_SLACK):
+        problems.append(f'peak_memory: {result["peak_memory"]}, '
+                        f'baseline {baseline["peak_memory"]}')
+    return problems
@@ -0,0 +1,39 @@
+import os
+from unittest import TestCase, skipUnless
+
+from tests.benchmarks.simulation import FULL_SIZE, SCENARIOS, Project, \
+    compare, load_baselines, run
+
+
+class SimulationBenchmarkTestCase(TestCase):
+    """ The simulated upgrade runs do not regress from the baselines. """
+
+    def setUp(self) -> None:
+        self.baselines = load_baselines()
+
+    def test_project(self):
+        """ The project is the same for the same seed. """
+        scenario = SCENARIOS[0]
+        project = Project.generate(scenario)
+        self.assertEqual(project.lines, Project.generate(scenario).lines)
+        self.assertEqual(scenario.packages, len(project.lines))
+        self.assertTrue(project.passes(project.pins))
+
+    def test_baselines(self):
+        self.check([scenario for scenario in SCENARIOS
+                    if scenario.packages < FULL_SIZE])
+
+    @skipUnless(os.environ.get('SAFE_PIP_UPGRADE_BENCHMARKS') == 'full',
+                'set SAFE_PIP_UPGRADE_BENCHMARKS=full to run')
+    def test_full_baselines(self):
+        self.check([scenario for scenario in SCENARIOS
+                    if scenario.packages >= FULL_SIZE])
+
+    def check(self, scenarios):
+        for scenario in scenarios:
+            with self.subTest(scenario.name):
+                self.assertIn(scenario.name, self.baselines)
+                result = run(scenario)
+                self.assertEqual(
+                    [], compare(scenario, result,
+                                self.baselines[scenario.name]))
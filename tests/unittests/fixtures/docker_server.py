@@ -0,0 +1,116 @@
+import json
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler
+from socketserver import ThreadingUnixStreamServer
+
+
+class FakeDockerServer:
+    """ Local stand-in of the docker engine API on a unix socket.
+
+    containers format: {name: {"Running": bool, "Image": image id}}.
+    run(args) emulates the exec commands, it returns (exit code, [(stream,
+    data), ...]). events are streamed to the subscribers.
+    """
+
+    def __init__(self, socket_path, containers, run, events=()):
+        self.socket_path = socket_path
+        self.containers = containers
+        self.run = run
+        self.events = list(events)
+        self.requests = []
+        self.connections = 0
+        self.execs = {}
+        self._server = ThreadingUnixStreamServer(socket_path, self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        args=(0.01,), daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                server.connections += 1
+
+            def do_GET(self):
+                server.requests.append(('GET', self.path))
+                parts = self.path.strip('/').split('/')[1:]
+                if parts[0] == 'containers' and parts[2] == 'json':
+                    container = server.containers.get(parts[1])
+                    if container is None:
+                        self.answer(404, {'message': 'No such container'})
+                    else:
+                        self.answer(200, {
+                            'Image': container['Image'],
+                            'State': {'Running': container['Running']}})
+                elif parts[0] == 'exec' and parts[2] == 'json':
+                    self.answer(200, {'Running': False,
+                                      'ExitCode': server.execs[parts[1]]})
+                elif parts[0].startswith('events'):
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Transfer-Encoding', 'chunked')
+                    self.end_headers()
+                    for event in server.events:
+                        data = json.dumps(event).encode() + b'\n'
+                        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+                    self.wfile.write(b'0\r\n\r\n')
+                else:
+                    self.answer(404, {'message': 'page not found'})
+
+            def do_POST(self):
+                server.requests.append(('POST', self.path))
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length) or b'{}')
+                parts = self.path.strip('/').split('/')[1:]
+                if parts[0] == 'containers' and parts[2] == 'exec':
+                    if parts[1] not in server.containers:
+                        self.answer(404, {'message': 'No such container'})
+                        return
+                    exec_id = str(len(server.execs))
+                    server.execs[exec_id] = body['Cmd']
+                    self.answer(201, {'Id': exec_id})
+                elif parts[0] == 'exec' and parts[2] == 'start':
+                    self.start(parts[1])
+                else:
+                    self.answer(404, {'message': 'page not found'})
+
+            def start(self, exec_id):
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'application/vnd.docker.raw-stream')
+                self.end_headers()
+                self.wfile.flush()
+                code, frames = server.run(server.execs[exec_id])
+                for stream, data in frames:
+                    self.wfile.write(struct.pack('>BxxxL', stream, len(data)))
+                    self.wfile.write(data)
+                    self.wfile.flush()
+                server.execs[exec_id] = code
+                # the stream ends with the connection
+                self.close_connection = True
+
+            def answer(self, status, data):
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
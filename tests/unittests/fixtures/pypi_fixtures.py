@@ -303,3 +303,18 @@ PYPI_ANSWER = json.dumps({
                    'upload_time_iso_8601': '2019-12-31T09:57:44.729470Z',
                    'url': 'https://files.pythonhosted.org/packages/45/8b/13656dfc264f8acd91bccd7a8e35edb9e92183beb32b9e4d7b250a5f635d/ppci-0.5.7.tar.gz'}]}
 })
+
+# the same releases in the PEP 691 json simple API format
+PYPI_SIMPLE_ANSWER = json.dumps({
+    'meta': {'api-version': '1.0'},
+    'name': 'ppci',
+    'files': [
+        {'filename': file['filename'],
+         'url': file['url'],
+         'hashes': {'sha256': file['digests']['sha256']},
+         'requires-python': file['requires_python'],
+         'yanked': False}
+        for files in json.loads(PYPI_ANSWER)['releases'].values()
+        for file in files
+    ],
+})
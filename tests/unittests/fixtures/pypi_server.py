@@ -0,0 +1,119 @@
+import hashlib
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from safe_pip_upgrade.pypi_simple import CONTENT_TYPE
+
+try:
+    from packaging.utils import canonicalize_name
+except ImportError:  # pragma: no cover
+    # noinspection PyProtectedMember,PyCompatibility
+    from pip._vendor.packaging.utils import canonicalize_name
+
+
+class FakePypiServer:
+    """ Local stand-in of pypi with the json simple API and legacy json API.
+
+    packages format: {name: {version: {release options}}}, options:
+        yanked - all files of the release are yanked (default: False)
+        requires_python - requires-python of files (default: None)
+        wheel - the release has a pure python wheel (default: True)
+    """
+
+    def __init__(self, packages, simple=True):
+        self.packages = {canonicalize_name(name): (name, releases)
+                         for name, releases in packages.items()}
+        self.simple = simple
+        self.requests = []
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        args=(0.01,), daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}'
+
+    @property
+    def index_url(self):
+        return self.url + '/simple/'
+
+    @property
+    def json_url_pattern(self):
+        return self.url + '/pypi/{package}/json'
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def files(self, name, version, options):
+        files = [{'filename': f'{name}-{version}.tar.gz',
+                  'packagetype': 'sdist'}]
+        if options.get('wheel', True):
+            # the project name of the wheel is escaped as in PEP 427
+            wheel_name = re.sub(r'[-_.]+', '_', name)
+            files.append({'filename':
+                          f'{wheel_name}-{version}-py3-none-any.whl',
+                          'packagetype': 'bdist_wheel'})
+        for file in files:
+            file['url'] = f'{self.url}/files/{file["filename"]}'
+            file['yanked'] = options.get('yanked', False)
+            file['requires_python'] = options.get('requires_python')
+        return files
+
+    def simple_answer(self, name, releases):
+        files = []
+        for version, options in releases.items():
+            for file in self.files(name, version, options):
+                file['requires-python'] = file.pop('requires_python')
+                del file['packagetype']
+                files.append(file)
+        return {'meta': {'api-version': '1.0'}, 'name': name, 'files': files}
+
+    def legacy_answer(self, name, releases):
+        return {'info': {'name': name},
+                'releases': {version: self.files(name, version, options)
+                             for version, options in releases.items()}}
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                server.requests.append((self.path, dict(self.headers)))
+                parts = self.path.strip('/').split('/')
+                package = server.packages.get(
+                    canonicalize_name(parts[1]) if len(parts) > 1 else '')
+                if package and parts[0] == 'simple' and server.simple:
+                    self.answer(server.simple_answer(*package), CONTENT_TYPE)
+                elif package and parts[0] == 'pypi' and parts[-1] == 'json':
+                    self.answer(server.legacy_answer(*package),
+                                'application/json')
+                else:
+                    self.send_error(404)
+
+            def answer(self, data, content_type):
+                body = json.dumps(data).encode()
+                etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -1,7 +1,12 @@
+import queue
 from unittest.case import TestCase
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
+from safe_pip_upgrade.config import Config
 from safe_pip_upgrade.runners.compose import ComposeRunner
+from safe_pip_upgrade.runners.incremental import (
+    Installer, changed_pins, requirement_pins)
+from safe_pip_upgrade.runners.watcher import ContainerWatcher
 
 
 class FakeConfig:
@@ -9,6 +14,18 @@ class FakeConfig:
     COMPOSE_PROJECT_FOLDER = 'COMPOSE_PROJECT_FOLDER'
     COMPOSE_SERVICE_NAME = 'COMPOSE_SERVICE_NAME'
     COMPOSE_REQUIREMENTS_FILE = 'COMPOSE_REQUIREMENTS_FILE'
+    TEST_START_COMMAND = 'python -m test'
+    TEST_STAGES = ''
+    TEST_FAILURE_PATTERNS = ''
+    TEST_DEADLINE_FACTOR = 0
+    TEST_DEADLINE_PERCENTILE = 95
+    TEST_DEADLINE_MIN = 60
+    COMPOSE_WHEELHOUSE_DIR = '/wheelhouse'
+    COMPOSE_SNAPSHOT = False
+    COMPOSE_SNAPSHOT_DIR = '/layer'
+    COMPOSE_DOCKER_SOCKET = ''
+    COMPOSE_WATCH_EVENTS = False
+    COMPOSE_TIMEOUT = 20
 
 
 class ComposeTestCase(TestCase):
@@ -47,3 +64,324 @@ class ComposeTestCase(TestCase):
             run_docker.return_value.stdout = b''
             result = runner._check_daemon()
             self.assertFalse(result)
+
+    def test_get_environment(self):
+        runner = ComposeRunner(FakeConfig)
+        with self.run_docker as run_docker, self._check_or_run_daemon_patcher:
+            run_docker.return_value.returncode = 0
+            run_docker.return_value.stdout = (
+                b'{"python_version": "3.8.5", "implementation": "cpython", '
+                b'"platform": "linux-x86_64", "libc": "glibc"}\n')
+
+            environment = runner.get_environment()
+
+            self.assertEqual('3.8.5', environment.python_version)
+            self.assertEqual('manylinux', environment.platform_family)
+
+            run_docker.return_value.returncode = 1
+            self.assertIsNone(runner.get_environment())
+
+    def test_spawn(self):
+        """ Pool worker has its own container and requirements file. """
+        runner = ComposeRunner(FakeConfig).spawn(2)
+
+        self.assertEqual('COMPOSE_SERVICE_NAME_upgrade_2', runner.daemon_name)
+        self.assertEqual('COMPOSE_REQUIREMENTS_FILE_worker_2',
+                         runner.requirements_file_name)
+
+    def test_run_tests_incremental(self):
+        """ The second trial installs only the changed pin. """
+        runner = ComposeRunner(FakeConfig)
+        with self.run_docker as run_docker, self._check_or_run_daemon_patcher:
+            run_docker.return_value.returncode = 0
+
+            runner.run_tests(['a==1.0\n', 'b==1.0 # comment\n'])
+            runner.run_tests(['a==1.0\n', 'b==2.0\n'])
+
+            calls = [c[0][2:] for c in run_docker.call_args_list]
+            self.assertEqual([
+                ('pip', 'install', '-r', 'COMPOSE_REQUIREMENTS_FILE'),
+                ('python', '-m', 'test'),
+                ('pip', 'install', '--no-deps', 'b==2.0'),
+                ('pip', 'check'),
+                ('python', '-m', 'test'),
+            ], calls)
+
+    def test_run_stages(self):
+        """ Stages are run before the tests, a failed stage stops the trial.
+        """
+        class StagesConfig(FakeConfig):
+            TEST_STAGES = ('check | 60 | pip check\n'
+                           'import | | python -c "import a"')
+
+        runner = ComposeRunner(StagesConfig)
+        with self.run_docker as run_docker, self._check_or_run_daemon_patcher:
+            run_docker.return_value.returncode = 0
+            self.assertTrue(runner.test())
+
+            run_docker.return_value.returncode = 1
+            self.assertFalse(runner.test())
+
+            calls = [(c[0][2:], c[1]['timeout'])
+                     for c in run_docker.call_args_list]
+            self.assertEqual([
+                (('pip', 'check'), 60),
+                (('python', '-c', 'import a'), 600),
+                (('python', '-m', 'test'), 600),
+                (('pip', 'check'), 60),
+            ], calls)
+            self.assertEqual(2, runner.pipeline.stats['check'].runs)
+            self.assertEqual(1, runner.pipeline.stats['check'].rejections)
+
+    def test_run_tests_snapshot(self):
+        """ Trial pins are installed to the layer over the original
+        requirements, the pins of the passed trials are merged to them. """
+        class SnapshotConfig(FakeConfig):
+            COMPOSE_SNAPSHOT = True
+
+        runner = ComposeRunner(SnapshotConfig)
+        tests = []
+
+        def run_docker(*args, **kwargs):
+            if args[-3:] == ('python', '-m', 'test'):
+                tests.append(args)
+                # the first trial fails
+                return Mock(returncode=int(len(tests) == 1))
+            return Mock(returncode=0)
+
+        req_file = Mock()
+        with self.run_docker as patched, self._check_or_run_daemon_patcher:
+            patched.side_effect = run_docker
+
+            self.assertTrue(runner.install_baseline(
+                ['a==1.0\n', 'b==1.0\n'], req_file))
+            runner.run_tests(['a==1.0\n', 'b==2.0\n'])
+            runner.run_tests(['a==2.0\n', 'b==1.0\n'])
+            runner.run_tests(['a==2.0\n', 'b==3.0\n'])
+
+            calls = [c[0][2:] for c in patched.call_args_list]
+            layer = ('sh', '-c', 'PYTHONPATH="$0${PYTHONPATH:+:$PYTHONPATH}" '
+                                 'exec "$@"', '/layer')
+            self.assertEqual([
+                ('rm', '-rf', '/layer'),
+                ('pip', 'install', '-r', 'COMPOSE_REQUIREMENTS_FILE'),
+                ('rm', '-rf', '/layer'),
+                ('pip', 'install', '--no-deps', '--target', '/layer',
+                 'b==2.0'),
+                layer + ('pip', 'check'),
+                layer + ('python', '-m', 'test'),
+                # b==2.0 failed and is dropped, b==1.0 is in the baseline
+                ('rm', '-rf', '/layer'),
+                ('pip', 'install', '--no-deps', '--target', '/layer',
+                 'a==2.0'),
+                layer + ('pip', 'check'),
+                layer + ('python', '-m', 'test'),
+                # a==2.0 passed and moves to the baseline
+                ('pip', 'install', '--no-deps', 'a==2.0'),
+                ('rm', '-rf', '/layer'),
+                ('pip', 'install', '--no-deps', '--target', '/layer',
+                 'b==3.0'),
+                layer + ('pip', 'check'),
+                layer + ('python', '-m', 'test'),
+                ('pip', 'install', '--no-deps', 'b==3.0'),
+            ], calls)
+        req_file.write_lines.assert_called_once_with(['a==1.0\n',
+                                                      'b==1.0\n'])
+
+    def test_restart_on_death(self):
+        """ The container dies during the tests, they are run again in a new
+        container with the requirements installed again. """
+        runner = ComposeRunner(FakeConfig)
+        runner.watcher = ContainerWatcher(lambda: (iter(()), None))
+        runner._docker_up = runner.installer.reset
+        tests = []
+
+        def run_docker(*args, **kwargs):
+            if args[2:] == ('python', '-m', 'test'):
+                tests.append(args)
+                if len(tests) == 1:
+                    runner.watcher.handle({'Action': 'die'})
+                    return Mock(returncode=137)
+            return Mock(returncode=0)
+
+        with self.run_docker as patched, self._check_or_run_daemon_patcher:
+            patched.side_effect = run_docker
+            self.assertTrue(runner.run_tests(['a==1.0\n']))
+
+            calls = [c[0][2:] for c in patched.call_args_list]
+            self.assertEqual([
+                ('pip', 'install', '-r', 'COMPOSE_REQUIREMENTS_FILE'),
+                ('python', '-m', 'test'),
+                ('pip', 'install', '-r', 'COMPOSE_REQUIREMENTS_FILE'),
+                ('python', '-m', 'test'),
+            ], calls)
+            self.assertEqual(1, len(runner.restarts))
+
+    def test_watch_liveness(self):
+        """ The container is not polled while its state is known. """
+        runner = ComposeRunner(FakeConfig)
+        events = queue.Queue()
+        runner.watcher = ContainerWatcher(
+            lambda: (iter(events.get, None), lambda: events.put(None)))
+        runner.watcher.start()
+        self.addCleanup(runner.watcher.stop)
+        with self.run_docker as run_docker:
+            run_docker.return_value.stdout = runner.daemon_name.encode()
+
+            runner._check_or_run_daemon()
+            runner._check_or_run_daemon()
+            self.assertEqual(1, run_docker.call_count)
+
+            events.put({'Action': 'die'})
+            self.assertTrue(runner.watcher.wait_death(0, 5))
+            runner._check_or_run_daemon()
+            # the container is up again
+            self.assertEqual(1, len(runner.restarts))
+            self.assertTrue(runner.watcher.alive)
+
+
+class WatcherTestCase(TestCase):
+    """ Container liveness by the events. """
+
+    def test_events(self):
+        aborted = []
+        watcher = ContainerWatcher(lambda: (iter([
+            {'Action': 'exec_start: pip check'},
+            {'status': 'start'},
+            {'Action': 'die'},
+            {'Action': 'destroy'},
+            {'Action': 'start'},
+            {'Action': 'oom'},
+        ]), None), on_die=lambda: aborted.append(watcher.alive),
+            clock=lambda: 10)
+        watcher.start()
+        watcher._thread.join(5)
+
+        self.assertEqual(2, watcher.deaths)
+        self.assertEqual(10, watcher.died_at)
+        self.assertEqual([False, False], aborted)
+        # the stream is closed, the state is unknown
+        self.assertIsNone(watcher.alive)
+        self.assertFalse(watcher.watching)
+        self.assertTrue(watcher.wait_death(1, 0))
+
+    def test_exit_handler(self):
+        """ The exit handler is registered while the watcher runs. """
+        watcher = ContainerWatcher(lambda: (iter([]), None))
+        with patch('safe_pip_upgrade.runners.watcher.atexit') as atexit:
+            for _ in range(3):
+                watcher.start()
+                watcher.stop()
+
+        self.assertEqual(3, atexit.register.call_count)
+        self.assertEqual(3, atexit.unregister.call_count)
+        atexit.unregister.assert_called_with(watcher.stop)
+
+
+class InstallerTestCase(TestCase):
+    """ Incremental installs of the requirements. """
+
+    def setUp(self) -> None:
+        self.time = 0
+        self.calls = []
+        self.check_result = True
+        self.installer = Installer(self.install_all, self.install_pins,
+                                   self.check, clock=lambda: self.time)
+
+    def install_all(self):
+        self.calls.append('all')
+        self.time += 60
+        return True
+
+    def install_pins(self, pins):
+        self.calls.append(pins)
+        self.time += 5
+        return True
+
+    def check(self):
+        self.calls.append('check')
+        return self.check_result
+
+    def test_requirement_pins(self):
+        pins = requirement_pins(['Django_Rest==1.0 # comment\n', '\n',
+                                 '# -r base.txt\n', '-e .\n',
+                                 'a[b] >= 1; python_version < "3.8"\n'])
+        self.assertEqual({'django-rest': 'Django_Rest==1.0', '-e .': '-e .',
+                          'a': 'a[b] >= 1; python_version < "3.8"'}, pins)
+
+    def test_changed_pins(self):
+        installed = {'a': 'a==1', 'b': 'b==1', '-e .': '-e .'}
+        self.assertEqual(['b==2', 'c==1'], changed_pins(
+            installed, {'a': 'a==1', 'b': 'b==2', 'c': 'c==1'}))
+        self.assertIsNone(changed_pins(None, {'a': 'a==1'}))
+        self.assertIsNone(changed_pins(installed, {'-e ..': '-e ..'}))
+
+    def test_install(self):
+        self.assertTrue(self.installer.install(['a==1\n', 'b==1\n']))
+        self.assertTrue(self.installer.install(['a==1\n', 'b==2\n']))
+        # nothing is changed
+        self.assertTrue(self.installer.install(['a==1\n', 'b==2\n']))
+
+        self.assertEqual(['all', ['b==2'], 'check'], self.calls)
+        # 60s - 5s, then the whole full install
+        self.assertEqual(115, self.installer.stats.saved_time)
+
+    def test_dependencies_moved(self):
+        """ Failed check falls back to the full install. """
+        self.installer.install(['a==1\n'])
+        self.check_result = False
+        self.assertTrue(self.installer.install(['a==2\n']))
+        self.assertEqual(['all', ['a==2'], 'check', 'all'], self.calls)
+
+    def test_full_install(self):
+        """ Unknown requirements and the turned off option install all. """
+        self.installer.install(['a==1\n'])
+        self.installer.install(None)
+        with patch.object(Config, 'INCREMENTAL_INSTALL', False):
+            self.installer.install(['a==1\n'])
+        self.installer.reset()
+        self.installer.install(['a==1\n'])
+        self.assertEqual(['all'] * 4, self.calls)
+
+    def test_layer(self):
+        """ Pins are compared with the baseline, the layer is reset. """
+        self.installer.reset_layer = lambda: self.calls.append('reset')
+        self.installer.install(['a==1\n', 'b==1\n'])
+        self.installer.install(['a==2\n', 'b==1\n'])
+        self.installer.install(['a==1\n', 'b==2\n'])
+        self.check_result = False
+        self.installer.install(['a==1\n', 'b==3\n'])
+
+        self.assertEqual(['reset', 'all',
+                          'reset', ['a==2'], 'check',
+                          'reset', ['b==2'], 'check',
+                          'reset', ['b==3'], 'check', 'reset', 'all'],
+                         self.calls)
+        self.assertEqual({'a': 'a==1', 'b': 'b==3'}, self.installer.baseline)
+        self.assertEqual(5, self.installer.stats.resets)
+
+    def test_merge_layer(self):
+        """ Every trial installs only its own change over the original
+        requirements and the passed trials. """
+        merged = []
+        self.installer.reset_layer = lambda: self.calls.append('reset')
+        self.installer.merge_layer = lambda pins: merged.append(pins) or True
+        self.installer.install_baseline(['p0==1\n', 'p1==1\n', 'p2==1\n'])
+        lines = ['p0==1\n', 'p1==1\n', 'p2==1\n']
+        for i in range(3):
+            lines[i] = f'p{i}==2\n'
+            self.installer.install(lines)
+            self.installer.passed()
+
+        self.assertEqual(['reset', 'all',
+                          'reset', ['p0==2'], 'check',
+                          'reset', ['p1==2'], 'check',
+                          'reset', ['p2==2'], 'check'], self.calls)
+        self.assertEqual([['p0==2'], ['p1==2'], ['p2==2']], merged)
+        self.assertEqual(requirement_pins(lines), self.installer.baseline)
+
+        # the baseline is unknown after a failed merge
+        self.installer.merge_layer = lambda pins: False
+        self.installer.install(['p0==3\n', 'p1==2\n', 'p2==2\n'])
+        self.installer.passed()
+        self.assertIsNone(self.installer.baseline)
@@ -0,0 +1,144 @@
+import io
+import os
+import subprocess
+import tempfile
+import time
+from unittest.case import TestCase
+from unittest.mock import patch
+
+from safe_pip_upgrade.runners.compose import ComposeRunner
+from safe_pip_upgrade.runners.docker_api import DockerApiError, DockerClient
+from .fixtures.docker_server import FakeDockerServer
+from .test_compose import FakeConfig
+
+
+class DockerApiTestCase(TestCase):
+
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.socket_path = os.path.join(directory.name, 'docker.sock')
+        self.commands = []
+        self.server = FakeDockerServer(
+            self.socket_path,
+            {'app_upgrade': {'Running': True, 'Image': 'sha256:1'},
+             'stopped': {'Running': False, 'Image': 'sha256:1'}},
+            self.run_command,
+            events=[{'Action': 'start'}, {'Action': 'die'}])
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.client = DockerClient(self.socket_path)
+
+    def run_command(self, args):
+        self.commands.append(args)
+        if args[0] == 'sleep':
+            time.sleep(float(args[1]))
+            return 0, []
+        if args[0] == 'false':
+            return 1, [(2, b'error\n')]
+        if args[-1] == 'failing':
+            return 1, [(1, b'test_a ... ok\nFAIL'), (1, b'ED test_b\n'),
+                       (1, b'test_c ... ok\n')]
+        return 0, [(1, b'out '), (2, b'err '), (1, b'put\n')]
+
+    def test_inspect(self):
+        self.assertTrue(self.client.is_running('app_upgrade'))
+        self.assertFalse(self.client.is_running('stopped'))
+        self.assertFalse(self.client.is_running('unknown'))
+        self.assertEqual('sha256:1',
+                         self.client.inspect('app_upgrade')['Image'])
+        # the requests share the keep-alive connection
+        self.assertEqual(1, self.server.connections)
+        self.assertEqual(('GET', '/v1.40/containers/stopped/json'),
+                         self.server.requests[1])
+
+    def test_exec(self):
+        result = self.client.exec('app_upgrade', ['pip', 'check'],
+                                  capture_output=True)
+        self.assertEqual((0, b'out put\n', b'err '),
+                         (result.returncode, result.stdout, result.stderr))
+
+        result = self.client.exec('app_upgrade', ['false'],
+                                  capture_output=True)
+        self.assertEqual((1, b'', b'error\n'),
+                         (result.returncode, result.stdout, result.stderr))
+
+        self.assertEqual([['pip', 'check'], ['false']], self.commands)
+        self.assertEqual(2, self.client.stats.calls)
+        # create and inspect requests reuse one connection, every stream
+        # has its own
+        self.assertEqual(3, self.server.connections)
+
+    def test_stream_output(self):
+        """ Without capture the output is streamed to the own streams. """
+        stdout = io.TextIOWrapper(io.BytesIO())
+        stderr = io.TextIOWrapper(io.BytesIO())
+        with patch('sys.stdout', stdout), patch('sys.stderr', stderr):
+            result = self.client.exec('app_upgrade', ['test'])
+
+        self.assertEqual(0, result.returncode)
+        self.assertIsNone(result.stdout)
+        self.assertEqual(b'out put\n', stdout.buffer.getvalue())
+        self.assertEqual(b'err ', stderr.buffer.getvalue())
+
+    def test_timeout(self):
+        with self.assertRaises(subprocess.TimeoutExpired):
+            self.client.exec('app_upgrade', ['sleep', '0.5'], timeout=0.1)
+
+    def test_errors(self):
+        with self.assertRaises(DockerApiError):
+            self.client.exec('unknown', ['test'])
+        with self.assertRaises(DockerApiError):
+            DockerClient(self.socket_path + '.missing').inspect('app_upgrade')
+
+    def test_events(self):
+        events, close = self.client.events({'container': ['app_upgrade']})
+        self.assertEqual([{'Action': 'start'}, {'Action': 'die'}],
+                         list(events))
+        close()
+        self.assertIn('filters=%7B%22container%22%3A+%5B%22app_upgrade%22'
+                      '%5D%7D', self.server.requests[-1][1])
+
+    def test_runner(self):
+        """ The runner checks the container and runs the steps by the API.
+        """
+        class ApiConfig(FakeConfig):
+            COMPOSE_SERVICE_NAME = 'app'
+            COMPOSE_DOCKER_SOCKET = self.socket_path
+
+        with patch.object(ComposeRunner, '_docker_up'):
+            runner = ComposeRunner(ApiConfig)
+            self.assertTrue(runner.run_tests())
+            self.assertEqual('sha256:1', runner.image_id())
+
+        self.assertEqual([
+            ['pip', 'install', '-r', 'COMPOSE_REQUIREMENTS_FILE'],
+            ['python', '-m', 'test'],
+        ], self.commands)
+        self.assertIn(('GET', '/v1.40/containers/app_upgrade/json'),
+                      self.server.requests)
+
+    def test_abort_on_failure(self):
+        """ The stage is left on the first failure line and killed in the
+        container. """
+        class ApiConfig(FakeConfig):
+            COMPOSE_SERVICE_NAME = 'app'
+            COMPOSE_DOCKER_SOCKET = self.socket_path
+            TEST_FAILURE_PATTERNS = '^FAILED'
+
+        stdout = io.TextIOWrapper(io.BytesIO())
+        with patch.object(ComposeRunner, '_docker_up'), \
+                patch('sys.stdout', stdout):
+            runner = ComposeRunner(ApiConfig)
+            self.assertTrue(runner.test('python -m test'))
+            self.assertFalse(runner.test('python -m failing'))
+
+        pid_file = '/tmp/app_upgrade.pid'
+        self.assertEqual([
+            ['sh', '-c', 'echo $$ > "$0" && exec "$@"', pid_file,
+             'python', '-m', 'test'],
+            ['sh', '-c', 'echo $$ > "$0" && exec "$@"', pid_file,
+             'python', '-m', 'failing'],
+            ['sh', '-c', 'kill -9 "$(cat "$0")"', pid_file],
+        ], self.commands)
+        self.assertNotIn(b'test_c', stdout.buffer.getvalue())
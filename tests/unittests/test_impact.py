@@ -0,0 +1,81 @@
+import os
+import tempfile
+from unittest.case import TestCase
+from unittest.mock import patch
+
+from safe_pip_upgrade import impact
+from safe_pip_upgrade.impact import ImpactSelector, ImportGraph, parse_imports
+
+PROJECT = {
+    'app/__init__.py': '',
+    'app/views.py': 'import requests\nfrom .utils import helper\n',
+    'app/utils.py': 'import six\n\ndef helper(): pass\n',
+    'app/models.py': 'from django.db import models\n',
+    'tests/__init__.py': '',
+    'tests/test_views.py': 'from app import views\n',
+    'tests/test_models.py': 'import app.models\n',
+    'tests/test_plain.py': 'import os\nimport app\n',
+}
+TOP_LEVEL_MAP = {'requests': ['requests'], 'six': ['six'],
+                 'django': ['Django'], 'unused': ['unused-distribution']}
+
+
+class ImpactTestCase(TestCase):
+
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.directory = tmp_dir.name
+        for path, source in PROJECT.items():
+            self.write(path, source)
+        self.cache_path = os.path.join(self.directory, '.impact.json')
+        self.graph = ImportGraph(self.directory, self.cache_path)
+        self.graph.update()
+        self.selector = ImpactSelector(self.graph, TOP_LEVEL_MAP,
+                                       'manage.py test {tests}')
+
+    def write(self, path, source):
+        full_path = os.path.join(self.directory, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'w') as f:
+            f.write(source)
+
+    def test_parse_imports(self):
+        """ Relative imports are resolved, imported names may be modules.
+        """
+        source = (b'import a.b\nfrom . import c\nfrom ..d import e\n'
+                  b'from f import *\n')
+        self.assertEqual(['a.b', 'f', 'pkg.d', 'pkg.d.e', 'pkg.sub',
+                          'pkg.sub.c'],
+                         parse_imports(source, 'pkg.sub.mod', False))
+        self.assertEqual(['pkg.sub', 'pkg.sub.c'],
+                         parse_imports(b'from . import c', 'pkg.sub', True))
+        self.assertEqual([], parse_imports(b'import (', 'pkg', True))
+
+    def test_select(self):
+        """ Tests are selected by the transitive imports. """
+        self.assertEqual(['tests/test_views.py'],
+                         self.selector.select(['six']))
+        self.assertEqual(['tests/test_models.py'],
+                         self.selector.select(['django']))
+        self.assertEqual([], self.selector.select(['unused-distribution']))
+        self.assertIsNone(self.selector.select(['unknown']))
+
+    def test_command(self):
+        self.assertEqual('manage.py test tests.test_models tests.test_views',
+                         self.selector.command(['Django', 'requests']))
+        self.assertEqual('', self.selector.command(['unused-distribution']))
+        self.assertIsNone(self.selector.command(['unknown']))
+
+    def test_incremental_update(self):
+        """ Only the changed files are parsed again. """
+        self.write('app/utils.py', 'import django\n')
+        graph = ImportGraph(self.directory, self.cache_path)
+        with patch.object(impact, 'parse_imports',
+                          wraps=impact.parse_imports) as parse:
+            graph.update()
+
+        self.assertEqual(1, parse.call_count)
+        selector = ImpactSelector(graph, TOP_LEVEL_MAP, '{test_files}')
+        self.assertEqual('tests/test_models.py tests/test_views.py',
+                         selector.command(['django']))
@@ -1,14 +1,22 @@
 import copy
 import json
+import os
 import re
+import tempfile
 from unittest.case import TestCase
 # noinspection PyProtectedMember
 from unittest.mock import MagicMock, patch, _patch, Mock
 
 import requests
 
+from safe_pip_upgrade.config import Config
 from safe_pip_upgrade.pypi import PypiPackage
-from safe_pip_upgrade.core.upgrade import Upgrade
+from safe_pip_upgrade.core.packages import Requirement
+from safe_pip_upgrade.core.upgrade import RunnerException, Upgrade
+from safe_pip_upgrade.journal import Journal
+from safe_pip_upgrade.requirements_file import RequirementsLocal
+from safe_pip_upgrade.resolver import SKIP, Verdict, pinned_versions
+from safe_pip_upgrade.runners.pool import RunnerPool, Worker
 from .fixtures.pypi_fixtures import PYPI_ANSWER
 
 try:
@@ -21,11 +29,14 @@ except ImportError:  # pragma: no cover
 class PypiPatcherMixin(TestCase):
     """ Mixin for patch request to Pypi to fixtures. """
     req_patcher: _patch
+    cache_patcher: _patch
 
     @classmethod
     def setUpClass(cls) -> None:
         super().setUpClass()
-        cls.req_patcher = patch('safe_pip_upgrade.pypi.requests.get', )
+        cls.cache_patcher = patch.object(Config, 'PYPI_CACHE_DIR', None)
+        cls.cache_patcher.start()
+        cls.req_patcher = patch('safe_pip_upgrade.pypi.session.get', )
         get = cls.req_patcher.start()
         get.return_value.status_code = requests.codes.ok
         get.return_value.text = PYPI_ANSWER
@@ -34,6 +45,7 @@ class PypiPatcherMixin(TestCase):
     def tearDownClass(cls) -> None:
         super().tearDownClass()
         cls.req_patcher.stop()
+        cls.cache_patcher.stop()
 
 
 class TryUpgradeRequirementsTestCase(PypiPatcherMixin):
@@ -82,6 +94,39 @@ class TryUpgradeRequirementsTestCase(PypiPatcherMixin):
         call_number = len(req_file.write_lines.call_args_list)
         self.assertEqual(call_number, 1)
 
+    def test_try_upgrade_below_upper_bound(self):
+        """ The cap above the pinned version is kept. """
+        client = MagicMock()
+        client.run_tests.return_value = True
+        req_file = CopyArgsMagicMock()
+
+        upgrade = Upgrade(client, req_file)
+        upgrade.req_lines = ['ppci<0.5.7\n']
+
+        upgrade.try_upgrade_requirement(0)
+
+        self.assertEqual('ppci==0.5.6,<0.5.7 # the latest working version\n',
+                         upgrade.req_lines[0])
+        # 0.5.7 is excluded without a trial
+        client.run_tests.assert_not_called()
+
+    def test_prefetch_packages(self):
+        """ Packages are prefetched unless their lines are final. """
+        upgrade = Upgrade(MagicMock(), MagicMock())
+        upgrade.req_lines = [
+            'p-1==0.0.2\n',
+            '# p-2==0.0.2\n',
+            'p-3==0.0.1 # the latest working version\n',
+            'p-4==0.0.1 # error on the version 0.0.3\n',
+            'p-5 # the latest working version\n',
+            '\n',
+        ]
+        with patch('safe_pip_upgrade.core.upgrade.pypi_packages') as packages:
+            upgrade.prefetch_packages()
+
+        names = packages.prefetch.call_args[0][0]
+        self.assertEqual(['p-1', 'p-4', 'p-5'], names)
+
     def test_try_upgrade_from_latest_version(self):
         """ The latest version is already installed. """
         client = MagicMock()
@@ -93,7 +138,7 @@ class TryUpgradeRequirementsTestCase(PypiPatcherMixin):
 
         upgrade.try_upgrade_requirement(0)
 
-        # version 0.5 is a latest
+        # version 0.5.7 is the latest the upper bound allows
         self.assertEqual('ppci==0.5.7\n', upgrade.req_lines[0])
 
         # there were no attempts to upgrade
@@ -131,20 +176,28 @@ p-4==0.0.4
     '''
 
     get_patcher: _patch
+    cache_patcher: _patch
+    journal_patcher: _patch
+    metrics_patcher: _patch
 
     @classmethod
-    def fake_get(cls, url):
+    def fake_get(cls, url, **kwargs):
         """ Emulate pypi answer with releases in cls.FAKE_RELEASES. """
         template = PypiPackage.URL_PATTERN.replace('{package}', '(.*)')
-        package = re.search(template, url).group(1)
-        response = json.dumps(
-            {'releases': {r: [] for r in cls.FAKE_RELEASES[package][0]}})
+        search = re.search(template, url)
         result = Mock()
+        if not search:
+            # the simple API is not supported by the fake
+            result.status_code = requests.codes.not_found
+            result.raise_for_status.side_effect = requests.HTTPError()
+            return result
+        response = json.dumps(
+            {'releases': {r: [] for r in cls.FAKE_RELEASES[search[1]][0]}})
         result.status_code = requests.codes.ok
         result.text = response
         return result
 
-    def fake_test(self):
+    def fake_test(self, requirements=None, command=None):
         """ Emulate testing with data in cls.FAKE_RELEASES. """
         lines = self.req_file.write_lines.call_args[0][0]
         for line in lines:
@@ -161,7 +214,13 @@ p-4==0.0.4
     @classmethod
     def setUpClass(cls) -> None:
         super().setUpClass()
-        cls.get_patcher = patch('safe_pip_upgrade.pypi.requests.get',
+        cls.cache_patcher = patch.object(Config, 'PYPI_CACHE_DIR', None)
+        cls.cache_patcher.start()
+        cls.journal_patcher = patch.object(Config, 'JOURNAL_FILE', '')
+        cls.journal_patcher.start()
+        cls.metrics_patcher = patch.object(Config, 'METRICS_REPORT', '')
+        cls.metrics_patcher.start()
+        cls.get_patcher = patch('safe_pip_upgrade.pypi.session.get',
                                 cls.fake_get)
         cls.get_patcher.start()
 
@@ -169,12 +228,25 @@ p-4==0.0.4
     def tearDownClass(cls) -> None:
         super().tearDownClass()
         cls.get_patcher.stop()
+        cls.journal_patcher.stop()
+        cls.metrics_patcher.stop()
+        cls.cache_patcher.stop()
+
+    @staticmethod
+    def fake_client(run_tests):
+        """ Mock client, every install succeeds, run_tests(lines,
+        command) runs the tests. """
+        client = MagicMock()
+        client.run_tests = run_tests
+        client.install.return_value = True
+        client.test.side_effect = lambda command=None: run_tests(
+            client.install.call_args[0][0], command)
+        client.get_environment.return_value = None
+        return client
 
     def test_start_upgrade(self):
         """ Start upgrade with the fake data and check the result. """
-        # mock client
-        client = MagicMock()
-        client.run_tests = self.fake_test
+        client = self.fake_client(self.fake_test)
         # mock requirements file
         self.req_file = CopyArgsMagicMock()
 
@@ -185,10 +257,451 @@ p-4==0.0.4
         exp = self.str_to_list(self.EXPECTED_REQUIREMENTS)
         self.req_file.write_lines.assert_called_with(exp)
 
+    def test_wheel_pins(self):
+        """ Candidate versions are prefetched in the search order. """
+        client = MagicMock()
+        self.req_file = CopyArgsMagicMock()
+        self.req_file.read_lines.return_value = self.str_to_list(
+            self.ORIGINAL_REQUIREMENTS)
+        upgrade = Upgrade(client, self.req_file)
+
+        self.assertEqual(['p-1==0.0.4', 'p-2==0.0.4', 'p-3==0.0.2',
+                          'p-1==0.0.3', 'p-2==0.0.3'], upgrade.wheel_pins())
+
     def str_to_list(self, string):
         return [s + '\n' for s in string.split('\n')]
 
 
+class ResumeUpgradeTestCase(StartUpgradeTestCase):
+    """ The interrupted upgrade is resumed from the journal. """
+
+    def setUp(self) -> None:
+        super().setUp()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        for name, value in (('WORKING_DIRECTORY', tmp_dir.name),
+                            ('JOURNAL_FILE', 'pip_upgrade.journal')):
+            patcher = patch.object(Config, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def create_upgrade(self, run_tests):
+        upgrade = Upgrade(self.fake_client(run_tests), self.req_file)
+        upgrade.req_lines = self.str_to_list(self.ORIGINAL_REQUIREMENTS)
+        return upgrade
+
+    def test_resume(self):
+        """ Finished packages and trials are not tested again. """
+        self.req_file = CopyArgsMagicMock()
+        tested = []
+
+        def crash_on_third_trial(requirements, command=None):
+            if len(tested) == 2:
+                raise RunnerException()
+            tested.append(list(requirements))
+            return self.fake_test()
+
+        self.create_upgrade(crash_on_third_trial).start_upgrade()
+        self.assertEqual(2, len(tested))
+
+        def count_trials(requirements, command=None):
+            tested.append(list(requirements))
+            return self.fake_test()
+
+        self.req_file = CopyArgsMagicMock()
+        # the requirements file has the lines of the interrupted trial
+        upgrade = self.create_upgrade(count_trials)
+        upgrade.req_lines = ['p-1==0.0.4\n']
+        with patch.object(Config, 'RESUME', True):
+            upgrade.start_upgrade()
+
+        exp = self.str_to_list(self.EXPECTED_REQUIREMENTS)
+        self.req_file.write_lines.assert_called_with(exp)
+        self.req_file.make_backup.assert_not_called()
+        # every trial of the one by one upgrade is run once: p-1 0.0.4 and
+        # 0.0.3, then p-2 0.0.4 (interrupted) and p-3 0.0.2
+        self.assertEqual(4, len(tested))
+        self.assertEqual(len(tested), len({''.join(t) for t in tested}))
+
+    def test_replayed_pass(self):
+        """ The passed trial of the journal is the base of the next
+        impacted trials like the live one. """
+        self.req_file = CopyArgsMagicMock()
+        run_tests = MagicMock()
+        upgrade = self.create_upgrade(run_tests)
+        upgrade.journal = MagicMock()
+        upgrade.journal.known_result.return_value = True
+        lines = ['p-1==0.0.4\n', 'p-2==0.0.1\n']
+
+        self.assertTrue(upgrade.run_trial(lines))
+
+        run_tests.assert_not_called()
+        self.req_file.write_lines.assert_called_with(lines)
+        self.req_file.copy_file.assert_called_with('', '_last_pass')
+        self.assertEqual({'p-1': 'p-1==0.0.4', 'p-2': 'p-2==0.0.1'},
+                         upgrade.passed_pins)
+
+    def test_install_results(self):
+        """ Failed installs are told from the trials interrupted in the
+        tests, the lines failed to install are not installed again. """
+        self.req_file = CopyArgsMagicMock()
+
+        def crash(requirements, command=None):
+            raise RunnerException()
+
+        upgrade = self.create_upgrade(crash)
+        # p-1 0.0.4 fails to install, the tests of p-1 0.0.3 crash
+        upgrade.client.install.side_effect = (
+            lambda lines: 'p-1==0.0.4\n' not in lines)
+        upgrade.start_upgrade()
+
+        installed = [call[0][0]
+                     for call in upgrade.client.install.call_args_list]
+        self.assertEqual(2, len(installed))
+        journal = Journal(os.path.join(Config.WORKING_DIRECTORY,
+                                       Config.JOURNAL_FILE))
+        self.assertTrue(journal.load())
+        self.assertFalse(journal.known_result(installed[0],
+                                              'python -m test impacted'))
+        self.assertIsNone(journal.known_result(installed[1]))
+
+    def test_finished_session(self):
+        """ The finished session is not resumed. """
+        self.req_file = CopyArgsMagicMock()
+        self.create_upgrade(self.fake_test).start_upgrade()
+
+        upgrade = self.create_upgrade(self.fake_test)
+        with patch.object(Config, 'RESUME', True):
+            upgrade.start_upgrade()
+
+        self.assertEqual(2, self.req_file.make_backup.call_count)
+
+
+class MetricsUpgradeTestCase(StartUpgradeTestCase):
+    """ The report of the run is written at the end. """
+
+    def test_start_upgrade(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        textfile = os.path.join(tmp_dir.name, 'upgrade.prom')
+        client = MagicMock()
+        client.run_tests = self.fake_test
+        client.get_environment.return_value = None
+        self.req_file = CopyArgsMagicMock()
+        upgrade = Upgrade(client, self.req_file)
+        upgrade.req_lines = self.str_to_list(self.ORIGINAL_REQUIREMENTS)
+
+        with patch.object(Config, 'WORKING_DIRECTORY', tmp_dir.name), \
+                patch.object(Config, 'METRICS_REPORT', 'report.json'), \
+                patch.object(Config, 'METRICS_TEXTFILE', textfile):
+            upgrade.start_upgrade()
+
+        with open(os.path.join(tmp_dir.name, 'report.json')) as f:
+            report = json.load(f)
+        self.assertFalse(report['interrupted'])
+        self.assertEqual(
+            {'from': '0.0.2', 'to': '0.0.3', 'trials': 2, 'passed': 1,
+             'accepted': ['0.0.3'], 'rejected': ['0.0.4']},
+            {key: value for key, value in report['packages']['p-1'].items()
+             if key != 'time'})
+        self.assertEqual(('0.0.4', 0),
+                         (report['packages']['p-4']['to'],
+                          report['packages']['p-4']['trials']))
+        self.assertEqual(4, report['phases']['trial']['count'])
+
+        with open(textfile) as f:
+            text = f.read()
+        self.assertIn('safe_pip_upgrade_phase_seconds_count{phase="trial"} 4',
+                      text)
+        self.assertIn('safe_pip_upgrade_trials_total{result="passed"} 3',
+                      text)
+        self.assertIn('safe_pip_upgrade_upgraded_packages 3', text)
+
+
+class ImpactUpgradeTestCase(StartUpgradeTestCase):
+    """ Trials run the impacted tests, the full suite verifies them. """
+
+    def test_start_upgrade(self):
+        commands = []
+
+        def fake_test(requirements=None, command=None):
+            commands.append(command)
+            return self.fake_test()
+
+        selector = MagicMock()
+        selector.command.side_effect = lambda names: f'test {" ".join(names)}'
+        client = MagicMock()
+        client.run_tests = fake_test
+        client.get_environment.return_value = None
+        self.req_file = CopyArgsMagicMock()
+        upgrade = Upgrade(client, self.req_file)
+        upgrade.req_lines = self.str_to_list(self.ORIGINAL_REQUIREMENTS)
+
+        with patch('safe_pip_upgrade.core.upgrade.ImpactSelector.'
+                   'from_config', return_value=selector):
+            upgrade.start_upgrade()
+
+        exp = self.str_to_list(self.EXPECTED_REQUIREMENTS)
+        self.req_file.write_lines.assert_called_with(exp)
+        # changes since the last passed trial, then the full suite
+        self.assertEqual(['test p-1', 'test p-1', 'test p-2', 'test p-3',
+                          None], commands)
+
+
+class ResolverUpgradeTestCase(StartUpgradeTestCase):
+    """ Candidates conflicting with the pins are rejected without trials.
+    """
+
+    def test_start_upgrade(self):
+        trials = []
+
+        def fake_test(requirements=None, command=None):
+            trials.append([line.strip() for line in requirements])
+            return self.fake_test()
+
+        def check(name, version, pins):
+            self.assertEqual({'p-1', 'p-2', 'p-3', 'p-4'}, set(pins))
+            if (name, version) == ('p-1', '0.0.4'):
+                return Verdict(SKIP, [])
+            return None
+
+        resolver = MagicMock()
+        resolver.check.side_effect = check
+        resolver.prune.return_value = {}
+        client = MagicMock()
+        client.run_tests = fake_test
+        client.get_environment.return_value = None
+        self.req_file = CopyArgsMagicMock()
+        upgrade = Upgrade(client, self.req_file)
+        upgrade.req_lines = self.str_to_list(self.ORIGINAL_REQUIREMENTS)
+
+        with patch('safe_pip_upgrade.core.upgrade.DependencyResolver.'
+                   'from_config', return_value=resolver):
+            upgrade.start_upgrade()
+
+        exp = self.str_to_list(self.EXPECTED_REQUIREMENTS)
+        self.req_file.write_lines.assert_called_with(exp)
+        self.assertEqual(3, len(trials))
+        self.assertFalse([lines for lines in trials
+                          if 'p-1==0.0.4' in lines])
+        self.assertEqual(1, upgrade.skipped_trials)
+
+
+class IncludesUpgradeTestCase(StartUpgradeTestCase):
+    """ Requirements of the -r includes are upgraded in their files within
+    the -c constraints. """
+
+    def test_start_upgrade(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        files = {
+            'requirements.txt': '-c constraints.txt\np-1==0.0.2\n'
+                                '-r base.txt\n',
+            'base.txt': 'p-2==0.0.2\np-3==0.0.1 # error on the version '
+                        '0.0.3\n',
+            'constraints.txt': 'p-2<0.0.4\n',
+        }
+        for name, text in files.items():
+            with open(os.path.join(tmp_dir.name, name), 'w') as f:
+                f.write(text)
+        trials = []
+
+        def fake_test(requirements=None, command=None):
+            trials.append(requirements)
+            return self.fake_test()
+
+        client = MagicMock()
+        client.run_tests = fake_test
+        client.get_environment.return_value = None
+        req_file = RequirementsLocal(
+            os.path.join(tmp_dir.name, 'requirements.txt'))
+        self.req_file = CopyArgsMagicMock(wraps=req_file)
+        self.req_file.full_name = req_file.full_name
+
+        with patch.object(Config, 'FOLLOW_INCLUDES', True):
+            upgrade = Upgrade(client, self.req_file)
+            upgrade.start_upgrade()
+
+        self.assertIn('# >>> -r base.txt\n', trials[0])
+        self.assertFalse([lines for lines in trials
+                          if 'p-2==0.0.4\n' in lines])
+        self.assertEqual(1, upgrade.skipped_trials)
+        for name, text in {
+            'requirements.txt': '-c constraints.txt\n'
+                                'p-1==0.0.3 # the latest working version\n'
+                                '-r base.txt\n',
+            'base.txt': 'p-2==0.0.3 # the latest working version\n'
+                        'p-3==0.0.2 # the latest working version\n',
+        }.items():
+            with open(os.path.join(tmp_dir.name, name)) as f:
+                self.assertEqual(text, f.read(), name)
+
+
+class ParallelUpgradeTestCase(StartUpgradeTestCase):
+    """ The same workflow with a pool of the runners. """
+
+    def fake_worker_test(self, req_file):
+        lines = req_file.write_lines.call_args[0][0]
+        return self.check_lines(lines)
+
+    def check_lines(self, lines):
+        for line in lines:
+            result = re.search(r'(p-\d)==(\d\.\d\.\d)', line)
+            if not result:
+                continue
+            version = parse(result[2])
+            max_version = parse(self.FAKE_RELEASES[result[1]][1])
+            if version > max_version:
+                return False
+        return True
+
+    def create_upgrade(self, original_requirements, workers=3):
+        client = MagicMock()
+        client.get_environment.return_value = None
+        client.run_tests = self.fake_test
+        self.req_file = CopyArgsMagicMock()
+        pool_workers = []
+        for number in range(workers):
+            req_file = CopyArgsMagicMock()
+            runner = MagicMock()
+            runner.run_tests.side_effect = (
+                lambda lines, command=None, f=req_file:
+                self.fake_worker_test(f))
+            pool_workers.append(Worker(runner, req_file, number))
+        self.pool = RunnerPool(pool_workers)
+
+        upgrade = Upgrade(client, self.req_file, pool=self.pool)
+        upgrade.req_lines = self.str_to_list(original_requirements)
+        return upgrade
+
+    def test_start_upgrade(self):
+        """ Start upgrade with the fake data and check the result. """
+        upgrade = self.create_upgrade(self.ORIGINAL_REQUIREMENTS)
+        upgrade.start_upgrade()
+
+        exp = self.str_to_list(self.EXPECTED_REQUIREMENTS)
+        self.req_file.write_lines.assert_called_with(exp)
+        # the trials were run by the workers, the main runner verified
+        # the upgrades together
+        self.assertEqual(4, sum(w.trials for w in self.pool.workers))
+        self.assertEqual(1, len(self.req_file.copy_file.call_args_list))
+        # every worker has the original requirements under its trials
+        original = self.str_to_list(self.ORIGINAL_REQUIREMENTS)
+        for worker in self.pool.workers:
+            worker.runner.install_baseline.assert_called_once_with(
+                original, worker.req_file)
+
+    def test_fail_together(self):
+        """ Upgrades that fail together are added one by one. """
+        def fake_test(requirements, command=None):
+            lines = self.req_file.write_lines.call_args[0][0]
+            return not ('p-5==0.0.2\n' in lines and 'p-6==0.0.2\n' in lines)
+
+        releases = {'p-5': (('0.0.1', '0.0.2'), '0.0.2'),
+                    'p-6': (('0.0.1', '0.0.2'), '0.0.2')}
+        upgrade = self.create_upgrade('p-5==0.0.1\np-6==0.0.1', workers=2)
+        upgrade.client.run_tests = fake_test
+        with patch.dict(self.FAKE_RELEASES, releases):
+            upgrade.start_upgrade()
+
+        exp = ['p-5==0.0.2\n', 'p-6==0.0.1 # error on the version 0.0.2\n']
+        self.req_file.write_lines.assert_called_with(exp)
+
+
+class KArySearchTestCase(ParallelUpgradeTestCase):
+    """ The same workflow with several versions tested at once. """
+
+    def setUp(self) -> None:
+        super().setUp()
+        patcher = patch.object(Config, 'SEARCH_ARITY', 4)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_start_upgrade(self):
+        """ Start upgrade with the fake data and check the result. """
+        upgrade = self.create_upgrade(self.ORIGINAL_REQUIREMENTS)
+        upgrade.start_upgrade()
+
+        exp = self.str_to_list(self.EXPECTED_REQUIREMENTS)
+        self.req_file.write_lines.assert_called_with(exp)
+
+    def test_search_rounds(self):
+        """ The interval is narrowed k + 1 times every round. """
+        releases = [f'1.0.{n}' for n in range(61)]
+        upgrade = self.create_upgrade('', workers=4)
+        for worker in self.pool.workers:
+            worker.runner.run_tests.side_effect = (
+                lambda lines, command=None, f=worker.req_file: int(re.search(
+                    r'==1\.0\.(\d+)', f.write_lines.call_args[0][0][0]
+                )[1]) <= 37)
+        with patch.dict(self.FAKE_RELEASES, {'p-k': (releases, '1.0.37')}):
+            lines = ['p-k==1.0.0\n']
+            upgrade.search_version_concurrently(
+                Requirement(lines[0]), 0, lines)
+
+        self.assertEqual(['p-k==1.0.37 # the latest working version\n'],
+                         lines)
+        # 15, 30, 45, 60, then 33, 36, 39, 42, then 37, 38
+        self.assertEqual(10, sum(w.trials for w in self.pool.workers))
+
+
+class GroupUpgradeTestCase(StartUpgradeTestCase):
+    """ The same workflow with the group strategy. """
+
+    def setUp(self) -> None:
+        super().setUp()
+        patcher = patch.object(Config, 'STRATEGY', 'group')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_start_upgrade(self):
+        super().test_start_upgrade()
+
+        # p-1, p-2 and p-3 together, p-1 alone, p-2 and p-3 together, then
+        # the version search of p-1
+        self.assertEqual(4, len(self.req_file.write_lines.call_args_list) - 1)
+
+    def test_known_failure(self):
+        """ The second half of a failed group is not tested as a whole. """
+        names = ['p-7', 'p-8', 'p-9', 'p-0']
+        releases = {name: (('0.0.1', '0.0.2'), '0.0.2') for name in names}
+        releases['p-0'] = (('0.0.1', '0.0.2'), '0.0.1')
+        self.req_file = CopyArgsMagicMock()
+        client = MagicMock()
+        client.run_tests = self.fake_test
+        client.get_environment.return_value = None
+        upgrade = Upgrade(client, self.req_file)
+        upgrade.req_lines = [f'{name}==0.0.1\n' for name in names]
+
+        with patch.dict(self.FAKE_RELEASES, releases):
+            upgrade.start_upgrade()
+
+        tested = [args[0] for args, _ in
+                  self.req_file.write_lines.call_args_list[:-1]]
+        # all, p-7 and p-8, p-9, then p-0 is known to fail
+        self.assertEqual(3, len(tested))
+        self.assertEqual(['p-7==0.0.2\n', 'p-8==0.0.2\n', 'p-9==0.0.2\n',
+                          'p-0==0.0.1 # the latest working version\n'],
+                         upgrade.req_lines)
+
+    def test_runner_failure(self):
+        """ The broken runner interrupts the upgrade. """
+        self.req_file = CopyArgsMagicMock()
+        client = MagicMock()
+        client.run_tests.side_effect = RunnerException()
+        client.get_environment.return_value = None
+        upgrade = Upgrade(client, self.req_file)
+        upgrade.req_lines = self.str_to_list(self.ORIGINAL_REQUIREMENTS)
+
+        upgrade.start_upgrade()
+
+        self.assertTrue(upgrade.interrupted)
+        self.assertEqual(1, client.run_tests.call_count)
+        self.assertEqual(
+            pinned_versions(self.str_to_list(self.ORIGINAL_REQUIREMENTS)),
+            pinned_versions(upgrade.req_lines))
+
+
 class CopyArgsMagicMock(MagicMock):
     """ Overrides MagicMock to store copies of arguments passed into calls. """
 
@@ -0,0 +1,59 @@
+from itertools import count
+from unittest.case import TestCase
+
+from safe_pip_upgrade.metrics import Metrics
+
+
+class MetricsTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.metrics = Metrics(clock=count(step=2).__next__)
+
+    def test_report(self):
+        with self.metrics.phase('install'):
+            pass
+        self.metrics.observe('install', 30)
+        self.metrics.count('pypi_cache_hits', 3)
+        self.metrics.trial('Django_Filter', 12.5, True)
+        self.metrics.decision('django-filter', '2.0', True)
+        self.metrics.versions('django-filter', '1.0', '2.0')
+
+        report = self.metrics.report()
+        self.assertEqual({'install': {'count': 2, 'total': 32, 'max': 30}},
+                         report['phases'])
+        self.assertEqual({'pypi_cache_hits': 3}, report['counters'])
+        # the names are canonical
+        self.assertEqual(
+            {'django-filter': {'from': '1.0', 'to': '2.0', 'trials': 1,
+                               'passed': 1, 'time': 12.5,
+                               'accepted': ['2.0'], 'rejected': []}},
+            report['packages'])
+
+    def test_prometheus(self):
+        for duration in (0.05, 3, 7200):
+            self.metrics.observe('stage:tests', duration)
+        self.metrics.trial('a', 1, False)
+        self.metrics.count('restarts')
+
+        lines = self.metrics.prometheus(interrupted=True).splitlines()
+        self.assertIn('# TYPE safe_pip_upgrade_phase_seconds histogram',
+                      lines)
+        buckets = [line for line in lines
+                   if line.startswith('safe_pip_upgrade_phase_seconds_bucket')]
+        self.assertEqual(
+            'safe_pip_upgrade_phase_seconds_bucket{phase="stage:tests",'
+            'le="0.1"} 1', buckets[0])
+        self.assertEqual(
+            'safe_pip_upgrade_phase_seconds_bucket{phase="stage:tests",'
+            'le="5"} 2', buckets[3])
+        self.assertEqual(
+            'safe_pip_upgrade_phase_seconds_bucket{phase="stage:tests",'
+            'le="+Inf"} 3', buckets[-1])
+        for line in (
+                'safe_pip_upgrade_phase_seconds_sum{phase="stage:tests"} '
+                '7203.050',
+                'safe_pip_upgrade_phase_seconds_count{phase="stage:tests"} 3',
+                'safe_pip_upgrade_trials_total{result="failed"} 1',
+                'safe_pip_upgrade_events_total{event="restarts"} 1',
+                'safe_pip_upgrade_run_interrupted 1'):
+            self.assertIn(line, lines)
@@ -0,0 +1,64 @@
+import io
+import subprocess
+import sys
+import time
+from unittest.case import TestCase
+from unittest.mock import patch
+
+from safe_pip_upgrade.runners.output import FailureMatcher, OutputMonitor, \
+    follow
+
+
+class FakeConfig:
+    TEST_FAILURE_PATTERNS = '\n ^FAILED \n^ERROR:\n'
+
+
+class OutputTestCase(TestCase):
+
+    def test_monitor(self):
+        """ Chunks of the streams are checked by lines. """
+        matcher = FailureMatcher.from_config(FakeConfig)
+        monitor = OutputMonitor(matcher)
+        self.assertFalse(monitor.feed(1, b'test_a ... ok\nFAI'))
+        self.assertFalse(monitor.feed(2, b'LED in stderr\n'))
+        self.assertTrue(monitor.feed(1, b'LED test_b\r\nERROR: test_c\n'))
+        self.assertEqual('FAILED test_b', monitor.failure)
+
+        monitor = OutputMonitor(matcher)
+        self.assertFalse(monitor.feed(1, b'ok\nERROR: at the end'))
+        self.assertTrue(monitor.close())
+        self.assertEqual('ERROR: at the end', monitor.failure)
+
+        class NoPatterns(FakeConfig):
+            TEST_FAILURE_PATTERNS = ''
+
+        self.assertIsNone(FailureMatcher.from_config(NoPatterns))
+
+    def test_follow(self):
+        """ The process is killed on the abort or the timeout. """
+        script = ('import sys, time\n'
+                  'for line in sys.argv[1:]:\n'
+                  '    print(line, flush=True)\n'
+                  'time.sleep(10)\n')
+        lines = []
+
+        def on_output(stream, line):
+            lines.append(line)
+            return line.startswith(b'FAILED')
+
+        stdout = io.TextIOWrapper(io.BytesIO())
+        started = time.monotonic()
+        with patch('sys.stdout', stdout), subprocess.Popen(
+                [sys.executable, '-c', script, 'ok', 'FAILED', 'next'],
+                stdout=subprocess.PIPE) as process:
+            self.assertNotEqual(0, follow(process, on_output, timeout=10))
+        self.assertEqual([b'ok\n', b'FAILED\n'], lines)
+        self.assertEqual(b'ok\nFAILED\n', stdout.buffer.getvalue())
+
+        with subprocess.Popen([sys.executable, '-c', script]) as process:
+            with self.assertRaises(subprocess.TimeoutExpired):
+                follow(process, timeout=0.2)
+        self.assertLess(time.monotonic() - started, 5)
+
+        with subprocess.Popen([sys.executable, '-c', 'exit(3)']) as process:
+            self.assertEqual(3, follow(process, timeout=10))
@@ -1,12 +1,25 @@
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from unittest import mock
 from unittest.case import TestCase
 
 import requests
 
-from safe_pip_upgrade import pypi
-from safe_pip_upgrade.pypi import PypiPackage, PypiPackages, pypi_packages
-from safe_pip_upgrade.core.packages import RequirementType, Requirement
-from .fixtures.pypi_fixtures import PYPI_ANSWER
+from safe_pip_upgrade.config import Config
+from safe_pip_upgrade.pypi import (AdaptiveLimiter, PypiPackage, PypiPackages,
+                                   pypi_packages, release_url)
+from safe_pip_upgrade.pypi_cache import PypiCache
+from safe_pip_upgrade.environment import TargetEnvironment
+from safe_pip_upgrade.pypi_simple import (CONTENT_TYPE, iter_files,
+                                          version_from_filename, wheel_tags)
+from safe_pip_upgrade.releases import ReleaseTable, Version, version_key
+from safe_pip_upgrade.core.packages import (RecognizeException,
+                                            RequirementType, Requirement)
+from .fixtures.pypi_fixtures import PYPI_ANSWER, PYPI_SIMPLE_ANSWER
+from .fixtures.pypi_server import FakePypiServer
 
 
 class PypiPackageTestCase(TestCase):
@@ -15,7 +28,7 @@ class PypiPackageTestCase(TestCase):
     @classmethod
     def setUpClass(cls) -> None:
         super().setUpClass()
-        with mock.patch('safe_pip_upgrade.pypi.requests.get', ) as req:
+        with mock.patch('safe_pip_upgrade.pypi.session.get', ) as req:
             req.return_value.status_code = requests.codes.ok
             req.return_value.text = PYPI_ANSWER
             cls.package = PypiPackage('ppci')
@@ -42,6 +55,64 @@ class PypiPackageTestCase(TestCase):
         version = self.package.get_middle_version(self.package.last_version)
         self.assertFalse(version)
 
+    def test_not_released_versions(self):
+        """ Versions that are not in releases are found by bisect. """
+        self.assertEqual('0.5.1', self.package.next_version('0.5.0'))
+        self.assertEqual('0.5.4', self.package.next_version('0.5.4rc1'))
+        self.assertIsNone(self.package.next_version('0.5.7'))
+        self.assertEqual('0.5.2',
+                         self.package.get_middle_version('0.5.0', '0.5.5'))
+        self.assertEqual('0.5.4',
+                         self.package.get_middle_version('0.5.3.1', '0.5.6a1'))
+
+    def test_get_spread_versions(self):
+        """ Versions for the k-ary search are spread over the interval. """
+        self.assertEqual(['0.5.3', '0.5.5', '0.5.7'],
+                         self.package.get_spread_versions('0.5', count=3))
+        self.assertEqual(['0.5.2', '0.5.4'],
+                         self.package.get_spread_versions('0.5', '0.5.7', 2))
+        self.assertEqual(['0.5.6'],
+                         self.package.get_spread_versions('0.5.5', '0.5.7', 4))
+        self.assertFalse(self.package.get_spread_versions('0.5.5', '0.5.6', 4))
+        self.assertFalse(self.package.get_spread_versions('0.5.7', count=4))
+
+    def test_search_order(self):
+        """ The versions the binary search tries go first. """
+        self.assertEqual(['0.5.7', '0.5.3', '0.5.1', '0.5.5', '0.5.2',
+                          '0.5.4', '0.5.6'],
+                         self.package.search_order('0.5'))
+        self.assertEqual(['0.5.3', '0.5.2', '0.5.4'],
+                         self.package.search_order('0.5.1', '0.5.5'))
+        self.assertFalse(self.package.search_order('0.5.7'))
+
+
+class ReleaseTableTestCase(TestCase):
+
+    def test_version_key_order(self):
+        """ Keys are ordered as packaging versions. """
+        versions = ['1.0.dev1', '1.0a1.dev1', '1.0a1', '1.0a2', '1.0b1',
+                    '1.0rc1', '1.0', '1.0.post1.dev1', '1.0.post1', '1.0.1',
+                    '1.1', '2', '1!0.1']
+        keys = [version_key(Version(v)) for v in versions]
+        self.assertEqual(sorted(keys), keys)
+        self.assertEqual(version_key(Version('1.0.0')),
+                         version_key(Version('1')))
+
+    def test_table(self):
+        table = ReleaseTable([
+            ('1.1', False, None),
+            ('1.0', True, '>=3'),
+            ('1.1rc1', False, None),
+        ])
+
+        self.assertEqual(('1.0', '1.1'), table.versions)
+        self.assertEqual([('1.0', True, '>=3', ()), ('1.1', False, None, ())],
+                         list(table))
+        self.assertEqual(1, table.bisect_left('1.1'))
+        self.assertEqual(1, table.bisect_left('1.1.0'))
+        self.assertEqual(2, table.bisect_right('1.1.0'))
+        self.assertEqual(1, table.bisect_right('1.0.5'))
+
 
 class PackagesTestCase(TestCase):
 
@@ -66,12 +137,424 @@ class PackagesTestCase(TestCase):
         get_versions.assert_not_called()
 
 
+class PrefetchTestCase(TestCase):
+    """ Concurrent requests of packages. """
+
+    def setUp(self) -> None:
+        super().setUp()
+        for patcher in (mock.patch.object(Config, 'PYPI_CACHE_DIR', None),
+                        mock.patch('safe_pip_upgrade.pypi.time.sleep')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_prefetch(self):
+        """ Packages are requested once, 429 answers are retried. """
+        throttled = set()
+
+        def fake_get(url, **kwargs):
+            response = mock.Mock()
+            response.iter_content.return_value = [PYPI_SIMPLE_ANSWER.encode()]
+            response.headers = {'Content-Type': CONTENT_TYPE}
+            response.status_code = requests.codes.ok
+            if 'throttled' in url and url not in throttled:
+                throttled.add(url)
+                response.status_code = requests.codes.too_many_requests
+                response.headers = {'Retry-After': '1'}
+            return response
+
+        packages = PypiPackages()
+        names = ['cached', 'a', 'throttled', 'b', 'a']
+        with mock.patch('safe_pip_upgrade.pypi.session.get',
+                        side_effect=fake_get) as get:
+            packages.get_package('cached')
+            get.reset_mock()
+            packages.prefetch(names, max_workers=2)
+
+        self.assertEqual(4, get.call_count)
+        for name in names:
+            with self.subTest(name):
+                package = packages.get_package(name)
+                self.assertEqual('0.5.7', package.last_version)
+
+    def test_prefetch_errors(self):
+        """ A failed package does not stop the prefetch of the others. """
+        def fake_get(url, **kwargs):
+            response = mock.Mock()
+            response.iter_content.return_value = [PYPI_SIMPLE_ANSWER.encode()]
+            response.headers = {'Content-Type': CONTENT_TYPE}
+            response.status_code = requests.codes.ok
+            if 'broken-json' in url:
+                # the legacy API answers with a page that is not json
+                response.headers = {'Content-Type': 'text/html'}
+                response.text = '<html></html>'
+            elif 'broken-http' in url:
+                response.raise_for_status.side_effect = \
+                    requests.HTTPError('500 Server Error')
+            return response
+
+        packages = PypiPackages()
+        with mock.patch('safe_pip_upgrade.pypi.session.get',
+                        side_effect=fake_get):
+            packages.prefetch(['broken-json', 'a', 'broken-http', 'b'],
+                              max_workers=1)
+
+            self.assertEqual('0.5.7', packages.get_package('a').last_version)
+            self.assertEqual('0.5.7', packages.get_package('b').last_version)
+            with self.assertRaises(ValueError):
+                packages.get_package('broken-json')
+
+    def test_adaptive_limiter(self):
+        limiter = AdaptiveLimiter(8)
+
+        limiter.throttle()
+        limiter.throttle()
+        self.assertEqual(2, limiter.limit)
+
+        for _ in range(10):
+            limiter.relax()
+        self.assertEqual(8, limiter.limit)
+
+
+class PypiCacheTestCase(TestCase):
+    """ Disk cache of the release lists. """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = PypiCache(self.tmp_dir.name, ttl=60, max_size=10 ** 6)
+        patcher = mock.patch('safe_pip_upgrade.pypi.session.get')
+        self.get = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.get.return_value.status_code = requests.codes.ok
+        self.get.return_value.text = PYPI_ANSWER
+        self.get.return_value.headers = {'ETag': '"1"'}
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    def test_fresh_entry(self):
+        """ The fresh entry is used without requests. """
+        PypiPackage('ppci', cache=self.cache)
+        self.get.reset_mock()
+
+        package = PypiPackage('ppci', cache=self.cache)
+
+        self.get.assert_not_called()
+        self.assertEqual('0.5.7', package.last_version)
+
+    def test_revalidate_stale_entry(self):
+        """ The stale entry is revalidated with the etag. """
+        PypiPackage('ppci', cache=self.cache)
+        fetched = self.cache.load(Config.PYPI_INDEX_URL, 'ppci')['fetched']
+        self.cache.ttl = 0
+        self.get.return_value.status_code = requests.codes.not_modified
+        self.get.return_value.text = ''
+
+        package = PypiPackage('ppci', cache=self.cache)
+
+        headers = self.get.call_args[1]['headers']
+        self.assertEqual('"1"', headers['If-None-Match'])
+        self.assertEqual('0.5.7', package.last_version)
+        entry = self.cache.load(Config.PYPI_INDEX_URL, 'ppci')
+        self.assertGreaterEqual(entry['fetched'], fetched)
+
+    def test_refresh(self):
+        """ The refresh mode requests pypi unconditionally. """
+        PypiPackage('ppci', cache=self.cache)
+        self.get.reset_mock()
+
+        with mock.patch.object(Config, 'PYPI_REFRESH', True):
+            PypiPackage('ppci', cache=self.cache)
+
+        self.assertEqual({}, self.get.call_args[1]['headers'])
+
+    def test_offline(self):
+        """ The offline mode uses stale entries and never requests. """
+        PypiPackage('ppci', cache=self.cache)
+        self.cache.ttl = 0
+        self.get.reset_mock()
+
+        with mock.patch.object(Config, 'PYPI_OFFLINE', True):
+            package = PypiPackage('ppci', cache=self.cache)
+            with self.assertRaises(ConnectionError):
+                PypiPackage('django', cache=self.cache)
+
+        self.get.assert_not_called()
+        self.assertEqual('0.5.7', package.last_version)
+
+    def test_evict(self):
+        """ The oldest entries are removed above the size limit. """
+        releases = [str(i) for i in range(100)]
+        self.cache.store('index', 'old', releases)
+        old_path = self.cache._path('index', 'old')
+        os.utime(old_path, (time.time() - 100, time.time() - 100))
+        self.cache.max_size = os.path.getsize(old_path) * 3 // 2
+
+        self.cache.store('index', 'new', releases)
+
+        self.assertIsNone(self.cache.load('index', 'old'))
+        self.assertEqual(releases, self.cache.load('index', 'new')['releases'])
+
+    def test_size_counted_once(self):
+        """ The cache directory is scanned by the first write only. """
+        with mock.patch('safe_pip_upgrade.pypi_cache.os.walk',
+                        wraps=os.walk) as walk:
+            for i in range(10):
+                self.cache.store('index', f'p-{i}', [str(i)])
+        self.assertEqual(1, walk.call_count)
+
+    def test_store_requires(self):
+        """ Requires of the releases share the counted size of the cache.
+        """
+        with mock.patch('safe_pip_upgrade.pypi_cache.os.walk',
+                        wraps=os.walk) as walk:
+            for i in range(10):
+                self.cache.store_requires('index', 'p', f'1.{i}',
+                                          [f'q>={i}'])
+        self.assertEqual(1, walk.call_count)
+        self.assertEqual(['q>=3'],
+                         self.cache.load_requires('index', 'p', '1.3'))
+        self.assertIsNone(self.cache.load_requires('index', 'p', '2.0'))
+
+    def test_get_requires(self):
+        """ Requires are requested from the configured index once. """
+        package = PypiPackage('ppci', cache=self.cache)
+        self.get.return_value.text = json.dumps(
+            {'info': {'requires_dist': ['six>=1.0']}})
+        self.get.reset_mock()
+
+        with mock.patch.object(Config, 'PYPI_INDEX_URL',
+                               'https://mirror.example.com/simple/'):
+            self.assertEqual(['six>=1.0'], package.get_requires('0.5.7'))
+            self.assertEqual(['six>=1.0'], package.get_requires('0.5.7'))
+            with mock.patch.object(Config, 'PYPI_OFFLINE', True):
+                self.assertIsNone(package.get_requires('0.5.6'))
+
+        self.get.assert_called_once_with(
+            'https://mirror.example.com/pypi/ppci/0.5.7/json')
+
+    def test_release_url(self):
+        self.assertEqual('https://pypi.org/pypi/ppci/0.5.7/json',
+                         release_url('ppci', '0.5.7'))
+        with mock.patch.object(Config, 'PYPI_INDEX_URL',
+                               'http://localhost:8080'):
+            self.assertEqual('http://localhost:8080/pypi/ppci/0.5.7/json',
+                             release_url('ppci', '0.5.7'))
+
+    def test_concurrent_store(self):
+        """ Concurrent writers of the entry don't share a temporary file.
+        """
+        releases = [str(i) for i in range(1000)]
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(
+                lambda _: self.cache.store('index', 'p', releases),
+                range(32)))
+        self.assertEqual(releases, self.cache.load('index', 'p')['releases'])
+        self.assertEqual(['p.json'], os.listdir(
+            os.path.dirname(self.cache._path('index', 'p'))))
+
+
+class SimpleApiTestCase(TestCase):
+    """ Requests to the local stand-in index. """
+    RELEASES = {
+        'Some_Package': {
+            '1.0': {},
+            '1.1': {'yanked': True},
+            '2.0': {'requires_python': '>=3.8'},
+            '2.1rc1': {},
+        },
+    }
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.cache = PypiCache(self.tmp_dir.name, ttl=0, max_size=10 ** 6)
+
+    def start_server(self, simple=True):
+        server = FakePypiServer(self.RELEASES, simple=simple).__enter__()
+        self.addCleanup(server.__exit__)
+        for patcher in (
+                mock.patch.object(Config, 'PYPI_INDEX_URL', server.index_url),
+                mock.patch.object(PypiPackage, 'URL_PATTERN',
+                                  server.json_url_pattern)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return server
+
+    def test_simple_api(self):
+        server = self.start_server()
+
+        package = PypiPackage('some-package', cache=self.cache)
+
+        self.assertEqual(['/simple/some-package/'],
+                         [path for path, _ in server.requests])
+        self.assertEqual('2.0', package.last_version)
+        flags = {r.version: r[1:3] for r in package.releases}
+        self.assertEqual({'1.0': (False, None),
+                          '1.1': (True, None),
+                          '2.0': (False, '>=3.8')}, flags)
+
+    def test_legacy_fallback(self):
+        server = self.start_server(simple=False)
+
+        simple_package = PypiPackage('some-package')
+        legacy_package = PypiPackage('some-package', cache=self.cache)
+
+        self.assertEqual(['/simple/some-package/', '/pypi/some-package/json'],
+                         [path for path, _ in server.requests[-2:]])
+        self.assertEqual(list(simple_package.releases),
+                         list(legacy_package.releases))
+
+    def test_revalidation(self):
+        """ The stale entry is revalidated with the same API. """
+        for simple in (True, False):
+            with self.subTest(simple=simple):
+                server = self.start_server(simple=simple)
+                PypiPackage('some-package', cache=self.cache)
+                server.requests.clear()
+
+                package = PypiPackage('some-package', cache=self.cache)
+
+                self.assertEqual(1, len(server.requests))
+                self.assertIn('If-None-Match', server.requests[0][1])
+                self.assertEqual('2.0', package.last_version)
+                self.cache.evict()
+
+    def test_iter_files(self):
+        """ Files are parsed from any chunks. """
+        data = PYPI_SIMPLE_ANSWER.encode()
+        expected = json.loads(PYPI_SIMPLE_ANSWER)['files']
+        for size in (1, 7, len(data)):
+            with self.subTest(size):
+                chunks = (data[i:i + size] for i in range(0, len(data), size))
+                self.assertEqual(expected, list(iter_files(chunks)))
+
+        with self.assertRaises(ValueError):
+            list(iter_files([data[:len(data) // 2]]))
+
+    def test_version_from_filename(self):
+        examples = {
+            'ppci-0.5.7-py3-none-any.whl': '0.5.7',
+            'ppci-0.5.1.zip': '0.5.1',
+            'django-rest-framework-0.1.tar.gz': '0.1',
+            'Django_Rest_Framework-0.1.tar.gz': '0.1',
+            'ppci-0.5.exe': None,
+        }
+        for filename, version in examples.items():
+            with self.subTest(filename):
+                name = 'ppci' if filename.startswith('ppci') else \
+                    'django-rest-framework'
+                self.assertEqual(version,
+                                 version_from_filename(name, filename))
+
+
+class EnvironmentTestCase(TestCase):
+    """ Filter of candidates for the test environment. """
+    RELEASES = {
+        'pkg': {
+            '1.0': {},
+            '1.1': {},
+            '1.2': {'yanked': True},
+            '1.3': {'wheel': False},
+            '1.4': {'requires_python': '>=3.9'},
+            '1.5': {'wheel': False},
+            '1.6': {'wheel': False},
+            '1.7': {'wheel': False, 'requires_python': '>=3.9'},
+        },
+        'sdist-only': {
+            '1.0': {'wheel': False},
+            '1.1': {'wheel': False},
+        },
+    }
+    ENVIRONMENT = TargetEnvironment('3.8.5', 'cpython', 'linux-x86_64', '')
+
+    def setUp(self) -> None:
+        super().setUp()
+        server = FakePypiServer(self.RELEASES).__enter__()
+        self.addCleanup(server.__exit__)
+        patcher = mock.patch.object(Config, 'PYPI_INDEX_URL',
+                                    server.index_url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_candidates(self):
+        package = PypiPackage('pkg', environment=self.ENVIRONMENT)
+
+        self.assertEqual(('1.0', '1.1', '1.3', '1.5', '1.6'),
+                         package.candidates.versions)
+        self.assertEqual('1.6', package.last_version)
+        self.assertEqual({'yanked': 1, 'requires another python': 2},
+                         package.skipped_after('1.1'))
+        # 1.3 in the middle has no wheel, 1.1 is the nearest with a wheel
+        self.assertEqual('1.1', package.get_middle_version('1.0', '1.6'))
+
+        with mock.patch.object(Config, 'SKIP_SDIST_ONLY', True):
+            package.set_environment(self.ENVIRONMENT)
+        self.assertEqual(('1.0', '1.1'), package.candidates.versions)
+
+    def test_no_candidates(self):
+        """ The pinned release stays a candidate, the package without
+        other candidates is not upgraded. """
+        with mock.patch.object(Config, 'SKIP_SDIST_ONLY', True):
+            package = PypiPackage('sdist-only', environment=self.ENVIRONMENT)
+            self.assertIsNone(package.last_version)
+
+            with mock.patch.object(pypi_packages, '_packages',
+                                   {'sdist-only': package}):
+                with self.assertRaises(RecognizeException):
+                    Requirement('sdist-only')
+                req = Requirement('sdist-only==1.0')
+                self.assertFalse(req.increase_version())
+
+        self.assertEqual(('1.0',), package.candidates.versions)
+        self.assertEqual({'has no wheel': 1}, package.skipped_after('1.0'))
+
+    def test_unknown_environment(self):
+        """ Only yanked releases are skipped. """
+        package = PypiPackage('pkg')
+
+        self.assertEqual('1.7', package.last_version)
+        self.assertEqual({'yanked': 1}, package.skipped_after('1.0'))
+        self.assertEqual('1.3', package.get_middle_version('1.0', '1.6'))
+
+    def test_wheel_supported(self):
+        examples = {
+            'py2.py3-none-any': True,
+            'cp38-cp-musllinux': True,
+            'cp38-cp-manylinux': False,
+            'cp37-cp-musllinux': False,
+            'cp36-abi3-musllinux': True,
+            'cp39-abi3-musllinux': False,
+            'cp310-cp-musllinux': False,
+        }
+        for tag, supported in examples.items():
+            with self.subTest(tag):
+                self.assertEqual(supported,
+                                 self.ENVIRONMENT.is_wheel_supported(tag))
+
+    def test_wheel_tags(self):
+        examples = {
+            'ppci-0.5.7-py3-none-any.whl': ['py3-none-any'],
+            'numpy-1.19.0-cp38-cp38-manylinux1_x86_64.whl': [
+                'cp38-cp-manylinux'],
+            'pkg-1.0-1-cp38-abi3-macosx_10_9_x86_64.macosx_11_0_arm64.whl':
+                ['cp38-abi3-macosx'],
+            'ppci-0.5.7.tar.gz': [],
+        }
+        for filename, tags in examples.items():
+            with self.subTest(filename):
+                self.assertEqual(tags, wheel_tags(filename))
+
+
 class RequirementTestCase(TestCase):
 
     @classmethod
     def setUpClass(cls) -> None:
         super().setUpClass()
-        with mock.patch('requests.get') as req:
+        with mock.patch('safe_pip_upgrade.pypi.session.get') as req, \
+                mock.patch.object(Config, 'PYPI_CACHE_DIR', None):
             req.return_value.status_code = requests.codes.ok
             req.return_value.text = PYPI_ANSWER
             cls.package = pypi_packages.get_package('ppci')
@@ -140,3 +623,44 @@ class RequirementTestCase(TestCase):
                 self.assertEqual(params[1], req.version, 'version')
                 self.assertEqual(params[2], req.type, 'type')
                 self.assertEqual(params[3], req.error_version, 'err version')
+
+    def test_get_line_keeps_line_parts(self):
+        """ Only the version and the comment of the line are rewritten. """
+        test_examples = {
+            'ppci[wasm]==0.5.0': 'ppci[wasm]==0.5.7\n',
+            'ppci==0.5.0; python_version >= "3.6"  # error on the '
+            'version 0.6.0':
+                'ppci==0.5.7; python_version >= "3.6" # error on the '
+                'version 0.6.0\n',
+            'ppci>=0.5.0,!=0.5.5,<1.0': 'ppci==0.5.7,!=0.5.5,<1.0\n',
+        }
+        for line, new_line in test_examples.items():
+            with self.subTest(line):
+                req = Requirement(line)
+                req.version = '0.5.7'
+                self.assertEqual(new_line, req.get_line())
+
+    def test_allows(self):
+        req = Requirement('ppci>=0.5.0,!=0.5.5,<0.5.7')
+        self.assertTrue(req.allows('0.5.6'))
+        self.assertFalse(req.allows('0.5.5'))
+        self.assertFalse(req.allows('0.5.7'))
+
+    def test_upper_bound(self):
+        """ A lone upper bound is not the version, it caps the candidates
+        and is kept in the line. """
+        req = Requirement('ppci<=0.5.7')
+        self.assertEqual('0.5.7', req.version)
+        self.assertEqual('ppci==0.5.7\n', req.get_line())
+
+        req = Requirement('ppci<0.5.7')
+        self.assertTrue(Version(req.version) < Version('0.5.7'))
+        self.assertFalse(req.allows('0.5.7'))
+        self.assertEqual(f'ppci=={req.version},<0.5.7\n', req.get_line())
+
+    def test_not_upgradable_lines(self):
+        for line in ('ppci @ https://example.com/ppci-0.5.zip', '-r base.txt',
+                     'ppci==0.5.0 --hash=sha256:abc', 'ppci==0.5.*'):
+            with self.subTest(line):
+                with self.assertRaises(RecognizeException):
+                    Requirement(line)
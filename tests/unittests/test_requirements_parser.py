@@ -0,0 +1,184 @@
+import os
+import tempfile
+from unittest.case import TestCase
+from unittest.mock import patch
+
+from safe_pip_upgrade.requirements_file import RequirementsLocal
+from safe_pip_upgrade.requirements_parser import (
+    BLANK, COMMENT, CONSTRAINT, INCLUDE, INVALID, OPTION, REQUIREMENT, URL,
+    RequirementsIncludes, parse_line)
+
+
+class ParseLineTestCase(TestCase):
+
+    def test_kinds(self):
+        test_examples = {
+            '': BLANK,
+            '   # comment': COMMENT,
+            'ppci': REQUIREMENT,
+            'ppci[wasm,x86]>=0.5; python_version > "3.6"  # c': REQUIREMENT,
+            'ppci @ https://example.com/ppci.zip': URL,
+            'https://example.com/ppci.zip': URL,
+            './local/ppci': URL,
+            '-r base.txt': INCLUDE,
+            '--requirement=base.txt': INCLUDE,
+            '-c constraints.txt': CONSTRAINT,
+            '--index-url https://example.com/simple': OPTION,
+            'ppci==0.5 ==0.6': INVALID,
+            'ppci[wasm': INVALID,
+            'ppci>=': INVALID,
+        }
+        for line, kind in test_examples.items():
+            with self.subTest(line):
+                self.assertEqual(kind, parse_line(line).kind)
+
+    def test_requirement(self):
+        parsed = parse_line('Django[argon2]>=2.2,!=3.0.1,<4.0 ; '
+                            'python_version >= "3.6"  # pinned \\\n')
+        self.assertEqual('Django', parsed.name)
+        self.assertEqual(('argon2',), parsed.extras)
+        self.assertEqual('2.2', parsed.version)
+        self.assertEqual(['!=3.0.1', '<4.0'],
+                         list(map(str, parsed.other_specifiers)))
+        self.assertEqual('python_version >= "3.6"', parsed.marker)
+        self.assertEqual('pinned \\', parsed.comment)
+        self.assertFalse(parsed.continued)
+
+        parsed = parse_line('ppci==0.5.7 \\\n')
+        self.assertTrue(parsed.continued)
+        parsed = parse_line('ppci==0.5.7 --hash=sha256:abc')
+        self.assertEqual((('--hash', 'sha256:abc'),), parsed.options)
+
+    def test_version(self):
+        test_examples = {
+            'ppci': None,
+            'ppci<=0.5.7': None,
+            'ppci<2,!=1.0': None,
+            'ppci!=0.5.6,<1.0,>0.5': '0.5',
+            'ppci~=0.5.0': '0.5.0',
+        }
+        for line, version in test_examples.items():
+            with self.subTest(line):
+                self.assertEqual(version, parse_line(line).version)
+
+    def test_with_version(self):
+        test_examples = {
+            'ppci': 'ppci==1.0\n',
+            'ppci[wasm]': 'ppci[wasm]==1.0\n',
+            '  ppci >= 0.5 , < 2  # old': 'ppci==1.0,<2\n',
+            'ppci<2': 'ppci==1.0,<2\n',
+            'ppci<=1.0.0,!=0.9': 'ppci==1.0,!=0.9\n',
+            'ppci<=2.0': 'ppci==1.0,<=2.0\n',
+            'ppci<=0.5.7;sys_platform=="linux"':
+                'ppci==1.0,<=0.5.7;sys_platform=="linux"\n',
+        }
+        for line, new_line in test_examples.items():
+            with self.subTest(line):
+                self.assertEqual(new_line,
+                                 parse_line(line).with_version('1.0'))
+        self.assertEqual('ppci==1.0 # the latest working version\n',
+                         parse_line('ppci==0.5\n').with_version(
+                             '1.0', 'the latest working version'))
+
+
+class RequirementsIncludesTestCase(TestCase):
+
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.directory = tmp_dir.name
+        self.includes = RequirementsIncludes()
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def read(self, name):
+        with open(os.path.join(self.directory, name)) as f:
+            return f.read()
+
+    def test_expand_and_split(self):
+        """ Nested, repeated and cyclic includes are expanded once and
+        split back to their files. """
+        self.write('base.txt', 'a==1\n-r common/common.txt\n')
+        self.write('common/common.txt', 'b==1\n-r ../base.txt\n')
+        root = self.write('requirements.txt',
+                          'c==1\n-r base.txt\n-r common/common.txt\n')
+        with open(root) as f:
+            lines = self.includes.expand(root, f.readlines())
+
+        self.assertEqual([
+            'c==1\n',
+            '# >>> -r base.txt\n',
+            'a==1\n',
+            '# >>> -r common/common.txt\n',
+            'b==1\n',
+            '# >>> -r ../base.txt\n',
+            '# <<< -r ../base.txt\n',
+            '# <<< -r common/common.txt\n',
+            '# <<< -r base.txt\n',
+            '# >>> -r common/common.txt\n',
+            '# <<< -r common/common.txt\n',
+        ], lines)
+        self.assertEqual(lines, self.includes.expand(root, lines))
+
+        lines[4] = 'b==2\n'
+        files = self.includes.split(root, lines)
+        self.assertEqual(['b==2\n', '-r ../base.txt\n'], files[
+            os.path.realpath(os.path.join(self.directory,
+                                          'common/common.txt'))])
+        self.assertEqual(['c==1\n', '-r base.txt\n', '-r common/common.txt\n'],
+                         files[os.path.realpath(root)])
+
+    def test_files_parsed_once(self):
+        self.write('base.txt', 'a==1\n')
+        self.write('dev.txt', '-r base.txt\n')
+        root = self.write('requirements.txt', '-r base.txt\n-r dev.txt\n')
+        with patch('safe_pip_upgrade.requirements_parser.parse_line',
+                   wraps=parse_line) as parse:
+            self.includes.expand(root, ['-r base.txt\n', '-r dev.txt\n'])
+        # 2 lines of the requirements, 1 line of each included file
+        self.assertEqual(4, parse.call_count)
+
+    def test_constraints(self):
+        """ -c files of the included files constrain the versions and are
+        relative to the requirements file in the trials. """
+        self.write('constraints/base.txt', 'a>=1,<3\nB!=2.1\n'
+                                           '-c more.txt\n')
+        self.write('constraints/more.txt', 'a!=2.5\n')
+        self.write('sub/dev.txt', '-c ../constraints/base.txt\na==1\n')
+        root = self.write('requirements.txt', '-r sub/dev.txt\n')
+        lines = self.includes.expand(root, ['-r sub/dev.txt\n'])
+
+        self.assertIn('-c constraints/base.txt\n', lines)
+        self.assertTrue(self.includes.allows('a', '2.4'))
+        self.assertFalse(self.includes.allows('a', '2.5'))
+        self.assertFalse(self.includes.allows('a', '3'))
+        self.assertFalse(self.includes.allows('b', '2.1'))
+        self.assertTrue(self.includes.allows('c', '2.1'))
+        self.assertEqual(['-c ../constraints/base.txt\n', 'a==1\n'],
+                         self.includes.split(root, lines)[
+                             os.path.realpath(os.path.join(self.directory,
+                                                           'sub/dev.txt'))])
+
+    def test_write_back(self):
+        """ Only the changed included files are written with backups. """
+        self.write('base.txt', 'a==1\n')
+        self.write('dev.txt', 'b==1\n')
+        root = self.write('requirements.txt', '-r base.txt\n-r dev.txt\n')
+        req_file = RequirementsLocal(root)
+        lines = self.includes.expand(root, req_file.read_lines())
+        lines[lines.index('a==1\n')] = 'a==2\n'
+
+        self.includes.write_back(req_file, lines)
+
+        self.assertEqual('a==2\n', self.read('base.txt'))
+        self.assertEqual('b==1\n', self.read('dev.txt'))
+        self.assertEqual('-r base.txt\n-r dev.txt\n',
+                         self.read('requirements.txt'))
+        self.assertEqual(['base.txt', 'base_backup_1.txt', 'dev.txt',
+                          'requirements.txt'],
+                         sorted(os.listdir(self.directory)))
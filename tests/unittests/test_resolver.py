@@ -0,0 +1,109 @@
+from unittest.case import TestCase
+
+from safe_pip_upgrade.environment import TargetEnvironment
+from safe_pip_upgrade.releases import ReleaseTable
+from safe_pip_upgrade.resolver import (CO_UPGRADE, SKIP, DependencyResolver,
+                                       pinned_versions)
+
+
+class FakePackage:
+
+    def __init__(self, versions, requires):
+        self.candidates = ReleaseTable((v, False, None, ()) for v in versions)
+        self.requires = requires
+        self.requested = []
+
+    def get_requires(self, version):
+        self.requested.append(version)
+        return self.requires.get(version)
+
+
+class FakePackages:
+
+    def __init__(self, packages):
+        self.packages = packages
+
+    def get_package(self, name):
+        if name not in self.packages:
+            raise ConnectionError(name)
+        return self.packages[name]
+
+
+class ResolverTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.packages = FakePackages({
+            'requests': FakePackage(('2.0', '3.0', '4.0'), {
+                '2.0': ['urllib3>=1.0'],
+                '3.0': ['urllib3>=2.0', 'idna; python_version < "3"'],
+                '4.0': ['urllib3>=3.0'],
+            }),
+            'urllib3': FakePackage(('1.0', '2.0'), {'1.0': [], '2.0': []}),
+            'botocore': FakePackage(('1.0', '2.0', '3.0'), {
+                '1.0': ['urllib3<2'],
+                '2.0': ['urllib3<3'],
+                '3.0': ['urllib3<3'],
+            }),
+            'idna': FakePackage(('1.0',), {}),
+        })
+        environment = TargetEnvironment('3.8.5')
+        self.resolver = DependencyResolver(self.packages,
+                                           environment.marker_environment)
+
+    def test_pinned_versions(self):
+        self.assertEqual({'requests': '2.0', 'my-package': '1.0'},
+                         pinned_versions(['requests==2.0 # comment\n',
+                                          'My_Package[extra] == 1.0\n',
+                                          'django>=2.0\n', '-r base.txt\n']))
+
+    def test_compatible(self):
+        self.assertIsNone(self.resolver.check(
+            'requests', '3.0', {'urllib3': '2.0', 'idna': '0.1'}))
+
+    def test_needs_co_upgrade(self):
+        """ A newer urllib3 fits the requests candidate. """
+        verdict = self.resolver.check('requests', '3.0', {'urllib3': '1.0'})
+        self.assertEqual(CO_UPGRADE, verdict.status)
+        self.assertEqual('requests requires urllib3>=2.0, urllib3==1.0',
+                         str(verdict.conflicts[0]))
+
+    def test_skip(self):
+        """ There is no urllib3 version the candidate could work with. """
+        verdict = self.resolver.check('requests', '4.0', {'urllib3': '2.0'})
+        self.assertEqual(SKIP, verdict.status)
+
+    def test_required_by_pin(self):
+        """ The pinned packages limit the versions of the candidate. """
+        verdict = self.resolver.check('urllib3', '2.0', {'botocore': '1.0'})
+        self.assertEqual(CO_UPGRADE, verdict.status)
+        self.assertEqual('botocore requires urllib3<2, urllib3==2.0',
+                         str(verdict.conflicts[0]))
+
+        # the latest botocore doesn't fit too
+        self.packages.packages['botocore'] = FakePackage(
+            ('1.0', '2.0'), {'1.0': ['urllib3<2'], '2.0': ['urllib3<2']})
+        resolver = DependencyResolver(self.packages, {})
+        verdict = resolver.check('urllib3', '2.0', {'botocore': '1.0'})
+        self.assertEqual(SKIP, verdict.status)
+
+    def test_unknown(self):
+        """ Unknown requirements don't reject candidates. """
+        self.assertIsNone(self.resolver.check('requests', '5.0',
+                                              {'urllib3': '1.0'}))
+        self.assertIsNone(self.resolver.check('urllib3', '2.0',
+                                              {'unknown': '1.0'}))
+
+    def test_memoized(self):
+        """ Requirements are requested once for all the checks. """
+        pins = {'urllib3': '1.0', 'botocore': '1.0'}
+        verdicts = self.resolver.prune('requests', ['2.0', '3.0', '4.0'], pins)
+        self.resolver.check('urllib3', '2.0', dict(pins, requests='2.0'))
+
+        self.assertEqual({'3.0': CO_UPGRADE, '4.0': SKIP},
+                         {version: verdict.status
+                          for version, verdict in verdicts.items()})
+        self.assertEqual(['2.0', '3.0', '4.0'],
+                         sorted(self.packages.packages['requests'].requested))
+        self.assertEqual(['1.0', '2.0'],
+                         sorted(self.packages.packages['urllib3'].requested))
+        self.assertEqual({CO_UPGRADE: 2, SKIP: 1}, self.resolver.rejections)
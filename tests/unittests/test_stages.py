@@ -0,0 +1,90 @@
+from itertools import count
+from unittest.case import TestCase
+
+from safe_pip_upgrade.stages import Stage, StageDeadlines, TrialPipeline, \
+    parse_stages
+
+
+class StagesTestCase(TestCase):
+
+    def test_parse_stages(self):
+        self.assertEqual([
+            Stage('check', 60, 'pip check'),
+            Stage('import', None, 'python -c "import a | b"'),
+        ], parse_stages('\n check | 60 | pip check \n'
+                        'import || python -c "import a | b"\n'))
+        self.assertEqual([], parse_stages(''))
+        with self.assertRaises(ValueError):
+            parse_stages('check | 60')
+
+    def test_run(self):
+        """ Stages run cheapest first and stop on the first failure. """
+        pipeline = TrialPipeline([Stage('check', 60, 'pip check'),
+                                  Stage('import', 60, 'python -c 1')])
+        clock = count().__next__
+        runs = []
+
+        def run_stage(stage):
+            runs.append(stage.name)
+            return stage.name != failed
+
+        failed = None
+        self.assertTrue(pipeline.run(run_stage, 'test', clock))
+        self.assertEqual(['check', 'import', 'tests'], runs)
+
+        runs.clear()
+        failed = 'check'
+        self.assertFalse(pipeline.run(run_stage, 'test', clock))
+        self.assertEqual(['check'], runs)
+
+        # no tests to run, the stages are run anyway
+        runs.clear()
+        failed = None
+        self.assertTrue(pipeline.run(run_stage, '', clock))
+        self.assertEqual(['check', 'import'], runs)
+
+        stats = pipeline.stats['check']
+        self.assertEqual((3, 1, 3.0),
+                         (stats.runs, stats.rejections, stats.time))
+        self.assertEqual(1, pipeline.stats['tests'].runs)
+
+    def test_deadlines(self):
+        """ Deadline is the percentile of the passed runs times the factor.
+        """
+        deadlines = StageDeadlines(factor=2, percentile=50, minimum=10)
+        self.assertIsNone(deadlines.get('test'))
+        for duration in (30, 10, 20, 1000):
+            deadlines.add('test', duration)
+        self.assertEqual(40, deadlines.get('test'))
+        deadlines.add('check', 1)
+        self.assertEqual(10, deadlines.get('check'))
+
+    def test_run_deadlines(self):
+        """ Stages get the deadline by their previous durations, the
+        configured timeout is the upper bound. """
+        pipeline = TrialPipeline([Stage('check', 60, 'pip check')],
+                                 StageDeadlines(factor=3, minimum=1))
+        durations = {'check': 5, 'tests': 100}
+        timeouts = []
+        clock = iter(range(0, 10000, 5)).__next__
+
+        def run_stage(stage):
+            timeouts.append((stage.name, stage.timeout))
+            for _ in range(durations[stage.name] // 5 - 1):
+                clock()
+            return passed
+
+        passed = True
+        self.assertTrue(pipeline.run(run_stage, 'test', clock))
+        self.assertTrue(pipeline.run(run_stage, 'test', clock))
+        # a failed run is not a duration of the stage
+        durations['tests'] = 5
+        passed = False
+        self.assertFalse(pipeline.run(run_stage, 'test', clock))
+        passed = True
+        self.assertTrue(pipeline.run(run_stage, 'test', clock))
+
+        self.assertEqual([('check', 60), ('tests', None),
+                          ('check', 15), ('tests', 300),
+                          ('check', 15),
+                          ('check', 15), ('tests', 300)], timeouts)
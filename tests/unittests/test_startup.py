@@ -0,0 +1,93 @@
+import configparser
+import os
+import subprocess
+import sys
+import tempfile
+from unittest.case import TestCase
+
+import safe_pip_upgrade
+
+ROOT = os.path.dirname(os.path.dirname(safe_pip_upgrade.__file__))
+# cumulative import time of the CLI module, microseconds
+IMPORT_BUDGET = 100000
+# modules loaded only by the commands that need them
+LAZY_MODULES = ('requests', 'urllib3', 'sqlite3', 'logging.config',
+                'safe_pip_upgrade.pypi', 'safe_pip_upgrade.core.upgrade',
+                'safe_pip_upgrade.runners.compose',
+                'safe_pip_upgrade.runners.docker_api')
+MAIN = 'from safe_pip_upgrade.pip_upgrade import main; main()'
+
+
+class StartupTestCase(TestCase):
+
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.directory = tmp_dir.name
+        self.env = dict(os.environ, PYTHONPATH=ROOT)
+
+    def python(self, *args):
+        return subprocess.run([sys.executable, *args], cwd=self.directory,
+                              env=self.env, capture_output=True, text=True,
+                              check=True)
+
+    def test_import_time(self):
+        """ The CLI module is imported fast without the heavy modules. """
+        result = self.python('-X', 'importtime', '-c',
+                             'import safe_pip_upgrade.pip_upgrade')
+        cumulative = {}
+        for line in result.stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                _, total, name = line.split('|')
+                if total.strip().isdigit():
+                    cumulative[name.strip()] = int(total)
+
+        self.assertEqual([], [name for name in LAZY_MODULES
+                              if name in cumulative])
+        self.assertLess(cumulative['safe_pip_upgrade.pip_upgrade'],
+                        IMPORT_BUDGET)
+
+    def test_no_side_effects(self):
+        """ --help and CREATE-INI write no log, the ini file of the
+        arguments is read before the arguments are applied. """
+        self.python('-c', MAIN, '--help')
+        self.assertEqual([], os.listdir(self.directory))
+
+        ini_file = os.path.join(self.directory, 'custom.ini')
+        with open(ini_file, 'w') as f:
+            f.write('[MAIN]\n'
+                    'working_directory = /from-ini\n'
+                    'local_requirements_file = from-ini.txt\n')
+        self.python('-c', MAIN, '-f', 'custom.ini', '-r', 'from-args.txt',
+                    'CREATE-INI')
+
+        self.assertEqual(['custom.ini'], os.listdir(self.directory))
+        ini = configparser.ConfigParser(inline_comment_prefixes=('#',))
+        ini.read(ini_file)
+        self.assertEqual('/from-ini', ini['MAIN']['working_directory'])
+        self.assertEqual('from-args.txt',
+                         ini['MAIN']['local_requirements_file'])
+
+    def test_search_arity_without_workers(self):
+        """ The k-ary search is rejected before the upgrade starts if
+        there is one runner only. """
+        with self.assertRaises(subprocess.CalledProcessError) as error:
+            self.python('-c', MAIN, '-k', '3', 'UPGRADE')
+
+        self.assertEqual(2, error.exception.returncode)
+        self.assertIn('search arity 3 needs several workers',
+                      error.exception.stderr)
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_resume_without_journal(self):
+        with self.assertRaises(subprocess.CalledProcessError) as error:
+            self.python('-c', MAIN, '--resume', 'UPGRADE')
+
+        self.assertIn('nothing to resume without the journal',
+                      error.exception.stderr)
+
+    def test_offline_without_cache(self):
+        with self.assertRaises(subprocess.CalledProcessError) as error:
+            self.python('-c', MAIN, '--offline', 'UPGRADE')
+
+        self.assertIn('set --cache-dir DIR', error.exception.stderr)
@@ -0,0 +1,89 @@
+import json
+import os
+import tempfile
+import threading
+from itertools import count
+from unittest.case import TestCase
+from unittest.mock import patch
+
+from safe_pip_upgrade.metrics import Metrics
+from safe_pip_upgrade.requirements_file import RequirementsLocal
+from safe_pip_upgrade.tracing import NO_SPAN, Tracer
+
+
+class TracingTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.tracer = Tracer(clock=count(step=0.001).__next__)
+
+    def test_disabled(self):
+        """ The disabled tracer collects nothing. """
+        with self.tracer.span('trial', package='a') as span:
+            span.set(passed=True)
+        self.assertIs(NO_SPAN, span)
+        self.assertEqual([], self.tracer.events)
+        self.tracer.save(os.devnull)
+
+    def test_spans(self):
+        """ Spans of the threads are nested by time. """
+        self.tracer.enable()
+        with self.tracer.span('trial', package='a', version='1.0') as span:
+            with self.tracer.span('docker', command='exec'):
+                pass
+            span.set(passed=False)
+        thread = threading.Thread(target=self.fail_in_span, name='worker')
+        thread.start()
+        thread.join()
+
+        trace = self.tracer.trace()
+        events = [event for event in trace['traceEvents']
+                  if event['ph'] == 'X']
+        self.assertEqual(['trial', 'docker', 'failed'],
+                         [event['name'] for event in events])
+        trial, docker, failed = events
+        self.assertEqual({'package': 'a', 'version': '1.0', 'passed': False},
+                         trial['args'])
+        self.assertLessEqual(trial['ts'], docker['ts'])
+        self.assertLessEqual(docker['ts'] + docker['dur'],
+                             trial['ts'] + trial['dur'])
+        self.assertEqual({'error': 'ValueError'}, failed['args'])
+        self.assertEqual(1, trial['tid'])
+        self.assertEqual(2, failed['tid'])
+        self.assertIn({'name': 'thread_name', 'ph': 'M',
+                       'pid': os.getpid(), 'tid': 2,
+                       'args': {'name': 'worker'}}, trace['traceEvents'])
+
+    def fail_in_span(self):
+        try:
+            with self.tracer.span('failed'):
+                raise ValueError()
+        except ValueError:
+            pass
+
+    def test_instrumentation(self):
+        """ Phases of the metrics and the requirements file are traced. """
+        self.tracer.enable()
+        with tempfile.TemporaryDirectory() as directory, \
+                patch('safe_pip_upgrade.metrics.tracer', self.tracer), \
+                patch('safe_pip_upgrade.requirements_file.tracer',
+                      self.tracer):
+            with Metrics().phase('install', pins=2):
+                requirements = RequirementsLocal(
+                    os.path.join(directory, 'requirements.txt'))
+                requirements.write_lines(['a==1.0\n'])
+                requirements.copy_file('', '_last_pass')
+
+            path = os.path.join(directory, 'trace.json')
+            self.tracer.save(path)
+            with open(path) as f:
+                events = json.load(f)['traceEvents']
+
+        self.assertEqual(
+            [('install', {'pins': 2}),
+             ('requirements.write',
+              {'file': requirements.full_name, 'lines': 1}),
+             ('requirements.copy',
+              {'source': requirements.full_name,
+               'target': requirements.file_with_suffix('_last_pass')})],
+            [(event['name'], event['args']) for event in events
+             if event['ph'] == 'X'])
@@ -0,0 +1,107 @@
+import os
+import tempfile
+from unittest.case import TestCase
+from unittest.mock import patch
+
+from safe_pip_upgrade.config import Config
+from safe_pip_upgrade.runners.incremental import requirement_pins
+from safe_pip_upgrade.trial_store import TrialStore, project_hash
+
+
+class FakeRunner:
+    """ Runner whose tests pass if the installed a is not 2. """
+
+    def __init__(self, image='image-1'):
+        self.image = image
+        self.installed = None
+        self.calls = []
+
+    def image_id(self):
+        return self.image
+
+    def install(self, requirements):
+        self.calls.append('install')
+        if 'broken==1\n' in requirements:
+            return False
+        self.installed = '\n'.join(
+            sorted(requirement_pins(requirements).values()))
+        return True
+
+    def freeze(self):
+        return self.installed
+
+    def test(self, command=None):
+        self.calls.append('test')
+        return 'a==2' not in self.installed
+
+
+class TrialStoreTestCase(TestCase):
+
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, 'trials.sqlite3')
+        self.store = TrialStore(self.path, 'project-1')
+        self.runner = FakeRunner()
+
+    def test_known_results(self):
+        """ Tests are not run again for the known environment. """
+        self.assertTrue(self.store.run_trial(self.runner, ['a==1\n']))
+        self.assertFalse(self.store.run_trial(self.runner, ['a==2\n']))
+
+        # the next run reads the file
+        store = TrialStore(self.path, 'project-1')
+        self.assertTrue(store.run_trial(self.runner, ['a==1 # comment\n']))
+        self.assertFalse(store.run_trial(self.runner, ['a==2\n']))
+
+        self.assertEqual(['install', 'test'] * 2 + ['install'] * 2,
+                         self.runner.calls)
+        self.assertEqual(2, store.hits)
+
+    def test_install_failure(self):
+        """ Failed installs are known by the pins. """
+        installs = []
+        self.assertFalse(self.store.run_trial(self.runner, ['broken==1\n'],
+                                              on_install=installs.append))
+        self.assertFalse(self.store.run_trial(self.runner, ['broken==1\n'],
+                                              on_install=installs.append))
+
+        self.assertEqual(['install'], self.runner.calls)
+        # the known result is not installed
+        self.assertEqual([False], installs)
+
+    def test_invalidate(self):
+        """ Results of other images and projects are removed. """
+        self.store.run_trial(self.runner, ['a==1\n'])
+        self.store.run_trial(FakeRunner('image-2'), ['a==1\n'])
+        TrialStore(self.path, 'project-2').run_trial(self.runner, ['a==1\n'])
+
+        self.store.invalidate('image-1')
+
+        count = self.store._connection.execute(
+            'SELECT COUNT(*) FROM trials').fetchone()[0]
+        self.assertEqual(1, count)
+        self.store.run_trial(self.runner, ['a==1\n'])
+        self.assertEqual(1, self.store.hits)
+
+    def test_project_hash(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'app.py'), 'w') as f:
+                f.write('a = 1')
+            first = project_hash(directory)
+            with open(os.path.join(directory, 'notes.txt'), 'w') as f:
+                f.write('not a code')
+            self.assertEqual(first, project_hash(directory))
+            with open(os.path.join(directory, 'app.py'), 'w') as f:
+                f.write('a = 2')
+            self.assertNotEqual(first, project_hash(directory))
+
+    def test_from_config(self):
+        self.assertIsNone(TrialStore.from_config())
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.object(Config, 'WORKING_DIRECTORY', directory), \
+                patch.object(Config, 'TRIAL_STORE', 'trials.sqlite3'):
+            store = TrialStore.from_config()
+            store._connection.close()
+            self.assertEqual(os.path.join(directory, 'trials.sqlite3'),
+                             store.path)
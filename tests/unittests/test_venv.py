@@ -0,0 +1,167 @@
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from unittest.case import TestCase, skipIf
+from unittest.mock import patch
+
+from safe_pip_upgrade.runners.venv import BIN_DIR, VenvRunner, \
+    clone_environment
+from safe_pip_upgrade.stages import Stage
+from .test_compose import FakeConfig
+
+
+class CloneTestCase(TestCase):
+
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.source = os.path.join(directory.name, 'baseline')
+        self.target = os.path.join(directory.name, 'trial')
+
+    def test_clone(self):
+        """ The files are hardlinked, the scripts with the environment path
+        are rewritten. """
+        os.makedirs(os.path.join(self.source, BIN_DIR))
+        os.makedirs(os.path.join(self.source, 'lib'))
+        module = os.path.join(self.source, 'lib', 'module.py')
+        with open(module, 'w') as f:
+            f.write('VALUE = 1\n')
+        script = os.path.join(self.source, BIN_DIR, 'pip')
+        with open(script, 'w') as f:
+            f.write(f'#!{os.path.abspath(self.source)}/{BIN_DIR}/python\n')
+        os.chmod(script, 0o755)
+        os.symlink(sys.executable,
+                   os.path.join(self.source, BIN_DIR, 'python'))
+
+        clone_environment(self.source, self.target)
+        # the old clone is replaced
+        clone_environment(self.source, self.target)
+
+        cloned_module = os.path.join(self.target, 'lib', 'module.py')
+        self.assertEqual(os.stat(module).st_ino,
+                         os.stat(cloned_module).st_ino)
+        cloned_script = os.path.join(self.target, BIN_DIR, 'pip')
+        self.assertNotEqual(os.stat(script).st_ino,
+                            os.stat(cloned_script).st_ino)
+        with open(cloned_script) as f:
+            self.assertEqual(
+                f'#!{os.path.abspath(self.target)}/{BIN_DIR}/python\n',
+                f.read())
+        with open(script) as f:
+            self.assertIn(os.path.abspath(self.source), f.read())
+        self.assertTrue(os.access(cloned_script, os.X_OK))
+        self.assertTrue(os.path.islink(
+            os.path.join(self.target, BIN_DIR, 'python')))
+
+    @skipIf(sys.platform == 'win32', 'posix layout of the environment')
+    def test_clone_venv(self):
+        """ The clone is a working environment with its own prefix. """
+        subprocess.run([sys.executable, '-m', 'venv', '--without-pip',
+                        self.source], check=True)
+        clone_environment(self.source, self.target)
+
+        result = subprocess.run(
+            [os.path.join(self.target, BIN_DIR, 'python'), '-c',
+             'import sys; print(sys.prefix)'],
+            check=True, capture_output=True)
+        self.assertEqual(os.path.realpath(self.target),
+                         os.path.realpath(result.stdout.decode().strip()))
+
+
+class VenvRunnerTestCase(TestCase):
+
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        class Config(FakeConfig):
+            WORKING_DIRECTORY = directory.name
+            LOCAL_REQUIREMENTS_FILE = 'requirements.txt'
+            VENV_PYTHON = 'python3'
+            VENV_DIR = 'venv'
+            INCREMENTAL_INSTALL = True
+            TEST_FAILURE_PATTERNS = '^FAILED'
+
+        self.config = Config
+        self.directory = directory.name
+        for patcher in (patch('safe_pip_upgrade.runners.incremental.Config',
+                              Config),
+                        patch('safe_pip_upgrade.wheelhouse.Config.'
+                              'WHEELHOUSE_DIR', '')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_run_tests(self):
+        """ The pins are installed to the clone of the baseline. """
+        calls = []
+
+        def run(args, directory='', **kwargs):
+            calls.append((args[:4], directory))
+            return subprocess.CompletedProcess(args, 0, b'', b'')
+
+        def run_stage(stage):
+            calls.append((shlex.split(stage.command), ''))
+            return True
+
+        venv_dir = os.path.join(self.directory, 'venv')
+        with patch.object(VenvRunner, '_run', side_effect=run), \
+                patch.object(VenvRunner, '_run_stage',
+                             side_effect=run_stage), \
+                patch('safe_pip_upgrade.runners.venv.clone_environment') \
+                as clone:
+            runner = VenvRunner(self.config)
+            worker = runner.spawn(1)
+            self.assertTrue(runner.run_tests(['a==1\n', 'b==1\n']))
+            self.assertTrue(runner.run_tests(['a==2\n', 'b==1\n']))
+
+        baseline = os.path.join(venv_dir, 'baseline')
+        trial = os.path.join(venv_dir, 'trial')
+        self.assertEqual([
+            (['python3', '-m', 'venv', baseline], None),
+            (['python', '-m', 'pip', 'install'], baseline),
+            (['python', '-m', 'test'], ''),
+            # the second trial installs only the changed pin to the clone
+            (['python', '-m', 'pip', 'install'], ''),
+            (['python', '-m', 'pip', 'check'], ''),
+            (['python', '-m', 'test'], ''),
+        ], calls)
+        self.assertEqual(os.path.join(venv_dir, 'baseline_worker_1'),
+                         worker.baseline_dir)
+        self.assertTrue(worker.requirements_file_name.endswith(
+            'requirements_worker_1.txt'))
+        self.assertEqual([
+            ((baseline, os.path.join(venv_dir, 'baseline_worker_1')),),
+            # the clone is reset before every trial
+            ((baseline, trial),),
+            ((baseline, trial),),
+            ((baseline, trial),),
+            # the passed trial becomes the baseline of the next trials
+            ((trial, baseline),),
+        ], clone.call_args_list)
+
+    @skipIf(sys.platform == 'win32', 'process groups')
+    def test_run_stage(self):
+        """ The stage is killed on the first failure line or the deadline.
+        """
+        with patch.object(VenvRunner, '_run'):
+            runner = VenvRunner(self.config)
+
+        def stage(script, timeout=None):
+            args = [sys.executable, '-c', script]
+            return Stage('tests', timeout, ' '.join(map(shlex.quote, args)))
+
+        self.assertTrue(runner._run_stage(stage('print("ok")')))
+        self.assertFalse(runner._run_stage(stage('exit(1)')))
+
+        started = time.monotonic()
+        self.assertFalse(runner._run_stage(stage(
+            'import time; print("FAILED test_a", flush=True); '
+            'time.sleep(10)')))
+        self.assertFalse(runner._run_stage(stage(
+            'import subprocess, sys; '
+            'subprocess.run([sys.executable, "-c", "import time; '
+            'time.sleep(10)"])', timeout=0.5)))
+        self.assertLess(time.monotonic() - started, 5)
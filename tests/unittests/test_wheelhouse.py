@@ -0,0 +1,87 @@
+import os
+import tempfile
+import threading
+import time
+from unittest.case import TestCase
+
+from safe_pip_upgrade.wheelhouse import (
+    WheelPrefetcher, Wheelhouse, find_links)
+
+
+class WheelhouseTestCase(TestCase):
+
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.wheelhouse = Wheelhouse(tmp_dir.name, max_size=10,
+                                     max_age=60 * 60)
+
+    def add_wheel(self, file_name, size=1, age=0):
+        path = os.path.join(self.wheelhouse.directory, file_name)
+        with open(path, 'w') as f:
+            f.write('x' * size)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_has(self):
+        self.add_wheel('Django_Rest-3.0-py3-none-any.whl')
+
+        self.assertTrue(self.wheelhouse.has('django-rest==3.0.0'))
+        self.assertFalse(self.wheelhouse.has('django-rest==3.1'))
+        self.assertFalse(self.wheelhouse.has('django-rest>=3.0'))
+
+    def test_find_links(self):
+        """ Pins are installed without the index if all are prebuilt. """
+        self.add_wheel('b-2.0-py3-none-any.whl')
+
+        self.assertEqual(['--no-index', '--find-links', '/wheelhouse'],
+                         find_links(self.wheelhouse, '/wheelhouse',
+                                    ['b==2.0']))
+        self.assertEqual(['--find-links', '/wheelhouse'],
+                         find_links(self.wheelhouse, '/wheelhouse',
+                                    ['b==2.0', 'c==1.0']))
+        self.assertEqual(['--find-links', '/wheelhouse'],
+                         find_links(self.wheelhouse, '/wheelhouse'))
+        self.assertEqual([], find_links(None, '/wheelhouse', ['b==2.0']))
+
+    def test_collect_garbage(self):
+        """ Old wheels and the oldest wheels above the size are removed. """
+        expired = self.add_wheel('a-1-py3-none-any.whl', age=2 * 60 * 60)
+        oldest = self.add_wheel('b-1-py3-none-any.whl', size=5, age=20)
+        used = self.add_wheel('c-1-py3-none-any.whl', size=5, age=30)
+        new = self.add_wheel('d-1-py3-none-any.whl', size=5, age=10)
+        # the used wheel becomes new
+        self.wheelhouse.has('c==1')
+
+        self.wheelhouse.collect_garbage()
+
+        self.assertEqual([False, False, True, True],
+                         [os.path.exists(p) for p in
+                          (expired, oldest, used, new)])
+
+
+class WheelPrefetcherTestCase(TestCase):
+
+    def test_prefetch(self):
+        """ Pins are downloaded in order, the prebuilt ones are skipped. """
+        downloaded = []
+        done = threading.Event()
+        with tempfile.TemporaryDirectory() as directory:
+            wheelhouse = Wheelhouse(directory, 1000, 1000)
+            open(os.path.join(directory, 'b-1-py3-none-any.whl'), 'w').close()
+
+            def download(pin):
+                downloaded.append(pin)
+                if pin == 'd==1':
+                    done.set()
+                return pin != 'c==1'
+
+            prefetcher = WheelPrefetcher(wheelhouse, download, workers=1)
+            prefetcher.start(['a==1', 'b==1', 'c==1', 'd==1'])
+            self.assertTrue(done.wait(5))
+            prefetcher._threads[0].join(5)
+            prefetcher.stop()
+
+        self.assertEqual(['a==1', 'c==1', 'd==1'], downloaded)
+        self.assertEqual((2, 1), (prefetcher.downloaded, prefetcher.failed))